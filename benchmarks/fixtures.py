@@ -0,0 +1,147 @@
+"""
+Deterministic SpaceNet-shaped fixtures, to benchmark the pipeline without downloading the dataset.
+
+The fixtures follow the layout `convert_tif.py` and `create_jsons.py` expect under "Spacenet/":
+georeferenced RGB-PanSharpen GeoTIFFs for every AOI, the Building_Solutions csv of Vegas, Paris,
+Shanghai and Khartoum, and one geojson per tile for Rio. The same seed always gives the same files.
+"""
+import csv
+import json
+import os
+import cv2 as cv
+import numpy as np
+from osgeo import gdal, osr
+
+
+# (number and name of the AOI, name in the file names, longitude and latitude of its first tile, normalized)
+# Rio tiles are 8-bit, the others 16-bit and stretched by convert_tif.py
+FIXTURE_AOIS = [
+    ("1_Rio", "1_RIO", (-43.66, -22.90), False),
+    ("2_Vegas", "2_Vegas", (-115.30, 36.25), True),
+    ("3_Paris", "3_Paris", (2.25, 48.90), True),
+    ("4_Shanghai", "4_Shanghai", (121.45, 31.25), True),
+    ("5_Khartoum", "5_Khartoum", (32.50, 15.60), True),
+]
+
+# degrees per pixel, about 30 cm like the pan-sharpened WorldView-3 tiles
+PIXEL_SIZE = 2.7e-6
+
+
+def _train_folder(aoi):
+    return f"Spacenet/AOI_{aoi}_Train"
+
+
+def _building(rng, tile_size):
+    """A rotated rectangle fully or partly inside the tile, as float pixel coordinates of shape (4, 2)."""
+    cx, cy = rng.uniform(-8, tile_size + 8, size=2)
+    w, h = rng.uniform(6, 40, size=2)
+    angle = rng.uniform(0, np.pi)
+    corners = np.array([[-w, -h], [w, -h], [w, h], [-w, h]]) / 2
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    return corners @ rotation.T + (cx, cy)
+
+
+def _tile(rng, tile_size, buildings, dtype):
+    """Bands of a tile of shape (3, rows, cols): a smooth background with brighter buildings."""
+    high = 255 if dtype == np.uint8 else 2047
+    bands = np.empty((3, tile_size, tile_size), dtype=dtype)
+    for b in range(3):
+        coarse = rng.uniform(0.1, 0.5, size=(8, 8)).astype(np.float32)
+        band = cv.resize(coarse, (tile_size, tile_size), interpolation=cv.INTER_CUBIC)
+        band += rng.normal(0, 0.02, size=band.shape).astype(np.float32)
+        roofs = np.zeros_like(band)
+        cv.fillPoly(roofs, [np.rint(p).astype(np.int32) for p in buildings], float(rng.uniform(0.6, 0.9)))
+        np.maximum(band, roofs, out=band)
+        bands[b] = np.clip(band * high, 0, high)
+    return bands
+
+
+def _write_geotiff(path, bands, geotransform):
+    dtype = gdal.GDT_Byte if bands.dtype == np.uint8 else gdal.GDT_UInt16
+    dataset = gdal.GetDriverByName("GTiff").Create(path, bands.shape[2], bands.shape[1], len(bands), dtype)
+    dataset.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    for b, band in enumerate(bands, start=1):
+        dataset.GetRasterBand(b).WriteArray(band)
+    dataset.FlushCache()
+
+
+def _wkt(points):
+    ring = np.concatenate([points, points[:1]])
+    return "POLYGON ((" + ",".join(f"{x} {y} 0" for x, y in ring.tolist()) + "))"
+
+
+def make_fixtures(root, tiles=8, tile_size=650, buildings=30, empty_fraction=0.1, seed=0):
+    """
+    Writes the fixtures of every AOI under `root`/Spacenet.
+
+    Args:
+        root (str): folder the "Spacenet" folder is created in.
+        tiles (int): number of training tiles of each AOI, a quarter as many test tiles are written.
+        tile_size (int): width and height of the tiles.
+        buildings (int): average number of buildings of a tile.
+        empty_fraction (float): fraction of the tiles without any building.
+        seed (int): seed of the generator.
+
+    Returns:
+        dict: number of "tiles", "buildings" and "bytes" written.
+    """
+    rng = np.random.default_rng(seed)
+    stats = {"tiles": 0, "buildings": 0, "bytes": 0}
+
+    for aoi, file_aoi, (lon, lat), normalize in FIXTURE_AOIS:
+        dtype = np.uint16 if normalize else np.uint8
+        train = os.path.join(root, _train_folder(aoi))
+        test = os.path.join(root, f"Spacenet/AOI_{aoi}_Test_public")
+        for folder in (f"{train}/RGB-PanSharpen", f"{test}/RGB-PanSharpen"):
+            os.makedirs(folder, exist_ok=True)
+
+        rows = []
+        num_test = max(tiles // 4, 1)
+        for index in range(tiles + num_test):
+            img = f"AOI_{file_aoi}_img{index + 1}"
+            folder = f"{train}/RGB-PanSharpen" if index < tiles else f"{test}/RGB-PanSharpen"
+            # tiles are laid out on a row, like neighbouring tiles of a scene
+            geotransform = (lon + index * tile_size * PIXEL_SIZE, PIXEL_SIZE, 0.0, lat, 0.0, -PIXEL_SIZE)
+
+            count = 0 if rng.random() < empty_fraction else int(rng.poisson(buildings))
+            polygons = [_building(rng, tile_size) for _ in range(count)]
+            # annotations only keep the part of the buildings inside of the tile
+            polygons = [np.clip(p, 0, tile_size - 1) for p in polygons]
+            polygons = [p for p in polygons if np.ptp(p[:, 0]) > 1 and np.ptp(p[:, 1]) > 1]
+
+            path = os.path.join(folder, f"RGB-PanSharpen_{img}.tif")
+            _write_geotiff(path, _tile(rng, tile_size, polygons, dtype), geotransform)
+            stats["tiles"] += 1
+            stats["bytes"] += os.path.getsize(path)
+            if index >= tiles:
+                continue
+
+            stats["buildings"] += len(polygons)
+            geo = [np.column_stack([lon + index * tile_size * PIXEL_SIZE + p[:, 0] * PIXEL_SIZE,
+                                    lat - p[:, 1] * PIXEL_SIZE]) for p in polygons]
+            if normalize:
+                if not polygons:
+                    rows.append([img, -1, "POLYGON EMPTY", "POLYGON EMPTY"])
+                for building_id, (p, g) in enumerate(zip(polygons, geo), start=1):
+                    rows.append([img, building_id, _wkt(np.round(p, 2)), _wkt(g)])
+            else:
+                os.makedirs(f"{train}/geojson", exist_ok=True)
+                features = [{"type": "Feature",
+                             "properties": {"building_id": i},
+                             "geometry": {"type": "Polygon",
+                                          "coordinates": [np.concatenate([g, g[:1]]).tolist()]}}
+                            for i, g in enumerate(geo)]
+                with open(f"{train}/geojson/Geo_{img}.geojson", "w") as f:
+                    json.dump({"type": "FeatureCollection", "features": features}, f)
+
+        if normalize:
+            os.makedirs(f"{train}/summaryData", exist_ok=True)
+            with open(f"{train}/summaryData/AOI_{aoi}_Train_Building_Solutions.csv", "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["ImageId", "BuildingId", "PolygonWKT_Pix", "PolygonWKT_Geo"])
+                writer.writerows(rows)
+
+    return stats
@@ -0,0 +1,360 @@
+"""
+Benchmarks of the stages of the pipeline on synthetic SpaceNet fixtures.
+
+    python benchmarks/run.py --output benchmark.json
+    python benchmarks/run.py --compare benchmark.json
+
+Fixtures are generated by :mod:`fixtures` in a work directory, then each stage is timed a few
+times on them. Results are written as JSON, and compared with a previous run with --compare,
+which exits with status 1 if a stage got slower than the threshold.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# the repository root, for the pipeline scripts and utils/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.fixtures import make_fixtures  # noqa: E402
+from convert_tif import AOIS as CONVERT_AOIS  # noqa: E402
+from create_jsons import AOIS as CSV_AOIS, rio_geojson_path, rio_train  # noqa: E402
+from utils.dataset import get_dataset_dicts, release_dataset_dicts  # noqa: E402
+from utils.functions import (  # noqa: E402
+    detectron_json,
+    detectron_json_stream,
+    geojson_json,
+    grab_certain_file,
+    merge_region_jsons,
+    tif_to_png,
+)
+
+# Bumped whenever the stages change, results of different versions are not compared
+BENCHMARK_VERSION = 1
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic SpaceNet fixtures")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run")
+    parser.add_argument("--tiles", type=int, default=8, help="Training tiles of each AOI")
+    parser.add_argument("--tile-size", type=int, default=650, help="Width and height of the tiles")
+    parser.add_argument("--buildings", type=int, default=30, help="Average number of buildings of a tile")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fixtures and of the model weights")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each stage, the median is reported")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes of the stages that have some")
+    parser.add_argument("--threads", type=int, help="torch threads of the inference stages")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per batch of the inference_batch stage")
+    parser.add_argument(
+        "--workdir",
+        help="Folder of the fixtures, kept and reused by later runs with the same parameters "
+        "(default: a temporary folder removed at the end)",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of a previous run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="A stage whose throughput dropped by more than this fraction of the baseline is a regression",
+    )
+    return parser
+
+
+# Stages, each a pair of functions taking the run arguments and a dict shared by the stages.
+# The first prepares the inputs of the stage and is not timed, the second is timed and returns the
+# number of items it processed. Every stage runs in the work directory, like the scripts in the root.
+
+def _tiles(folder):
+    return grab_certain_file(".tif", folder)
+
+
+def _convert(args, state):
+    count = 0
+    for name, train_folder, test_folder, normalize in CONVERT_AOIS:
+        files = _tiles(train_folder)
+        tif_to_png(files, train_folder, "Spacenet/train", normalize=normalize, workers=args.workers)
+        count += len(files)
+    state["converted"] = True
+    return count
+
+
+def _csv_jsons(args, state):
+    count = 0
+    for num_dataset, train_folder, csv_path in CSV_AOIS:
+        files = _tiles(train_folder)
+        detectron_json(files, train_folder, pd.read_csv(csv_path), num_dataset, "train")
+        count += len(files)
+    return count
+
+
+def _csv_jsons_stream(args, state):
+    count = 0
+    for num_dataset, train_folder, csv_path in CSV_AOIS:
+        files = _tiles(train_folder)
+        detectron_json_stream({"train": files}, train_folder, csv_path, num_dataset)
+        count += len(files)
+    return count
+
+
+def _geojson_jsons(args, state):
+    files = _tiles(rio_train)
+    geojson_json(files, rio_train, [rio_geojson_path(file) for file in files], "1_Rio", "train", workers=args.workers)
+    return len(files)
+
+
+def _prepare_outputs(args, state):
+    os.makedirs("Spacenet/train", exist_ok=True)
+    if "converted" not in state:
+        _convert(args, state)
+    if "region_jsons" not in state:
+        _geojson_jsons(args, state)
+        _csv_jsons(args, state)
+        merge_region_jsons([f"Spacenet/train/AOI_{aoi}_region_data.json"
+                            for aoi in ("1_Rio", "2_Vegas", "3_Paris", "4_Shanghai", "5_Khartoum")],
+                           "Spacenet/train/via_region_data.json")
+        state["region_jsons"] = True
+
+
+def _prepare_split(args, state):
+    os.makedirs("Spacenet/train", exist_ok=True)
+
+
+def _dataset_dicts(args, state):
+    return len(get_dataset_dicts("Spacenet/train", use_cache=False))
+
+
+def _prepare_dataset_dicts_cached(args, state):
+    _prepare_outputs(args, state)
+    get_dataset_dicts("Spacenet/train")
+
+
+def _dataset_dicts_cached(args, state):
+    # only the cache on disk, not the records this process already loaded
+    release_dataset_dicts()
+    return len(get_dataset_dicts("Spacenet/train"))
+
+
+def tiny_mask_rcnn_config(tile_size=650):
+    """
+    A Mask R-CNN small enough to benchmark on CPU: ResNet-18 FPN with narrow heads and random weights.
+    Every score is kept, so that the mask head runs on as many boxes as a trained model would give.
+    """
+    from detectron2 import model_zoo
+    from detectron2.config import get_cfg
+
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_1x.yaml"))
+    cfg.MODEL.WEIGHTS = ""
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.MODEL.RESNETS.DEPTH = 18
+    cfg.MODEL.RESNETS.RES2_OUT_CHANNELS = 64
+    cfg.MODEL.FPN.OUT_CHANNELS = 64
+    cfg.MODEL.RPN.POST_NMS_TOPK_TEST = 300
+    cfg.MODEL.ROI_BOX_HEAD.FC_DIM = 256
+    cfg.MODEL.ROI_MASK_HEAD.CONV_DIM = 64
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.0
+    cfg.TEST.DETECTIONS_PER_IMAGE = 100
+    cfg.INPUT.MIN_SIZE_TEST = tile_size
+    cfg.INPUT.MAX_SIZE_TEST = tile_size
+    cfg.freeze()
+    return cfg
+
+
+def _prepare_inference(args, state):
+    import cv2
+    import torch
+    from detectron2.engine import DefaultPredictor
+
+    _prepare_outputs(args, state)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if "predictor" not in state:
+        torch.manual_seed(args.seed)
+        state["predictor"] = DefaultPredictor(tiny_mask_rcnn_config(args.tile_size))
+        files = sorted(name for name in os.listdir("Spacenet/train") if name.endswith(".png"))
+        state["images"] = [cv2.imread(os.path.join("Spacenet/train", name)) for name in files]
+        # the first call allocates the buffers of the model
+        state["predictor"](state["images"][0])
+
+
+def _inference(args, state):
+    for image in state["images"]:
+        state["predictor"](image)
+    return len(state["images"])
+
+
+def _prepare_inference_batch(args, state):
+    _prepare_inference(args, state)
+    if "batch_predictor" not in state:
+        sys.path.insert(0, os.path.join(ROOT, "inference"))
+        from predictor import BatchPredictor
+
+        # the same weights as the single image predictor
+        state["batch_predictor"] = BatchPredictor(state["predictor"].cfg)
+        state["batch_predictor"].model.load_state_dict(state["predictor"].model.state_dict())
+        state["batch_predictor"].predict_batch(state["images"][:args.batch_size])
+
+
+def _inference_batch(args, state):
+    images = state["images"]
+    for start in range(0, len(images), args.batch_size):
+        state["batch_predictor"].predict_batch(images[start:start + args.batch_size])
+    return len(images)
+
+
+STAGES = {
+    "tif_to_png": (_prepare_split, _convert),
+    "detectron_json": (_prepare_split, _csv_jsons),
+    "detectron_json_stream": (_prepare_split, _csv_jsons_stream),
+    "geojson_json": (_prepare_split, _geojson_jsons),
+    "get_dataset_dicts": (_prepare_outputs, _dataset_dicts),
+    "get_dataset_dicts_cached": (_prepare_dataset_dicts_cached, _dataset_dicts_cached),
+    "inference": (_prepare_inference, _inference),
+    "inference_batch": (_prepare_inference_batch, _inference_batch),
+}
+
+
+def _peak_rss_mb():
+    # kilobytes on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024
+
+
+def run_stage(name, args, state):
+    """
+    Returns:
+        dict: the items processed, the seconds of every run, their median and minimum, and the
+        throughput in items per second of the median run.
+    """
+    prepare, run = STAGES[name]
+    prepare(args, state)
+    seconds = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        items = run(args, state)
+        seconds.append(time.perf_counter() - start)
+    median = float(np.median(seconds))
+    return {"items": items,
+            "seconds": seconds,
+            "median": median,
+            "min": min(seconds),
+            "items_per_second": items / median if median > 0 else None,
+            "peak_rss_mb": _peak_rss_mb()
+           }
+
+
+def _environment():
+    environment = {"python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "processor": platform.processor(),
+                   "cpu_count": os.cpu_count()}
+    try:
+        environment["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        environment["commit"] = None
+    try:
+        import torch
+        environment["torch"] = torch.__version__
+        environment["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return environment
+
+
+def _prepare_fixtures(workdir, parameters):
+    """Generates the fixtures in `workdir`, unless it already has those of the same parameters."""
+    marker = os.path.join(workdir, "fixtures.json")
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f)["parameters"] == parameters:
+                print(f"Reusing the fixtures of {workdir}")
+                return
+    shutil.rmtree(os.path.join(workdir, "Spacenet"), ignore_errors=True)
+    start = time.perf_counter()
+    stats = make_fixtures(workdir, **parameters)
+    print(f"Generated {stats['tiles']} tiles and {stats['buildings']} buildings in {time.perf_counter() - start:.1f}s")
+    with open(marker, "w") as f:
+        json.dump({"parameters": parameters, "stats": stats}, f)
+
+
+def compare(results, baseline, threshold=0.10):
+    """
+    Compares the throughput of every stage with the baseline.
+
+    Returns:
+        list[str]: the stages that regressed.
+    """
+    if baseline.get("version") != results["version"]:
+        print(f"The baseline was written by version {baseline.get('version')} of the benchmarks, "
+              f"not {results['version']}, its stages may not be comparable")
+    if baseline.get("parameters", {}).get("fixtures") != results["parameters"]["fixtures"]:
+        print("The baseline was run on other fixtures, only the throughputs are comparable")
+
+    regressions = []
+    print(f"{'stage':<26}{'baseline/s':>12}{'current/s':>12}{'change':>10}")
+    for name, stage in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None or not base.get("items_per_second") or not stage["items_per_second"]:
+            print(f"{name:<26}{'-':>12}{stage['items_per_second'] or 0:>12.2f}{'new':>10}")
+            continue
+        change = stage["items_per_second"] / base["items_per_second"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<26}{base['items_per_second']:>12.2f}{stage['items_per_second']:>12.2f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(args):
+    parameters = {"tiles": args.tiles, "tile_size": args.tile_size, "buildings": args.buildings, "seed": args.seed}
+    workdir = args.workdir or tempfile.mkdtemp(prefix="spacenet_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    results = {"version": BENCHMARK_VERSION,
+               "date": str(datetime.datetime.now()),
+               "environment": _environment(),
+               "parameters": {"fixtures": parameters, "repeat": args.repeat, "workers": args.workers,
+                              "threads": args.threads, "batch_size": args.batch_size},
+               "stages": {}}
+    try:
+        _prepare_fixtures(workdir, parameters)
+        os.chdir(workdir)
+        state = {}
+        for name in args.stages:
+            results["stages"][name] = stage = run_stage(name, args, state)
+            print(f"{name}: {stage['median']:.3f}s for {stage['items']} items, "
+                  f"{stage['items_per_second'] or 0:.2f} items/s")
+    finally:
+        os.chdir(cwd)
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(get_parser().parse_args()))
@@ -1,93 +1,160 @@
 import os
-import json
-import geojson
+import argparse
 import numpy as np
-import pandas as pd
 
-from osgeo import gdal
 from sklearn.model_selection import train_test_split
 
 # custom functions
-from utils.functions import grab_certain_file, tif_to_png
+from utils.functions import band_statistics, grab_certain_file, tif_to_png
+from utils.manifest import BuildManifest
+from utils.metrics import add_metrics_arguments, metrics
+from utils.tilestore import write_tile_store
+from utils.writers import image_extension
 
 
 RANDOM_SEED = 560
 
-# Path to all images
-rio_train = "Spacenet/AOI_1_Rio_Train/RGB-PanSharpen"
-rio_test = "Spacenet/AOI_1_Rio_Test_public/RGB-PanSharpen"
-
-vegas_train = "Spacenet/AOI_2_Vegas_Train/RGB-PanSharpen"
-vegas_test = "Spacenet/AOI_2_Vegas_Test_public/RGB-PanSharpen"
-
-paris_train = "Spacenet/AOI_3_Paris_Train/RGB-PanSharpen"
-paris_test = "Spacenet/AOI_3_Paris_Test_public/RGB-PanSharpen"
-
-shanghai_train = "Spacenet/AOI_4_Shanghai_Train/RGB-PanSharpen"
-shanghai_test = "Spacenet/AOI_4_Shanghai_Test_public/RGB-PanSharpen"
-
-khartoum_train = "Spacenet/AOI_5_Khartoum_Train/RGB-PanSharpen"
-khartoum_test = "Spacenet/AOI_5_Khartoum_Test_public/RGB-PanSharpen"
-
-
-
-# Convert TIFF to PNG
-# Rio de Janeiro
-rio_images = grab_certain_file(".tif", rio_train)
-train, val = train_test_split(rio_images, test_size=0.2, random_state=RANDOM_SEED)
-test = grab_certain_file(".tif", rio_test)
-
-tif_to_png(train, rio_train, "Spacenet/train")
-print("Done converting Rio/train images")
-tif_to_png(val, rio_train, "Spacenet/val")
-print("Done converting Rio/val images")
-tif_to_png(test, rio_test, "Spacenet/test")
-print("Done converting Rio/test images")
-
-# Vegas
-vegas_images = grab_certain_file(".tif", vegas_train)
-train, val = train_test_split(vegas_images, test_size=0.2, random_state=RANDOM_SEED)
-test = grab_certain_file(".tif", vegas_test)
-
-tif_to_png(train, vegas_train, "Spacenet/train", normalize=True)
-print("Done converting Vegas/train images")
-tif_to_png(val, vegas_train, "Spacenet/val", normalize=True)
-print("Done converting Vegas/val images")
-tif_to_png(test, vegas_test, "Spacenet/test", normalize=True)
-print("Done converting Vegas/test images")
-
-# Paris
-paris_images = grab_certain_file(".tif", paris_train)
-train, val = train_test_split(paris_images, test_size=0.2, random_state=RANDOM_SEED)
-test = grab_certain_file(".tif", paris_test)
-
-tif_to_png(train, paris_train, "Spacenet/train", normalize=True)
-print("Done converting Paris/train images")
-tif_to_png(val, paris_train, "Spacenet/val", normalize=True)
-print("Done converting Paris/val images")
-tif_to_png(test, paris_test, "Spacenet/test", normalize=True)
-print("Done converting Paris/test images")
-
-# Shanghai
-shanghai_images = grab_certain_file(".tif", shanghai_train)
-train, val = train_test_split(shanghai_images, test_size=0.2, random_state=RANDOM_SEED)
-test = grab_certain_file(".tif", shanghai_test)
-
-tif_to_png(train, shanghai_train, "Spacenet/train", normalize=True)
-print("Done converting Shanghai/train images")
-tif_to_png(val, shanghai_train, "Spacenet/val", normalize=True)
-print("Done converting Shanghai/val images")
-tif_to_png(test, shanghai_test, "Spacenet/test", normalize=True)
-print("Done converting Shanghai/test images")
-
-# Khartoum
-khartoum_images = grab_certain_file(".tif", khartoum_train)
-train, val = train_test_split(khartoum_images, test_size=0.2, random_state=RANDOM_SEED)
-test = grab_certain_file(".tif", khartoum_test)
-
-tif_to_png(train, khartoum_train, "Spacenet/train", normalize=True)
-print("Done converting Khartoum/train images")
-tif_to_png(val, khartoum_train, "Spacenet/val", normalize=True)
-print("Done converting Khartoum/val images")
-tif_to_png(test, khartoum_test, "Spacenet/test", normalize=True)
-print("Done converting Khartoum/test images")
+# Path to all images, and whether the AOI must be normalized
+# (name, train folder, test folder, normalize)
+AOIS = [
+    ("Rio", "Spacenet/AOI_1_Rio_Train/RGB-PanSharpen", "Spacenet/AOI_1_Rio_Test_public/RGB-PanSharpen", False),
+    ("Vegas", "Spacenet/AOI_2_Vegas_Train/RGB-PanSharpen", "Spacenet/AOI_2_Vegas_Test_public/RGB-PanSharpen", True),
+    ("Paris", "Spacenet/AOI_3_Paris_Train/RGB-PanSharpen", "Spacenet/AOI_3_Paris_Test_public/RGB-PanSharpen", True),
+    ("Shanghai", "Spacenet/AOI_4_Shanghai_Train/RGB-PanSharpen", "Spacenet/AOI_4_Shanghai_Test_public/RGB-PanSharpen", True),
+    ("Khartoum", "Spacenet/AOI_5_Khartoum_Train/RGB-PanSharpen", "Spacenet/AOI_5_Khartoum_Test_public/RGB-PanSharpen", True),
+]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Convert the SpaceNet TIFF images to PNG (or WebP/npy)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used to convert the tiles (default: all cores)",
+    )
+    parser.add_argument(
+        "--stretch",
+        choices=["tile", "aoi"],
+        default="tile",
+        help="Stretch each normalized tile by its own band range, or every tile of an AOI by the range of the whole AOI",
+    )
+    parser.add_argument(
+        "--percentiles",
+        nargs=2,
+        type=float,
+        metavar=("LOW", "HIGH"),
+        help="With --stretch aoi, stretch between these percentiles of the AOI instead of its minimum and maximum",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["png", "webp", "npy"],
+        default="png",
+        help="Output format: png, lossless webp, or raw npy arrays which are the fastest to decode",
+    )
+    parser.add_argument(
+        "--compression",
+        type=int,
+        default=1,
+        help="PNG compression level from 0 (fastest) to 9 (smallest)",
+    )
+    parser.add_argument(
+        "--tile-store",
+        action="store_true",
+        help="Also pack the train and val tiles into a memory-mapped tile store in Spacenet/<split>/tiles, "
+        "read by train_net.py with SPACENET.TILE_STORE True",
+    )
+    parser.add_argument(
+        "--manifest",
+        default="Spacenet/convert_manifest.json",
+        help="Build manifest, a rerun only converts the tiles that are new or changed since",
+    )
+    parser.add_argument("--hash", action="store_true", help="Also compare the content of the sources, not only their size and mtime")
+    parser.add_argument("--force", action="store_true", help="Convert every tile, even those that are up to date")
+    add_metrics_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.metrics or args.prometheus_port:
+        metrics.open(args.metrics, args.prometheus_port, script="convert_tif")
+    manifest = BuildManifest(args.manifest, hash_files=args.hash)
+    extension = image_extension(args.format)
+    failed = {}
+
+    # Convert TIFF to PNG
+    for name, train_folder, test_folder, normalize in AOIS:
+        images = grab_certain_file(".tif", train_folder)
+        train, val = train_test_split(images, test_size=0.2, random_state=RANDOM_SEED)
+        test = grab_certain_file(".tif", test_folder)
+
+        stats = None
+        if normalize and args.stretch == "aoi":
+            key = f"stats:{train_folder}"
+            sources = [os.path.join(train_folder, item) for item in images]
+            stats_params = {"percentiles": args.percentiles}
+            if not args.force and manifest.is_current(key, sources, stats_params):
+                stats = tuple(np.asarray(values) for values in manifest.data(key))
+            else:
+                with metrics.stage(f"statistics/{name}", items=len(images)):
+                    stats = band_statistics(images, train_folder, percentiles=args.percentiles, workers=args.workers)
+                manifest.record(key, sources, [], stats_params, data=[values.tolist() for values in stats])
+
+        params = {"normalize": normalize,
+                  "stats": None if stats is None else [values.tolist() for values in stats],
+                  "format": args.format,
+                  "compression": args.compression}
+
+        for split, files, folder in [("train", train, train_folder),
+                                     ("val", val, train_folder),
+                                     ("test", test, test_folder)]:
+            dst = f"Spacenet/{split}"
+
+            # only the new or changed tiles, and those whose output is missing
+            todo = [item for item in files
+                    if args.force or not manifest.is_current(os.path.join(dst, item.replace(".tif", extension)),
+                                                             [os.path.join(folder, item)], params)]
+
+            def record(item, error, dst=dst, folder=folder):
+                if error is None:
+                    output = os.path.join(dst, item.replace(".tif", extension))
+                    manifest.record(output, [os.path.join(folder, item)], [output], params)
+                    metrics.increment("tiles_converted")
+                    metrics.increment("bytes_read", os.path.getsize(os.path.join(folder, item)))
+                    metrics.increment("bytes_written", os.path.getsize(output))
+                else:
+                    metrics.increment("tiles_failed")
+
+            with metrics.stage(f"convert/{name}/{split}", items=len(todo)):
+                results = tif_to_png(todo, folder, dst, normalize=normalize, stats=stats, workers=args.workers,
+                                     fmt=args.format, compression=args.compression, callback=record)
+            manifest.save()
+            failed.update({os.path.join(folder, k): v for k, v in results.items() if v is not None})
+            print(f"Done converting {name}/{split} images ({len(files) - len(todo)} already up to date)")
+
+            if args.tile_store and split != "test":
+                shard = os.path.basename(os.path.dirname(train_folder)).replace("_Train", "")
+                store = f"{dst}/tiles"
+                key = os.path.join(store, f"{shard}.u8")
+                sources = [os.path.join(folder, item) for item in files]
+                if not args.force and manifest.is_current(key, sources, params):
+                    print(f"{name}/{split} tile store already up to date")
+                    continue
+                with metrics.stage(f"tile_store/{name}/{split}", items=len(files)):
+                    results = write_tile_store(files, folder, store, shard, normalize=normalize,
+                                               stats=stats, workers=args.workers)
+                failed.update({os.path.join(folder, k): v for k, v in results.items() if v is not None})
+                if all(error is None for error in results.values()):
+                    manifest.record(key, sources, [key, os.path.join(store, f"{shard}.json")], params)
+                manifest.save()
+                print(f"Done packing {name}/{split} images")
+
+    manifest.save()
+    if failed:
+        print(f"{len(failed)} images could not be converted:")
+        for path, error in failed.items():
+            print(f"  {path}: {error}")
+    if metrics.enabled:
+        print(metrics.report())
+        metrics.close()
@@ -1,214 +1,215 @@
 import os
-import json
-import geojson
+import argparse
 import pandas as pd
-from tqdm import tqdm
-from osgeo import gdal
 from sklearn.model_selection import train_test_split
 
 # custom functions
-from utils.functions import grab_certain_file, detectron_json
+from utils.functions import grab_certain_file, detectron_json, detectron_json_stream, geojson_json, merge_region_jsons
+from utils.annotations import annotation_table_current, write_annotation_table
+from utils.polygons import simplify_region_json
+from utils.masks import add_region_rles
+from utils.coco import region_json_to_coco
+from utils.manifest import BuildManifest
+from utils.metrics import add_metrics_arguments, metrics
 
 
 
 RANDOM_SEED = 560
 
+# Bumped whenever the content of the region JSON files changes, so that older files are rebuilt
+# 2: width and height of the images in their file attributes
+JSON_VERSION = 2
+
 rio_train = "Spacenet/AOI_1_Rio_Train/RGB-PanSharpen"
 rio_geojson = "Spacenet/AOI_1_Rio_Train/geojson"
-vegas_train = "Spacenet/AOI_2_Vegas_Train/RGB-PanSharpen"
-paris_train = "Spacenet/AOI_3_Paris_Train/RGB-PanSharpen"
-shanghai_train = "Spacenet/AOI_4_Shanghai_Train/RGB-PanSharpen"
-khartoum_train = "Spacenet/AOI_5_Khartoum_Train/RGB-PanSharpen"
-
-
 
-# Create JSONs for Detectron2
-# Rio de Janeiro
-# Special case, so no function
-rio_images = grab_certain_file(".tif", rio_train)
-train, val = train_test_split(rio_images, test_size=0.2, random_state=RANDOM_SEED)
-train_dict = {}
-
-# Training set
-for file in tqdm(train, desc="Creating JSONs for Detectron2 on 1_Rio_train", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}"):
-    file_path = os.path.join(rio_train, file)
+# (number and name, train folder, Building_Solutions csv)
+AOIS = [
+    ("2_Vegas", "Spacenet/AOI_2_Vegas_Train/RGB-PanSharpen",
+     "Spacenet/AOI_2_Vegas_Train/summaryData/AOI_2_Vegas_Train_Building_Solutions.csv"),
+    ("3_Paris", "Spacenet/AOI_3_Paris_Train/RGB-PanSharpen",
+     "Spacenet/AOI_3_Paris_Train/summaryData/AOI_3_Paris_Train_Building_Solutions.csv"),
+    ("4_Shanghai", "Spacenet/AOI_4_Shanghai_Train/RGB-PanSharpen",
+     "Spacenet/AOI_4_Shanghai_Train/summaryData/AOI_4_Shanghai_Train_Building_Solutions.csv"),
+    ("5_Khartoum", "Spacenet/AOI_5_Khartoum_Train/RGB-PanSharpen",
+     "Spacenet/AOI_5_Khartoum_Train/summaryData/AOI_5_Khartoum_Train_Building_Solutions.csv"),
+]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Create the Detectron2 JSON files of the SpaceNet dataset")
+    parser.add_argument(
+        "--manifest",
+        default="Spacenet/jsons_manifest.json",
+        help="Build manifest, a rerun only rebuilds the JSON files whose sources changed since",
+    )
+    parser.add_argument("--hash", action="store_true", help="Also compare the content of the sources, not only their size and mtime")
+    parser.add_argument("--force", action="store_true", help="Rebuild every JSON file, even those that are up to date")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used to parse the geojson files (default: all cores)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Stream the Building_Solutions csv files this many rows at a time instead of loading them whole, "
+        "which keeps memory flat for large csv files",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also write the annotations into a columnar store in Spacenet/<split>/annotations (needs pyarrow), "
+        "which get_dataset_dicts loads instead of via_region_data.json",
+    )
+    parser.add_argument(
+        "--simplify",
+        type=float,
+        metavar="TOL",
+        help="Clean the polygons: keep their exterior ring, remove duplicate and collinear vertices, clip them to "
+        "their tile, simplify them with this Douglas-Peucker tolerance in pixels (0 only removes redundant "
+        "vertices) and drop those without area",
+    )
+    parser.add_argument(
+        "--rle",
+        action="store_true",
+        help="Also store the mask of every polygon as compressed RLE (needs pycocotools), so that training with "
+        "SPACENET.MASK_CACHE does not rasterize them",
+    )
+    add_metrics_arguments(parser)
+    return parser
+
+
+def rio_geojson_path(file):
     img_id = file.split(".tif")[0]
     img_id = img_id.split("img")[1]
-    geojson_path = os.path.join(rio_geojson, f"Geo_AOI_1_RIO_img{img_id}.geojson")
-    
-    with open(geojson_path) as f:
-        gj = geojson.load(f)
-    
-    regions = {}
-    num_buildings = len(gj["features"])
-    if num_buildings > 0:
-        gdal_image = gdal.Open(file_path)
-        pixel_width, pixel_height = gdal_image.GetGeoTransform()[1], gdal_image.GetGeoTransform()[5]
-        originX, originY = gdal_image.GetGeoTransform()[0], gdal_image.GetGeoTransform()[3]
-        
-        for i in range(num_buildings):
-            points = gj["features"][i]["geometry"]["coordinates"][0]
-            if len(points) == 1:
-                points = points[0]
-            
-            all_points_x, all_points_y = [], []
-            for j in range(len(points)):
-                all_points_x.append(int(round((points[j][0] - originX) / pixel_width)))
-                all_points_y.append(int(round((points[j][1] - originY) / pixel_height)))
-            
-            regions[str(i)] = {"shape_attributes":
-                                   {"name": "polygon",
-                                    "all_points_x": all_points_x,
-                                    "all_points_y": all_points_y,
-                                    "category": 0
-                                   },
-                               "region_attributes": {}
-                              }
-    
-    dictionary = {"file_ref": '',
-                  "size": os.path.getsize(file_path),
-                  "filename": file.replace(".tif", ".png"),
-                  "base64_img_data": '',
-                  "file_attributes": {},
-                  "regions": regions
-                 }
-    
-    train_dict[file.replace(".tif", ".png")] = dictionary
-    
-with open("Spacenet/train/AOI_1_Rio_region_data.json", "w") as f:
-    json.dump(train_dict, f)
-
-
-# Validation set
-val_dict = {}
-
-for file in tqdm(val, desc="Creating JSONs for Detectron2 on 1_Rio_val", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}"):
-    file_path = os.path.join(rio_train, file)
-    img_id = file.split(".tif")[0]
-    img_id = img_id.split("img")[1]
-    geojson_path = os.path.join(rio_geojson, f"Geo_AOI_1_RIO_img{img_id}.geojson")
-    
-    with open(geojson_path) as f:
-        gj = geojson.load(f)
-    
-    regions = {}
-    num_buildings = len(gj["features"])
-    if num_buildings > 0:
-        gdal_image = gdal.Open(file_path)
-        pixel_width, pixel_height = gdal_image.GetGeoTransform()[1], gdal_image.GetGeoTransform()[5]
-        originX, originY = gdal_image.GetGeoTransform()[0], gdal_image.GetGeoTransform()[3]
-        
-        for i in range(num_buildings):
-            points = gj["features"][i]["geometry"]["coordinates"][0]
-            if len(points) == 1:
-                points = points[0]
-            
-            all_points_x, all_points_y = [], []
-            for j in range(len(points)):
-                all_points_x.append(int(round((points[j][0] - originX) / pixel_width)))
-                all_points_y.append(int(round((points[j][1] - originY) / pixel_height)))
-            
-            regions[str(i)] = {"shape_attributes":
-                                   {"name": "polygon",
-                                    "all_points_x": all_points_x,
-                                    "all_points_y": all_points_y,
-                                    "category": 0
-                                   },
-                               "region_attributes": {}
-                              }
-    
-    dictionary = {"file_ref": '',
-                  "size": os.path.getsize(file_path),
-                  "filename": file.replace(".tif", ".png"),
-                  "base64_img_data": '',
-                  "file_attributes": {},
-                  "regions": regions
-                 }
-    
-    val_dict[file.replace(".tif", ".png")] = dictionary
-
-with open("Spacenet/val/AOI_1_Rio_region_data.json", "w") as f:
-    json.dump(val_dict, f)
-
-
-
-# Vegas
-vegas_images = grab_certain_file(".tif", vegas_train)
-train, val = train_test_split(vegas_images, test_size=0.2, random_state=RANDOM_SEED)
-df = pd.read_csv("Spacenet/AOI_2_Vegas_Train/summaryData/AOI_2_Vegas_Train_Building_Solutions.csv")
-
-detectron_json(train, vegas_train, df, "2_Vegas", "train")
-detectron_json(val, vegas_train, df, "2_Vegas", "val")
-
-
-
-# Paris
-paris_images = grab_certain_file(".tif", paris_train)
-train, val = train_test_split(paris_images, test_size=0.2, random_state=RANDOM_SEED)
-df = pd.read_csv("Spacenet/AOI_3_Paris_Train/summaryData/AOI_3_Paris_Train_Building_Solutions.csv")
-
-detectron_json(train, paris_train, df, "3_Paris", "train")
-detectron_json(val, paris_train, df, "3_Paris", "val")
-
-
-
-# Shanghai
-shanghai_images = grab_certain_file(".tif", shanghai_train)
-train, val = train_test_split(shanghai_images, test_size=0.2, random_state=RANDOM_SEED)
-df = pd.read_csv("Spacenet/AOI_4_Shanghai_Train/summaryData/AOI_4_Shanghai_Train_Building_Solutions.csv")
-
-detectron_json(train, shanghai_train, df, "4_Shanghai", "train")
-detectron_json(val, shanghai_train, df, "4_Shanghai", "val")
-
-
-
-# Khartoum
-khartoum_images = grab_certain_file(".tif", khartoum_train)
-train, val = train_test_split(khartoum_images, test_size=0.2, random_state=RANDOM_SEED)
-df = pd.read_csv("Spacenet/AOI_5_Khartoum_Train/summaryData/AOI_5_Khartoum_Train_Building_Solutions.csv")
-
-detectron_json(train, khartoum_train, df, "5_Khartoum", "train")
-detectron_json(val, khartoum_train, df, "5_Khartoum", "val")
-
-
-
-
-# Create JSON for entire training dataset
-jsons = ["Spacenet/train/AOI_1_Rio_region_data.json",
-         "Spacenet/train/AOI_2_Vegas_region_data.json",
-         "Spacenet/train/AOI_3_Paris_region_data.json",
-         "Spacenet/train/AOI_4_Shanghai_region_data.json",
-         "Spacenet/train/AOI_5_Khartoum_region_data.json"
-        ]
-
-result = {}
-for file in jsons:
-    with open(file, "r") as f:
-        loaded = json.load(f)
-    for key, value in loaded.items():
-        result[key] = value
-
-with open("Spacenet/train/via_region_data.json", "w") as file:
-    json.dump(result, file)
-
-
-
-# Create JSON for entire validation dataset
-jsons = ["Spacenet/val/AOI_1_Rio_region_data.json",
-         "Spacenet/val/AOI_2_Vegas_region_data.json",
-         "Spacenet/val/AOI_3_Paris_region_data.json",
-         "Spacenet/val/AOI_4_Shanghai_region_data.json",
-         "Spacenet/val/AOI_5_Khartoum_region_data.json"
-        ]
-
-result = {}
-for file in jsons:
-    with open(file, "r") as f:
-        loaded = json.load(f)
-    for key, value in loaded.items():
-        result[key] = value
-
-with open("Spacenet/val/via_region_data.json", "w") as file:
-    json.dump(result, file)
-
-print("Done creating JSONs")
\ No newline at end of file
+    return os.path.join(rio_geojson, f"Geo_AOI_1_RIO_img{img_id}.geojson")
+
+
+def post_process(dst, args):
+    if args.simplify is not None:
+        with metrics.stage(f"simplify/{os.path.basename(dst)}"):
+            before, after, dropped = simplify_region_json(dst, args.simplify)
+        reduction = 100 * (1 - after / before) if before else 0
+        print(f"{dst}: {before} -> {after} vertices ({reduction:.1f}% fewer), {dropped} invalid polygons dropped")
+    if args.rle:
+        with metrics.stage(f"rle/{os.path.basename(dst)}"):
+            add_region_rles(dst)
+    metrics.increment("bytes_written", os.path.getsize(dst))
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.metrics or args.prometheus_port:
+        metrics.open(args.metrics, args.prometheus_port, script="create_jsons")
+    manifest = BuildManifest(args.manifest, hash_files=args.hash)
+    params = {"version": JSON_VERSION}
+    exterior_only = args.simplify is not None
+    if exterior_only:
+        params["simplify"] = args.simplify
+    if args.rle:
+        params["rle"] = True
+
+    # Create JSONs for Detectron2
+    # Rio de Janeiro
+    # Special case, one geojson file per image instead of a csv
+    rio_images = grab_certain_file(".tif", rio_train)
+    train, val = train_test_split(rio_images, test_size=0.2, random_state=RANDOM_SEED)
+
+    for train_val, files in [("train", train), ("val", val)]:
+        dst = f"Spacenet/{train_val}/AOI_1_Rio_region_data.json"
+        sources = [os.path.join(rio_train, file) for file in files] + [rio_geojson_path(file) for file in files]
+        if not args.force and manifest.is_current(dst, sources, params):
+            print(f"{dst} is already up to date")
+            continue
+
+        with metrics.stage(f"json/1_Rio/{train_val}", items=len(files)):
+            geojson_json(files, rio_train, [rio_geojson_path(file) for file in files], "1_Rio", train_val, workers=args.workers)
+        metrics.increment("bytes_read", sum(os.path.getsize(rio_geojson_path(file)) for file in files))
+        post_process(dst, args)
+        manifest.record(dst, sources, [dst], params)
+        manifest.save()
+
+
+
+    # Vegas, Paris, Shanghai and Khartoum
+    for num_dataset, train_folder, csv_path in AOIS:
+        images = grab_certain_file(".tif", train_folder)
+        train, val = train_test_split(images, test_size=0.2, random_state=RANDOM_SEED)
+        stale = {}
+        for train_val, files in [("train", train), ("val", val)]:
+            dst = f"Spacenet/{train_val}/AOI_{num_dataset}_region_data.json"
+            sources = [csv_path] + [os.path.join(train_folder, file) for file in files]
+            if not args.force and manifest.is_current(dst, sources, params):
+                print(f"{dst} is already up to date")
+            else:
+                stale[train_val] = files
+
+        if not stale:
+            continue
+        metrics.increment("bytes_read", os.path.getsize(csv_path))
+        if args.chunksize:
+            with metrics.stage(f"json/{num_dataset}/{'_'.join(stale)}", items=sum(map(len, stale.values()))):
+                detectron_json_stream(stale, train_folder, csv_path, num_dataset, chunksize=args.chunksize,
+                                      exterior_only=exterior_only)
+        else:
+            with metrics.stage(f"read_csv/{num_dataset}"):
+                df = pd.read_csv(csv_path)
+            for train_val, files in stale.items():
+                with metrics.stage(f"json/{num_dataset}/{train_val}", items=len(files)):
+                    detectron_json(files, train_folder, df, num_dataset, train_val, exterior_only=exterior_only)
+
+        for train_val, files in stale.items():
+            dst = f"Spacenet/{train_val}/AOI_{num_dataset}_region_data.json"
+            post_process(dst, args)
+            manifest.record(dst, [csv_path] + [os.path.join(train_folder, file) for file in files], [dst], params)
+        manifest.save()
+
+
+
+    # Create JSON for entire training and validation datasets
+    for train_val in ["train", "val"]:
+        jsons = [f"Spacenet/{train_val}/AOI_1_Rio_region_data.json",
+                 f"Spacenet/{train_val}/AOI_2_Vegas_region_data.json",
+                 f"Spacenet/{train_val}/AOI_3_Paris_region_data.json",
+                 f"Spacenet/{train_val}/AOI_4_Shanghai_region_data.json",
+                 f"Spacenet/{train_val}/AOI_5_Khartoum_region_data.json"
+                ]
+        dst = f"Spacenet/{train_val}/via_region_data.json"
+        if not args.force and manifest.is_current(dst, jsons):
+            print(f"{dst} is already up to date")
+        else:
+            with metrics.stage(f"merge/{train_val}"):
+                merge_region_jsons(jsons, dst)
+            manifest.record(dst, jsons, [dst])
+            manifest.save()
+
+        # COCO instances file, loaded by the evaluator instead of converting the dataset at every evaluation
+        coco = f"Spacenet/{train_val}/coco_instances.json"
+        if not args.force and manifest.is_current(coco, [dst]):
+            print(f"{coco} is already up to date")
+        else:
+            with metrics.stage(f"coco/{train_val}") as stage:
+                stage["items"], _ = region_json_to_coco(dst, coco)
+            manifest.record(coco, [dst], [coco])
+            manifest.save()
+
+        # Columnar store, one parquet file per AOI so that merging is only adding files
+        if args.parquet:
+            for json_path in jsons:
+                aoi = os.path.basename(json_path).replace("_region_data.json", "")
+                table = f"Spacenet/{train_val}/annotations/{aoi}.parquet"
+                # tables written before their source was recorded are ignored by get_dataset_dicts
+                if (not args.force and manifest.is_current(table, [json_path])
+                        and annotation_table_current(table, f"Spacenet/{train_val}")):
+                    continue
+                with metrics.stage(f"parquet/{aoi}/{train_val}"):
+                    write_annotation_table(json_path, f"Spacenet/{train_val}/annotations", aoi, train_val)
+                manifest.record(table, [json_path], [table])
+            manifest.save()
+
+    print("Done creating JSONs")
+    if metrics.enabled:
+        print(metrics.report())
+        metrics.close()
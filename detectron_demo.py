@@ -2,74 +2,35 @@
 # https://github.com/rl02898/detectron2-spacenet
 # Imports
 import os
-import json
 import yaml
 import torch
 import random
-import cv2 as cv
 import detectron2
-import numpy as np
 
 from detectron2 import model_zoo
 from detectron2.config import get_cfg
-from detectron2.structures import BoxMode
 from detectron2.engine import DefaultTrainer
 from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import ColorMode
 from detectron2.utils.visualizer import Visualizer
-from detectron2.data import MetadataCatalog, DatasetCatalog
+from detectron2.data import build_detection_train_loader
 
+from utils.dataset import register_spacenet_datasets
+from utils.mapper import SpacenetDatasetMapper
 
-# Dataset registration function
-def get_dataset_dicts(img_dir):
-    json_file = os.path.join(img_dir, "via_region_data.json")
-    with open(json_file) as f:
-        imgs_anns = json.load(f)
-    
-    dataset_dicts = []
-    for idx, annots in enumerate(imgs_anns.values()):
-        record = {}
-        
-        filename = os.path.join(img_dir, annots["filename"])
-        height, width = cv.imread(filename).shape[:2]
-        
-        record["file_name"] = filename
-        record["image_id"] = idx
-        record["height"] = height
-        record["width"] = width
-      
-        annotations = annots["regions"]
-        objs = []
-        for _, anno in annotations.items():
-            assert not anno["region_attributes"]
-            anno = anno["shape_attributes"]
-            px = anno["all_points_x"]
-            py = anno["all_points_y"]
-            poly = [(x + 0.5, y + 0.5) for x, y in zip(px, py)]
-            poly = [p for x in poly for p in x]
-            obj = {"bbox": [np.min(px),
-                            np.min(py),
-                            np.max(px),
-                            np.max(py)
-                           ],
-                   "bbox_mode": BoxMode.XYXY_ABS,
-                   "segmentation": [poly],
-                   "category_id": anno["category"]
-                  }
-            objs.append(obj)
-        record["annotations"] = objs
-        dataset_dicts.append(record)
-    return dataset_dicts
+
+# Trainer that reads png, webp or npy images
+class Trainer(DefaultTrainer):
+    @classmethod
+    def build_train_loader(cls, cfg):
+        return build_detection_train_loader(cfg, mapper=SpacenetDatasetMapper(cfg, True))
 
 
 # Register your dataset
 classes = ["building"]
 colors = [(249, 180, 45)]
 
-for d in ["train", "val"]:
-    DatasetCatalog.register(d, lambda d=d: get_dataset_dicts(os.path.join("Spacenet", d)))
-    MetadataCatalog.get(d).thing_classes = classes
-    MetadataCatalog.get(d).thing_colors = colors
+register_spacenet_datasets("Spacenet", ["train", "val"], thing_colors=colors)
 
 
 # Create configurations
@@ -92,7 +53,7 @@ with open("Spacenet/SpacenetD2cfg.yaml", "w") as file:
 
 # Train your model
 os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
-trainer = DefaultTrainer(cfg)
+trainer = Trainer(cfg)
 trainer.resume_or_load(resume=False)
 trainer.train()
 
@@ -1,23 +1,34 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 import argparse
 import glob
+import itertools
 import multiprocessing as mp
 from turtle import colormode
 import numpy as np
 import os
+import sys
 import tempfile
 import time
 import warnings
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import tqdm
+from PIL import Image
 
 from detectron2.config import get_cfg
-from detectron2.data.detection_utils import read_image
+from detectron2.data.detection_utils import read_image as read_pil_image
 from detectron2.utils.logger import setup_logger
 from detectron2.utils.visualizer import ColorMode
 
 from predictor import VisualizationDemo
 
+# the repository root, for the dataset helpers in utils/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.metrics import add_metrics_arguments, metrics  # noqa: E402
+from utils.writers import IMAGE_FORMATS, read_image  # noqa: E402
+
 # constants
 WINDOW_NAME = "COCO detections"
 
@@ -54,6 +65,76 @@ def get_parser():
         help="A list of space separated input images; "
         "or a single glob pattern such as 'directory/*.jpg'",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of --input images the model is run on at once",
+    )
+    parser.add_argument(
+        "--export",
+        choices=["geojson", "geojsonl", "csv"],
+        help="Skip the visualizations and write the outlines of the predicted buildings of every --input "
+        "image to the args.output file, as GeoJSON, GeoJSON lines or a SpaceNet PolygonWKT_Pix csv",
+    )
+    parser.add_argument(
+        "--geo-dir",
+        help="Folder of the source GeoTIFFs of the --input tiles, with the same names, "
+        "to export lon/lat coordinates instead of pixels",
+    )
+    parser.add_argument(
+        "--export-tolerance",
+        type=float,
+        default=0.0,
+        help="Douglas-Peucker tolerance in pixels of the exported outlines",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=8,
+        help="Number of --input images decoded ahead of the model, and of outputs waiting to be saved",
+    )
+    parser.add_argument(
+        "--io-workers",
+        type=int,
+        default=4,
+        help="Number of threads decoding the --input images, and of threads rendering and saving the outputs",
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Run the model in separate processes, one per GPU or --cpu-workers on CPU",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        default=1,
+        help="Number of predictor processes of --parallel on CPU, each pinned to its own cores",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        help="Intra-op threads of each CPU worker (default: the number of cores it is pinned to)",
+    )
+    parser.add_argument(
+        "--scene",
+        nargs="+",
+        help="A list of space separated full-scene GeoTIFFs, predicted window by window; "
+        "or a single glob pattern such as 'directory/*.tif'",
+    )
+    parser.add_argument("--tile-size", type=int, default=650, help="Size of the windows of --scene")
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        default=128,
+        help="Overlap of the windows of --scene, larger than the biggest building",
+    )
+    parser.add_argument(
+        "--nms-threshold",
+        type=float,
+        default=0.5,
+        help="Mask IoU above which detections of overlapping windows are merged",
+    )
     parser.add_argument(
         "--output",
         help="A file or directory to save output visualizations. "
@@ -72,9 +153,74 @@ def get_parser():
         default=[],
         nargs=argparse.REMAINDER,
     )
+    add_metrics_arguments(parser)
     return parser
 
 
+def iter_input_paths(inputs):
+    """
+    Yields the paths of the input images: several paths as they are, the images of a directory
+    that detectron2 or the tile readers can read, or the matches of a single glob pattern, both
+    sorted like the outputs they give.
+    """
+    if len(inputs) > 1:
+        yield from inputs
+        return
+    path = os.path.expanduser(inputs[0])
+    if os.path.isdir(path):
+        extensions = tuple(ext for ext, _, _ in IMAGE_FORMATS.values()) + tuple(Image.registered_extensions())
+        with os.scandir(path) as entries:
+            paths = sorted(entry.path for entry in entries
+                           if entry.name.lower().endswith(extensions) and entry.is_file())
+    else:
+        paths = sorted(glob.iglob(path))
+    assert paths, "The input path(s) was not found"
+    yield from paths
+
+
+def prefetch_images(paths, executor, ahead):
+    """
+    Yields (path, image) in the order of `paths`, with up to `ahead` images being read by the
+    threads of `executor` in the meantime.
+    """
+    pending = deque()
+    for path in paths:
+        pending.append((path, executor.submit(timed_read, path)))
+        if len(pending) > ahead:
+            path, future = pending.popleft()
+            yield path, future.result()
+    while pending:
+        path, future = pending.popleft()
+        yield path, future.result()
+
+
+def read_input_image(path):
+    """
+    Reads the png, webp or npy tiles the dataset can be written in with their own readers, and any
+    other image with PIL, to be consistent with evaluation.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if any(extension == ext for ext, _, _ in IMAGE_FORMATS.values()):
+        return read_image(path, format="BGR")
+    return read_pil_image(path, format="BGR")
+
+
+def timed_read(path):
+    with metrics.stage("read", items=1, emit=False):
+        image = read_input_image(path)
+    metrics.increment("bytes_read", os.path.getsize(path))
+    return image
+
+
+def timed_write(write, *args):
+    with metrics.stage("write", items=1, emit=False):
+        write(*args)
+
+
+def save_visualization(demo, img, predictions, out_filename):
+    demo.draw(img, predictions).save(out_filename)
+
+
 def test_opencv_video_format(codec, file_ext):
     with tempfile.TemporaryDirectory(prefix="video_format_test") as dir:
         filename = os.path.join(dir, "test_file" + file_ext)
@@ -98,43 +244,126 @@ if __name__ == "__main__":
     setup_logger(name="fvcore")
     logger = setup_logger()
     logger.info("Arguments: " + str(args))
+    if args.metrics or args.prometheus_port:
+        metrics.open(args.metrics, args.prometheus_port, script="demo")
 
     cfg = setup_cfg(args)
 
-    demo = VisualizationDemo(cfg)
+    demo = VisualizationDemo(
+        cfg,
+        parallel=args.parallel,
+        batch_size=args.batch_size,
+        num_cpu_workers=args.cpu_workers,
+        threads_per_worker=args.threads_per_worker,
+    )
 
     if args.input:
-        if len(args.input) == 1:
-            args.input = glob.glob(os.path.expanduser(args.input[0]))
-            assert args.input, "The input path(s) was not found"
-        for path in tqdm.tqdm(args.input, disable=not args.output):
-            # use PIL, to be consistent with evaluation
-            img = read_image(path, format="BGR")
+        exporter = None
+        if args.export:
+            # needs only the polygons, not the visualizations
+            from export import build_exporter
+
+            assert args.output, "Please specify the file to export to with args.output"
+            exporter = build_exporter(args.export, args.output, args.geo_dir, args.export_tolerance)
+
+        input_paths = iter_input_paths(args.input)
+        if args.output and exporter is None and not os.path.isdir(args.output):
+            # checked before any prediction, so that no output is overwritten
+            input_paths = list(input_paths)
+            assert len(input_paths) == 1, "Please specify a directory with args.output"
+
+        # decode ahead -> model -> render and save, each stage bounded by --prefetch
+        readers = ThreadPoolExecutor(max_workers=args.io_workers)
+        writers = ThreadPoolExecutor(max_workers=args.io_workers) if args.output else None
+        images = prefetch_images(input_paths, readers, args.prefetch)
+        # parallel workers are kept busy with as many images as they buffer
+        chunk = demo.predictor.default_buffer_size if args.parallel else args.batch_size
+        progress = tqdm.tqdm(disable=not args.output)
+        saving = deque()
+        stop = False
+        while not stop:
+            # time the model waits for the readers
+            with metrics.stage("read_wait", emit=False):
+                batch = list(itertools.islice(images, chunk))
+            if not batch:
+                break
+            paths, imgs = zip(*batch)
             start_time = time.time()
-            predictions, visualized_output = demo.run_on_image(img)
-            logger.info(
-                "{}: {} in {:.2f}s".format(
-                    path,
-                    "detected {} instances".format(len(predictions["instances"]))
-                    if "instances" in predictions
-                    else "finished",
-                    time.time() - start_time,
+            outputs = demo.predict(list(imgs))
+            metrics.add_time("predict", time.time() - start_time, len(paths))
+            elapsed = (time.time() - start_time) / len(paths)
+            for path, img, predictions in zip(paths, imgs, outputs):
+                if "instances" in predictions:
+                    metrics.increment("instances", len(predictions["instances"]))
+                logger.info(
+                    "{}: {} in {:.2f}s".format(
+                        path,
+                        "detected {} instances".format(len(predictions["instances"]))
+                        if "instances" in predictions
+                        else "finished",
+                        elapsed,
+                    )
                 )
-            )
 
-            if args.output:
-                if os.path.isdir(args.output):
-                    assert os.path.isdir(args.output), args.output
-                    out_filename = os.path.join(args.output, os.path.basename(path))
+                if exporter is not None:
+                    saving.append(writers.submit(timed_write, exporter.write, path, predictions))
+                    while len(saving) > args.prefetch:
+                        saving.popleft().result()
+                elif args.output:
+                    if os.path.isdir(args.output):
+                        assert os.path.isdir(args.output), args.output
+                        out_filename = os.path.join(args.output, os.path.basename(path))
+                    else:
+                        out_filename = args.output
+                    saving.append(writers.submit(timed_write, save_visualization, demo, img, predictions, out_filename))
+                    while len(saving) > args.prefetch:
+                        saving.popleft().result()
                 else:
-                    assert len(args.input) == 1, "Please specify a directory with args.output"
-                    out_filename = args.output
-                visualized_output.save(out_filename)
-            else:
-                cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
-                cv2.imshow(WINDOW_NAME, visualized_output.get_image()[:, :, ::-1])
-                if cv2.waitKey(0) == 27:
-                    break  # esc to quit
+                    cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+                    cv2.imshow(WINDOW_NAME, demo.draw(img, predictions).get_image()[:, :, ::-1])
+                    if cv2.waitKey(0) == 27:
+                        stop = True
+                        break  # esc to quit
+                progress.update()
+        for future in saving:
+            future.result()
+        progress.close()
+        readers.shutdown(cancel_futures=True)
+        if writers is not None:
+            writers.shutdown()
+        if exporter is not None:
+            exporter.close()
+            logger.info("Exported {} buildings to {}".format(exporter.count, args.output))
+    elif args.scene:
+        # needs GDAL, only imported for scenes
+        from scene import detection_records, predict_scene
+
+        assert args.output, "Please specify a directory with args.output for the detections of --scene"
+        os.makedirs(args.output, exist_ok=True)
+        if len(args.scene) == 1:
+            args.scene = glob.glob(os.path.expanduser(args.scene[0]))
+            assert args.scene, "The scene path(s) was not found"
+        for path in args.scene:
+            start_time = time.time()
+            progress = tqdm.tqdm(desc=os.path.basename(path), unit="window")
+            with metrics.stage("scene/" + os.path.basename(path)) as stage:
+                detections, geotransform = predict_scene(
+                    demo.predictor,
+                    path,
+                    tile_size=args.tile_size,
+                    overlap=args.overlap,
+                    iou_threshold=args.nms_threshold,
+                    callback=lambda window: progress.update(),
+                )
+                stage["items"] = progress.n
+            progress.close()
+            metrics.increment("instances", len(detections))
+            logger.info(
+                "{}: detected {} instances in {:.2f}s".format(path, len(detections), time.time() - start_time)
+            )
+            out_filename = os.path.join(args.output, os.path.splitext(os.path.basename(path))[0] + ".json")
+            with open(out_filename, "w") as f:
+                json.dump({"scene": path, "geotransform": geotransform, "detections": detection_records(detections)}, f)
     elif args.webcam:
         assert args.input is None, "Cannot have both --input and --webcam!"
         assert args.output is None, "output not yet supported with --webcam!"
@@ -188,3 +417,7 @@ if __name__ == "__main__":
             output_file.release()
         else:
             cv2.destroyAllWindows()
+
+    if metrics.enabled:
+        logger.info("Metrics:\n" + metrics.report())
+        metrics.close()
@@ -0,0 +1,180 @@
+"""
+Headless export of the predicted buildings as polygons, without rendering them.
+
+The outlines of the predicted masks are extracted with OpenCV, mapped to the reference
+system of the source GeoTIFF of each tile when it is known, and streamed to a GeoJSON,
+GeoJSONL or SpaceNet-style csv file as the images are predicted.
+"""
+import csv
+import json
+import os
+import threading
+import numpy as np
+import torch
+
+from utils.polygons import mask_polygons, pixel_to_geo
+
+
+EXPORT_FORMATS = ("geojson", "geojsonl", "csv")
+
+
+def image_id(path):
+    """SpaceNet ImageId of a tile, Ex: "AOI_2_Vegas_img123" for ".../RGB-PanSharpen_AOI_2_Vegas_img123.png"."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem[stem.index("AOI_"):] if "AOI_" in stem else stem
+
+
+def instance_polygons(predictions, tolerance=0.0):
+    """
+    Args:
+        predictions (dict): the output of the model for one image.
+        tolerance (float): Douglas-Peucker tolerance in pixels of the outlines.
+
+    Returns:
+        list[tuple]: (polygon, score) of each predicted building, the polygon as an int array of
+        shape (N, 2) of pixel coordinates. A mask split in several parts gives several polygons.
+    """
+    if "instances" not in predictions:
+        return []
+    instances = predictions["instances"].to(torch.device("cpu"))
+    if not instances.has("pred_masks") or len(instances) == 0:
+        return []
+    masks = instances.pred_masks.numpy()
+    scores = instances.scores.numpy()
+    boxes = instances.pred_boxes.tensor.numpy()
+    height, width = masks.shape[1:]
+
+    results = []
+    for mask, score, box in zip(masks, scores, boxes):
+        # contours are only looked for around the building, one pixel wider than its box
+        x0, y0 = np.maximum(np.floor(box[:2]).astype(int) - 1, 0)
+        x1, y1 = np.minimum(np.ceil(box[2:]).astype(int) + 1, (width, height))
+        crop = mask[y0:y1, x0:x1]
+        if not crop.any():
+            crop, x0, y0 = mask, 0, 0
+        for polygon in mask_polygons(crop, offset=(x0, y0), tolerance=tolerance):
+            results.append((polygon, float(score)))
+    return results
+
+
+class _StreamingExporter:
+    """
+    Writes the polygons of each image to `path` as soon as they are given. :meth:`write` may be
+    called from several threads, the polygons are extracted concurrently and written one image
+    at a time.
+    """
+
+    def __init__(self, path, geo_dir=None, tolerance=0.0):
+        """
+        Args:
+            path (str): the output file.
+            geo_dir (str): folder of the source GeoTIFFs, named like the tiles with a ".tif"
+                extension. Without it, coordinates stay in pixels.
+            tolerance (float): Douglas-Peucker tolerance in pixels of the outlines.
+        """
+        self.geo_dir = geo_dir
+        self.tolerance = tolerance
+        self.file = open(path, "w", newline="")
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def geotransform(self, path):
+        if self.geo_dir is None:
+            return None
+        # only needed with --geo-dir
+        from osgeo import gdal
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        dataset = gdal.Open(os.path.join(self.geo_dir, stem + ".tif"))
+        return dataset.GetGeoTransform() if dataset is not None else None
+
+    def write(self, path, predictions):
+        polygons = instance_polygons(predictions, self.tolerance)
+        geotransform = self.geotransform(path)
+        with self.lock:
+            self._write(path, polygons, geotransform)
+
+    def _write(self, path, polygons, geotransform):
+        raise NotImplementedError
+
+    def close(self):
+        self.file.close()
+
+
+class GeoJSONExporter(_StreamingExporter):
+    """One feature per building, with the image, score and pixel polygon in its properties."""
+
+    def __init__(self, path, geo_dir=None, tolerance=0.0, lines=False):
+        super().__init__(path, geo_dir, tolerance)
+        self.lines = lines
+        if not lines:
+            self.file.write('{"type": "FeatureCollection", "features": [\n')
+
+    def _write(self, path, polygons, geotransform):
+        for polygon, score in polygons:
+            ring = pixel_to_geo(polygon, geotransform) if geotransform is not None else polygon
+            # GeoJSON rings are closed
+            ring = np.concatenate([ring, ring[:1]]).tolist()
+            feature = {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {"ImageId": image_id(path), "Confidence": score},
+            }
+            if not self.lines and self.count:
+                self.file.write(",\n")
+            self.file.write(json.dumps(feature))
+            if self.lines:
+                self.file.write("\n")
+            self.count += 1
+
+    def close(self):
+        if not self.lines:
+            self.file.write("\n]}\n")
+        super().close()
+
+
+class CSVExporter(_StreamingExporter):
+    """SpaceNet solution csv: ImageId, BuildingId, PolygonWKT_Pix, Confidence, with geo coordinates added when known."""
+
+    def __init__(self, path, geo_dir=None, tolerance=0.0):
+        super().__init__(path, geo_dir, tolerance)
+        self.writer = csv.writer(self.file)
+        header = ["ImageId", "BuildingId", "PolygonWKT_Pix", "Confidence"]
+        if geo_dir is not None:
+            header.append("PolygonWKT_Geo")
+        self.writer.writerow(header)
+
+    @staticmethod
+    def _wkt(ring):
+        ring = np.concatenate([ring, ring[:1]])
+        return "POLYGON ((" + ",".join(f"{x} {y} 0" for x, y in ring.tolist()) + "))"
+
+    def _write(self, path, polygons, geotransform):
+        img_id = image_id(path)
+        if not polygons:
+            row = [img_id, -1, "POLYGON EMPTY", 1]
+            self.writer.writerow(row + ["POLYGON EMPTY"] if self.geo_dir is not None else row)
+        # buildings are numbered from 1, like in the SpaceNet solution csv files
+        for building_id, (polygon, score) in enumerate(polygons, 1):
+            row = [img_id, building_id, self._wkt(polygon), score]
+            if self.geo_dir is not None:
+                row.append(self._wkt(pixel_to_geo(polygon, geotransform)) if geotransform is not None else "")
+            self.writer.writerow(row)
+            self.count += 1
+
+
+def build_exporter(fmt, path, geo_dir=None, tolerance=0.0):
+    """
+    Args:
+        fmt (str): one of :data:`EXPORT_FORMATS`.
+        path, geo_dir, tolerance: see :class:`_StreamingExporter`.
+
+    Returns:
+        the exporter, whose `write(image_path, predictions)` is called for every image and
+        `close()` once at the end.
+    """
+    if fmt == "csv":
+        return CSVExporter(path, geo_dir, tolerance)
+    if fmt in ("geojson", "geojsonl"):
+        return GeoJSONExporter(path, geo_dir, tolerance, lines=fmt == "geojsonl")
+    raise ValueError(f"Unknown export format {fmt}, expected one of {EXPORT_FORMATS}")
@@ -1,25 +1,37 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 import atexit
-import bisect
+import heapq
 import multiprocessing as mp
+import os
+import queue
+import time
 from collections import deque
+from multiprocessing import shared_memory
 import cv2
+import numpy as np
 import torch
 
+from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.data import MetadataCatalog
+from detectron2.data import transforms as T
 from detectron2.engine.defaults import DefaultPredictor
+from detectron2.modeling import build_model
 from detectron2.utils.video_visualizer import VideoVisualizer
 from detectron2.utils.visualizer import ColorMode, Visualizer
 
 
 class VisualizationDemo(object):
-    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
+    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False, batch_size=1,
+                 num_cpu_workers=1, threads_per_worker=None):
         """
         Args:
             cfg (CfgNode):
             instance_mode (ColorMode):
             parallel (bool): whether to run the model in different processes from visualization.
                 Useful since the visualization logic can be slow.
+            batch_size (int): number of images :meth:`run_on_images` runs the model on at once.
+            num_cpu_workers, threads_per_worker (int): see :class:`AsyncPredictor`, used when
+                `parallel` and no GPU is available.
         """
         self.metadata = MetadataCatalog.get(
             cfg.DATASETS.TEST[0] if len(cfg.DATASETS.TEST) else "__unused"
@@ -28,9 +40,17 @@ class VisualizationDemo(object):
         self.instance_mode = instance_mode
 
         self.parallel = parallel
+        self.batch_size = batch_size
         if parallel:
             num_gpu = torch.cuda.device_count()
-            self.predictor = AsyncPredictor(cfg, num_gpus=num_gpu)
+            self.predictor = AsyncPredictor(
+                cfg,
+                num_gpus=num_gpu,
+                num_cpu_workers=num_cpu_workers,
+                threads_per_worker=threads_per_worker,
+            )
+        elif batch_size > 1:
+            self.predictor = BatchPredictor(cfg)
         else:
             self.predictor = DefaultPredictor(cfg)
 
@@ -44,8 +64,65 @@ class VisualizationDemo(object):
             predictions (dict): the output of the model.
             vis_output (VisImage): the visualized image output.
         """
-        vis_output = None
         predictions = self.predictor(image)
+        return predictions, self.draw(image, predictions)
+
+    def run_on_images(self, images):
+        """
+        Like :meth:`run_on_image` for a list of images, see :meth:`predict`.
+
+        Args:
+            images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list[tuple]: the predictions and the visualized image output of each image.
+        """
+        return [(predictions, self.draw(image, predictions))
+                for image, predictions in zip(images, self.predict(images))]
+
+    def predict(self, images):
+        """
+        Runs the model on a list of images, `batch_size` images at once when the demo was built
+        with a batch size, or keeping every worker busy when it is parallel. Visualization is
+        left to :meth:`draw`, so that it can run somewhere else.
+
+        Args:
+            images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list[dict]: the output of the model for each image.
+        """
+        if self.parallel:
+            outputs = []
+            in_flight = 0
+            for image in images:
+                self.predictor.put(image)
+                in_flight += 1
+                if in_flight > self.predictor.default_buffer_size:
+                    outputs.append(self.predictor.get())
+                    in_flight -= 1
+            for _ in range(in_flight):
+                outputs.append(self.predictor.get())
+            return outputs
+
+        if not isinstance(self.predictor, BatchPredictor):
+            return [self.predictor(image) for image in images]
+
+        outputs = []
+        for start in range(0, len(images), self.batch_size):
+            outputs.extend(self.predictor.predict_batch(images[start:start + self.batch_size]))
+        return outputs
+
+    def draw(self, image, predictions):
+        """
+        Args:
+            image (np.ndarray): the image of shape (H, W, C) (in BGR order) the predictions are of.
+            predictions (dict): the output of the model.
+
+        Returns:
+            vis_output (VisImage): the visualized image output.
+        """
+        vis_output = None
         # Convert image from OpenCV BGR format to Matplotlib RGB format.
         image = image[:, :, ::-1]
         visualizer = Visualizer(image, self.metadata, instance_mode=ColorMode.SEGMENTATION)
@@ -63,7 +140,7 @@ class VisualizationDemo(object):
                 instances = predictions["instances"].to(self.cpu_device)
                 vis_output = visualizer.draw_instance_predictions(predictions=instances)
 
-        return predictions, vis_output
+        return vis_output
 
     def _frame_from_video(self, video):
         while video.isOpened():
@@ -129,80 +206,282 @@ class VisualizationDemo(object):
                 yield process_predictions(frame, self.predictor(frame))
 
 
+class BatchPredictor:
+    """
+    Like :class:`DefaultPredictor`, except that :meth:`predict_batch` preprocesses a list of
+    images and runs the model once on all of them, which saves the overhead of one forward per
+    image. The outputs are the same as those of :class:`DefaultPredictor` for each image.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg.clone()  # cfg can be modified by model
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        if len(cfg.DATASETS.TEST):
+            self.metadata = MetadataCatalog.get(cfg.DATASETS.TEST[0])
+
+        checkpointer = DetectionCheckpointer(self.model)
+        checkpointer.load(cfg.MODEL.WEIGHTS)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+    def _preprocess(self, original_image):
+        # the same preprocessing as DefaultPredictor
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def predict_batch(self, original_images):
+        """
+        Args:
+            original_images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list[dict]: the output of the model for each image.
+        """
+        with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
+            return self.model([self._preprocess(image) for image in original_images])
+
+    def __call__(self, original_image):
+        """
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+        Returns:
+            predictions (dict): the output of the model for one image only.
+        """
+        return self.predict_batch([original_image])[0]
+
+
+class _SharedSlots:
+    """
+    A block of shared memory cut into fixed-size slots. The process that creates it hands the
+    slots out, the others attach to it by name and only read or write the slots they are given.
+    """
+
+    def __init__(self, num_slots, slot_size, name=None):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(num_slots * slot_size, 1))
+        else:
+            # workers share the resource tracker of the process that created the block,
+            # which unlinks it only once they have all exited
+            self.shm = shared_memory.SharedMemory(name=name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def view(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=slot * self.slot_size)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
 class AsyncPredictor:
     """
     A predictor that runs the model asynchronously, possibly on >1 GPUs.
     Because rendering the visualization takes considerably amount of time,
     this helps improve throughput a little bit when rendering videos.
+
+    Frames and predicted masks go through shared memory, only their descriptors are pickled
+    through the queues. Frames that do not fit or find no free slot are pickled as before.
     """
 
     class _StopToken:
         pass
 
     class _PredictWorker(mp.Process):
-        def __init__(self, cfg, task_queue, result_queue):
+        def __init__(self, cfg, task_queue, result_queue, cores=None, num_threads=None,
+                     result_slots=None, free_result_slots=None):
             self.cfg = cfg
             self.task_queue = task_queue
             self.result_queue = result_queue
+            self.cores = cores
+            self.num_threads = num_threads
+            # (name, number of slots, slot size) of the result masks block
+            self.result_slots = result_slots
+            self.free_result_slots = free_result_slots
             super().__init__()
 
+        def _read_frame(self, data, frames):
+            if not isinstance(data, tuple):
+                return data
+            name, num_slots, slot_size, slot, shape, dtype = data
+            if frames.get(name) is None:
+                frames[name] = _SharedSlots(num_slots, slot_size, name)
+            # the slot is not reused before the result of this frame is back
+            return frames[name].view(slot, shape, dtype)
+
+        def _write_masks(self, result, masks_block):
+            """Moves the masks of the result into a free slot, returns its descriptor or None."""
+            if masks_block is None or "instances" not in result:
+                return None
+            instances = result["instances"].to(torch.device("cpu"))
+            if not instances.has("pred_masks"):
+                return None
+            masks = instances.pred_masks.numpy()
+            packed = np.packbits(masks, axis=None)
+            if packed.nbytes > masks_block.slot_size:
+                return None
+            try:
+                slot = self.free_result_slots.get_nowait()
+            except queue.Empty:
+                return None
+            masks_block.view(slot, packed.shape, packed.dtype)[:] = packed
+            instances.remove("pred_masks")
+            result["instances"] = instances
+            return slot, masks.shape
+
         def run(self):
+            if self.cores:
+                os.sched_setaffinity(0, self.cores)
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
             predictor = DefaultPredictor(self.cfg)
+            frames = {}
+            masks_block = _SharedSlots(*self.result_slots[1:], name=self.result_slots[0]) if self.result_slots else None
 
             while True:
                 task = self.task_queue.get()
                 if isinstance(task, AsyncPredictor._StopToken):
                     break
                 idx, data = task
-                result = predictor(data)
-                self.result_queue.put((idx, result))
+                result = predictor(self._read_frame(data, frames))
+                self.result_queue.put((idx, result, self._write_masks(result, masks_block)))
 
-    def __init__(self, cfg, num_gpus: int = 1):
+            for block in frames.values():
+                block.close()
+            if masks_block is not None:
+                masks_block.close()
+
+    def __init__(self, cfg, num_gpus: int = 1, num_cpu_workers: int = 1, threads_per_worker: int = None,
+                 result_slot_size: int = 8 << 20):
         """
         Args:
             cfg (CfgNode):
             num_gpus (int): if 0, will run on CPU
+            num_cpu_workers (int): number of processes when running on CPU. The cores this
+                process may run on are split into as many disjoint sets, and each worker is
+                pinned to its own.
+            threads_per_worker (int): intra-op threads of each CPU worker, defaults to the
+                number of cores it is pinned to. Fewer workers with more threads lower the
+                latency of each image, more workers with fewer threads raise the throughput.
+            result_slot_size (int): bytes of shared memory for the bit-packed masks of one
+                result. Results with more masks are pickled.
         """
-        num_workers = max(num_gpus, 1)
+        num_workers = num_gpus if num_gpus > 0 else max(num_cpu_workers, 1)
         self.task_queue = mp.Queue(maxsize=num_workers * 3)
         self.result_queue = mp.Queue(maxsize=num_workers * 3)
+
+        core_sets = [None] * num_workers
+        if num_gpus == 0 and num_workers > 1 and hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+            # contiguous blocks, so that a worker stays on neighbouring cores
+            bounds = [len(cores) * i // num_workers for i in range(num_workers + 1)]
+            core_sets = [set(cores[bounds[i]:bounds[i + 1]]) for i in range(num_workers)]
+
+        # one slot per result in the queue and per worker
+        self.masks_block = _SharedSlots(num_workers * 4, result_slot_size)
+        self.free_result_slots = mp.Queue()
+        for slot in range(self.masks_block.num_slots):
+            self.free_result_slots.put(slot)
+        result_slots = (self.masks_block.name, self.masks_block.num_slots, self.masks_block.slot_size)
+
         self.procs = []
-        for gpuid in range(max(num_gpus, 1)):
+        for workerid in range(num_workers):
             cfg = cfg.clone()
             cfg.defrost()
-            cfg.MODEL.DEVICE = "cuda:{}".format(gpuid) if num_gpus > 0 else "cpu"
+            cfg.MODEL.DEVICE = "cuda:{}".format(workerid) if num_gpus > 0 else "cpu"
+            num_threads = None
+            if num_gpus == 0:
+                num_threads = threads_per_worker or (len(core_sets[workerid]) if core_sets[workerid] else None)
             self.procs.append(
-                AsyncPredictor._PredictWorker(cfg, self.task_queue, self.result_queue)
+                AsyncPredictor._PredictWorker(
+                    cfg,
+                    self.task_queue,
+                    self.result_queue,
+                    core_sets[workerid],
+                    num_threads,
+                    result_slots,
+                    self.free_result_slots,
+                )
             )
 
         self.put_idx = 0
         self.get_idx = 0
-        self.result_rank = []
-        self.result_data = []
+        # reorder buffer, a heap of (idx, result)
+        self.results = []
+        # frames block, created for the size of the first frame
+        self.frames_block = None
+        self.free_frame_slots = []
+        self.frame_slot_of = {}
 
         for p in self.procs:
             p.start()
         atexit.register(self.shutdown)
 
+    def _frame_payload(self, idx, image):
+        if self.frames_block is None:
+            # every frame in flight has its slot, see default_buffer_size
+            self.frames_block = _SharedSlots(self.default_buffer_size + 1, image.nbytes)
+            self.free_frame_slots = list(range(self.frames_block.num_slots))
+        if image.nbytes > self.frames_block.slot_size or not self.free_frame_slots:
+            return image
+        slot = self.free_frame_slots.pop()
+        self.frames_block.view(slot, image.shape, image.dtype)[...] = image
+        self.frame_slot_of[idx] = slot
+        block = self.frames_block
+        return block.name, block.num_slots, block.slot_size, slot, image.shape, image.dtype.str
+
+    def _receive(self):
+        idx, res, masks = self.result_queue.get()
+        slot = self.frame_slot_of.pop(idx, None)
+        if slot is not None:
+            self.free_frame_slots.append(slot)
+        if masks is not None:
+            slot, shape = masks
+            count = int(np.prod(shape))
+            packed = self.masks_block.view(slot, ((count + 7) // 8,), np.uint8)
+            # copied out, the slot goes back to the workers
+            pred_masks = np.unpackbits(packed, count=count).reshape(shape).astype(bool)
+            self.free_result_slots.put(slot)
+            res["instances"].pred_masks = torch.from_numpy(pred_masks)
+        return idx, res
+
+    def _drain(self):
+        while True:
+            try:
+                _, _, masks = self.result_queue.get_nowait()
+            except queue.Empty:
+                return
+            if masks is not None:
+                self.free_result_slots.put(masks[0])
+
     def put(self, image):
         self.put_idx += 1
-        self.task_queue.put((self.put_idx, image))
+        self.task_queue.put((self.put_idx, self._frame_payload(self.put_idx, image)))
 
     def get(self):
         self.get_idx += 1  # the index needed for this request
-        if len(self.result_rank) and self.result_rank[0] == self.get_idx:
-            res = self.result_data[0]
-            del self.result_data[0], self.result_rank[0]
-            return res
-
-        while True:
+        while not len(self.results) or self.results[0][0] != self.get_idx:
             # make sure the results are returned in the correct order
-            idx, res = self.result_queue.get()
-            if idx == self.get_idx:
-                return res
-            insert = bisect.bisect(self.result_rank, idx)
-            self.result_rank.insert(insert, idx)
-            self.result_data.insert(insert, res)
+            heapq.heappush(self.results, self._receive())
+        return heapq.heappop(self.results)[1]
 
     def __len__(self):
         return self.put_idx - self.get_idx
@@ -211,9 +490,39 @@ class AsyncPredictor:
         self.put(image)
         return self.get()
 
-    def shutdown(self):
-        for _ in self.procs:
-            self.task_queue.put(AsyncPredictor._StopToken())
+    def shutdown(self, timeout: float = 30.0):
+        """
+        Stops the workers, the results still in flight are dropped.
+
+        Args:
+            timeout (float): seconds the workers have to finish their current image, those
+                still alive afterwards are terminated.
+        """
+        if self.masks_block is None:
+            return
+        deadline = time.monotonic() + timeout
+        stops = len(self.procs)
+        # a worker blocked on a full result queue never reads its stop token, nor exits before
+        # its last result is read, so the results are drained until every worker is gone
+        alive = list(self.procs)
+        while alive and time.monotonic() < deadline:
+            while stops:
+                try:
+                    self.task_queue.put_nowait(AsyncPredictor._StopToken())
+                except queue.Full:
+                    break
+                stops -= 1
+            self._drain()
+            alive[0].join(0.1)
+            alive = [p for p in alive if p.is_alive()]
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        for block in (self.frames_block, self.masks_block):
+            if block is not None:
+                block.close()
+        self.frames_block = self.masks_block = None
 
     @property
     def default_buffer_size(self):
@@ -0,0 +1,217 @@
+"""
+Sliding-window inference over full-scene GeoTIFFs.
+
+The scene is never read whole: windows of a fixed size are read one at a time through GDAL,
+so memory depends on the window size, not on the size of the scene. Detections keep their
+masks cropped to their own extent, and the duplicates found in the overlap of neighbouring
+windows are merged with a mask-aware NMS.
+"""
+from collections import defaultdict, namedtuple
+import numpy as np
+import torch
+from osgeo import gdal
+
+from utils.functions import to_uint8
+from utils.masks import mask_util
+
+
+# box is (x0, y0, x1, y1) in scene pixels, mask is a boolean crop whose top left corner is (x0, y0)
+SceneDetection = namedtuple("SceneDetection", ["box", "score", "category", "mask"])
+
+
+def scene_windows(width, height, tile_size=650, overlap=128):
+    """
+    Windows covering a scene, overlapping by `overlap` pixels. The last window of each row and
+    column is aligned with the edge of the scene, so that every window has the same size.
+
+    Args:
+        width, height (int): size of the scene.
+        tile_size (int): size of the square windows.
+        overlap (int): overlap of neighbouring windows, larger than the biggest building.
+
+    Returns:
+        list[tuple]: the windows as (x, y, w, h).
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"The overlap must be in [0, {tile_size}), got {overlap}")
+    stride = tile_size - overlap
+
+    def starts(size):
+        if size <= tile_size:
+            return [0]
+        last = size - tile_size
+        return list(range(0, last, stride)) + [last]
+
+    return [(x, y, min(tile_size, width), min(tile_size, height))
+            for y in starts(height) for x in starts(width)]
+
+
+def scene_statistics(dataset, bands=(1, 2, 3)):
+    """
+    Per band values to stretch a scene between, computed by GDAL from its overviews when it has
+    some, without reading the whole raster.
+
+    Args:
+        dataset (gdal.Dataset): the scene.
+        bands (tuple[int]): bands read as the RGB channels.
+
+    Returns:
+        tuple or None: the per band lower and upper values, None for 8-bit scenes which are not stretched.
+    """
+    if dataset.GetRasterBand(bands[0]).DataType == gdal.GDT_Byte:
+        return None
+    low, high = zip(*(dataset.GetRasterBand(b).ComputeRasterMinMax(True) for b in bands))
+    return np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+
+
+def _detections(instances, x, y):
+    """Detections of one window in scene coordinates, with their masks cropped to their extent."""
+    boxes = instances.pred_boxes.tensor.numpy() if instances.has("pred_boxes") else None
+    masks = instances.pred_masks.numpy() if instances.has("pred_masks") else None
+    scores = instances.scores.numpy()
+    classes = instances.pred_classes.numpy()
+
+    detections = []
+    for i in range(len(instances)):
+        if masks is not None:
+            rows, cols = np.nonzero(masks[i])
+            if len(rows) == 0:
+                continue
+            x0, y0, x1, y1 = cols.min(), rows.min(), cols.max() + 1, rows.max() + 1
+            mask = masks[i, y0:y1, x0:x1].copy()
+        else:
+            x0, y0 = np.floor(boxes[i, :2]).astype(int)
+            x1, y1 = np.ceil(boxes[i, 2:]).astype(int)
+            mask = np.ones((max(y1 - y0, 1), max(x1 - x0, 1)), dtype=bool)
+        detections.append(SceneDetection((int(x0) + x, int(y0) + y, int(x1) + x, int(y1) + y),
+                                         float(scores[i]), int(classes[i]), mask))
+    return detections
+
+
+def _overlap(a, b):
+    """Number of pixels covered by the masks of both detections."""
+    x0, y0 = max(a.box[0], b.box[0]), max(a.box[1], b.box[1])
+    x1, y1 = min(a.box[2], b.box[2]), min(a.box[3], b.box[3])
+    if x0 >= x1 or y0 >= y1:
+        return 0
+    crop_a = a.mask[y0 - a.box[1]:y1 - a.box[1], x0 - a.box[0]:x1 - a.box[0]]
+    crop_b = b.mask[y0 - b.box[1]:y1 - b.box[1], x0 - b.box[0]:x1 - b.box[0]]
+    return int(np.count_nonzero(crop_a & crop_b))
+
+
+def merge_detections(detections, iou_threshold=0.5, containment_threshold=0.8, cell_size=256):
+    """
+    Mask-aware NMS over the detections of every window. A detection is dropped when its mask
+    overlaps the mask of a higher scoring one of the same class by more than `iou_threshold`
+    IoU, or when more than `containment_threshold` of the smaller mask is covered, which removes
+    buildings cut by the edge of a window and detected whole in its neighbour.
+
+    Kept detections are indexed in a grid of `cell_size` pixels, so each one is only compared
+    with its neighbours.
+
+    Args:
+        detections (list[SceneDetection]):
+        iou_threshold (float):
+        containment_threshold (float):
+        cell_size (int):
+
+    Returns:
+        list[SceneDetection]: the kept detections, by decreasing score.
+    """
+    def cells(box):
+        for cy in range(box[1] // cell_size, (box[3] - 1) // cell_size + 1):
+            for cx in range(box[0] // cell_size, (box[2] - 1) // cell_size + 1):
+                yield cx, cy
+
+    grid = defaultdict(list)
+    kept, areas = [], []
+    for det in sorted(detections, key=lambda d: -d.score):
+        area = int(np.count_nonzero(det.mask))
+        candidates = {k for cell in cells(det.box) for k in grid[cell]}
+        duplicate = False
+        for k in candidates:
+            other = kept[k]
+            if other.category != det.category:
+                continue
+            inter = _overlap(det, other)
+            if inter == 0:
+                continue
+            if (inter / (area + areas[k] - inter) > iou_threshold
+                    or inter / max(min(area, areas[k]), 1) > containment_threshold):
+                duplicate = True
+                break
+        if duplicate:
+            continue
+        for cell in cells(det.box):
+            grid[cell].append(len(kept))
+        kept.append(det)
+        areas.append(area)
+    return kept
+
+
+def predict_scene(predictor, path, tile_size=650, overlap=128, stats=None, bands=(1, 2, 3),
+                  iou_threshold=0.5, containment_threshold=0.8, callback=None):
+    """
+    Run a predictor over a GeoTIFF scene window by window.
+
+    Args:
+        predictor (callable): takes a BGR uint8 image and returns the predictions of the model,
+            like :class:`DefaultPredictor`.
+        path (str): the GeoTIFF scene.
+        tile_size (int): size of the windows, the size of the tiles the model was trained on.
+        overlap (int): overlap of neighbouring windows.
+        stats (tuple): per band lower and upper values to stretch between, defaults to those of
+            :func:`scene_statistics`.
+        bands (tuple[int]): bands read as the RGB channels.
+        iou_threshold, containment_threshold (float): see :func:`merge_detections`.
+        callback (callable): called with each window once it has been predicted, for progress.
+
+    Returns:
+        list[SceneDetection]: the detections of the scene.
+        tuple: the geotransform of the scene.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        raise FileNotFoundError(f"GDAL could not open {path}")
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    if stats is None:
+        stats = scene_statistics(dataset, bands)
+    low, high = stats if stats is not None else (None, None)
+
+    detections = []
+    for window in scene_windows(width, height, tile_size, overlap):
+        x, y, w, h = window
+        arrays = dataset.ReadAsArray(x, y, w, h, band_list=list(bands))
+        # windows outside of the footprint of an orthomosaic are left empty
+        if arrays.any():
+            image = to_uint8(arrays, normalize=stats is not None, low=low, high=high)
+            predictions = predictor(np.ascontiguousarray(image[..., ::-1]))
+            if "instances" in predictions:
+                instances = predictions["instances"].to(torch.device("cpu"))
+                detections.extend(_detections(instances, x, y))
+        if callback is not None:
+            callback(window)
+
+    return merge_detections(detections, iou_threshold, containment_threshold), dataset.GetGeoTransform()
+
+
+def detection_records(detections):
+    """
+    Args:
+        detections (list[SceneDetection]):
+
+    Returns:
+        list[dict]: the detections in a JSON serializable form, with the box in XYXY scene pixels and
+        the mask as the COCO RLE of its crop, whose top left corner is the top left corner of the box.
+    """
+    return [{"bbox": list(det.box),
+             "score": det.score,
+             "category_id": det.category,
+             "segmentation": mask_rle(det.mask)}
+            for det in detections]
+
+
+def mask_rle(mask):
+    """COCO RLE of a boolean mask, with its counts as a string."""
+    rle = mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+    return {"size": [int(s) for s in rle["size"]], "counts": rle["counts"].decode("ascii")}
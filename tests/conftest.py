@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the repository root, for the helpers in utils/ and inference/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
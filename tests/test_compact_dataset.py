@@ -0,0 +1,72 @@
+import pickle
+
+from detectron2.structures import BoxMode
+
+from utils.dataset import CompactDataset
+
+
+def _records():
+    return [
+        {"file_name": "Spacenet/train/RGB-PanSharpen_AOI_2_Vegas_img1.png", "image_id": 0, "height": 650,
+         "width": 650,
+         "annotations": [
+             {"bbox": [10.0, 20.0, 30.5, 40.5], "bbox_mode": BoxMode.XYXY_ABS,
+              "segmentation": [[10.5, 20.5, 30.5, 20.5, 30.5, 40.5]], "category_id": 0},
+             # a building in two parts
+             {"bbox": [1.0, 2.0, 9.0, 8.0], "bbox_mode": BoxMode.XYWH_ABS,
+              "segmentation": [[1.5, 2.5, 5.5, 2.5, 5.5, 6.5], [6.5, 2.5, 9.5, 2.5, 9.5, 8.5, 6.5, 8.5]],
+              "category_id": 0},
+         ]},
+        # no building
+        {"file_name": "Spacenet/train/RGB-PanSharpen_AOI_3_Paris_img2.webp", "image_id": 1, "height": 650,
+         "width": 650, "annotations": []},
+        {"file_name": "Spacenet/train/RGB-PanSharpen_AOI_4_Shanghai_img3.npy", "image_id": 2, "height": 400,
+         "width": 300,
+         "annotations": [
+             {"bbox": [0.0, 0.0, 4.0, 4.0], "bbox_mode": BoxMode.XYXY_ABS,
+              "segmentation": {"size": [400, 300], "counts": "PPYo0<5K00O1N2O1O0"}, "category_id": 0},
+             {"bbox": [5.0, 5.0, 7.0, 7.0], "bbox_mode": BoxMode.XYXY_ABS,
+              "segmentation": [[5.5, 5.5, 7.5, 5.5, 7.5, 7.5]], "category_id": 1},
+         ]},
+        # non-ascii file name
+        {"file_name": "Spacenet/val/tuile_é.png", "image_id": 7, "height": 650, "width": 650,
+         "annotations": [
+             {"bbox": [2.0, 3.0, 4.0, 5.0], "bbox_mode": BoxMode.XYXY_ABS,
+              "segmentation": {"size": [650, 650], "counts": b"Ya0:1O2N"}, "category_id": 0},
+         ]},
+    ]
+
+
+def _normalized(record):
+    # RLE counts are rebuilt as str, which pycocotools reads like bytes
+    for anno in record["annotations"]:
+        segm = anno["segmentation"]
+        if isinstance(segm, dict) and isinstance(segm["counts"], bytes):
+            segm["counts"] = segm["counts"].decode()
+    return record
+
+
+def test_records_are_rebuilt():
+    records = _records()
+    dataset = CompactDataset(records)
+    assert len(dataset) == len(records)
+    for i, expected in enumerate(_records()):
+        record = dataset[i]
+        assert record == _normalized(expected)
+        for anno in record["annotations"]:
+            assert isinstance(anno["bbox_mode"], BoxMode)
+
+
+def test_empty_dataset():
+    assert len(CompactDataset([])) == 0
+
+
+def test_records_without_annotations_key():
+    dataset = CompactDataset([{"file_name": "a.png", "image_id": 3, "height": 8, "width": 8}])
+    assert dataset[0] == {"file_name": "a.png", "image_id": 3, "height": 8, "width": 8, "annotations": []}
+
+
+def test_pickled_dataset():
+    # spawned dataloader workers receive the dataset pickled
+    dataset = pickle.loads(pickle.dumps(CompactDataset(_records())))
+    assert [dataset[i] for i in range(len(dataset))] == [_normalized(r) for r in _records()]
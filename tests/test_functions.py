@@ -0,0 +1,86 @@
+import pytest
+
+from utils.functions import _regions, parse_wkt_polygons
+
+
+def _baseline_regions(literals):
+    """The per-row parsing of the original detectron_json, for the buildings of one image."""
+    regions = {}
+    for i, literal in enumerate(literals):
+        if "EMPTY" in literal:
+            regions = {}
+            break
+        if "),(" in literal:
+            literal = literal.replace("),(", ",")
+
+        tup = literal.split("((")[1]
+        tup = tup[:-2]
+        strlist = tup.split(",")
+        all_points_x, all_points_y = [], []
+        for j in range(len(strlist)):
+            split = strlist[j].split(" ")
+            all_points_x.append(round(float(split[0])))
+            all_points_y.append(round(float(split[1])))
+        regions[str(i)] = {"shape_attributes":
+                               {"name": "polygon",
+                                "all_points_x": all_points_x,
+                                "all_points_y": all_points_y,
+                                "category": 0
+                               },
+                           "region_attributes": {}
+                          }
+    return regions
+
+
+SQUARE = "POLYGON ((103.4 2.2 0,109.1 2.2 0,109.1 8.6 0,103.4 8.6 0,103.4 2.2 0))"
+# exterior ring and a hole
+COURTYARD = ("POLYGON ((0 0 0,20 0 0,20 20 0,0 20 0,0 0 0),"
+             "(5.5 5.5 0,15.5 5.5 0,15.5 15.5 0,5.5 15.5 0,5.5 5.5 0))")
+TWO_HOLES = ("POLYGON ((0 0 0,30 0 0,30 10 0,0 10 0,0 0 0),(2 2 0,4 2 0,4 4 0,2 2 0),"
+             "(20 2 0,24 2 0,24 6 0,20 2 0))")
+# values halfway between integers are rounded to even, like the built-in round
+HALVES = "POLYGON ((0.5 1.5 0,2.5 3.5 0,-0.5 -1.5 0,0.5 1.5 0))"
+# without the z coordinate
+PLANAR = "POLYGON ((1.2 3.7,4.9 3.7,4.9 8.1,1.2 3.7))"
+EMPTY = "POLYGON EMPTY"
+
+
+@pytest.mark.parametrize("literals", [
+    [SQUARE],
+    [COURTYARD],
+    [TWO_HOLES],
+    [HALVES],
+    [PLANAR],
+    [SQUARE, COURTYARD, HALVES, TWO_HOLES],
+    [EMPTY],
+    [SQUARE, EMPTY],
+    [EMPTY, SQUARE],
+])
+def test_same_regions_as_per_row_parsing(literals):
+    assert _regions(parse_wkt_polygons(literals)) == _baseline_regions(literals)
+
+
+def test_polygons_of_several_images():
+    # the polygons of every image are parsed at once, each string keeps its own coordinates
+    literals = [SQUARE, EMPTY, COURTYARD, HALVES]
+    parsed = parse_wkt_polygons(literals)
+    assert parsed[1] is None
+    for literal, polygon in zip(literals, parsed):
+        if polygon is not None:
+            assert _regions([polygon]) == _baseline_regions([literal])
+
+
+def test_exterior_only():
+    xs, ys = parse_wkt_polygons([COURTYARD], exterior_only=True)[0]
+    assert (xs, ys) == ([0, 20, 20, 0, 0], [0, 0, 20, 20, 0])
+    assert parse_wkt_polygons([SQUARE], exterior_only=True) == parse_wkt_polygons([SQUARE])
+    assert parse_wkt_polygons([EMPTY], exterior_only=True) == [None]
+
+
+def test_multipolygon_is_rejected():
+    # neither path parses a MULTIPOLYGON, both raise instead of writing wrong coordinates
+    literal = "MULTIPOLYGON (((0 0 0,1 0 0,1 1 0,0 0 0)),((5 5 0,6 5 0,6 6 0,5 5 0)))"
+    with pytest.raises(ValueError):
+        _baseline_regions([literal])
+    with pytest.raises(ValueError):
+        parse_wkt_polygons([literal])
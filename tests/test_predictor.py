@@ -0,0 +1,99 @@
+import multiprocessing as mp
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from detectron2.config import get_cfg
+from detectron2.structures import Instances
+
+import inference.predictor as predictor_module
+from inference.predictor import AsyncPredictor
+
+
+class DummyPredictor:
+    """Predicts one mask, the pixels of the image equal to its first pixel, slower for even images."""
+
+    def __init__(self, cfg):
+        pass
+
+    def __call__(self, image):
+        value = int(image[0, 0, 0])
+        if value % 2 == 0:
+            # results come back out of order
+            time.sleep(0.05)
+        mask = image[..., 0] == value
+        return {"instances": Instances(image.shape[:2], scores=torch.tensor([float(value)]),
+                                       pred_masks=torch.from_numpy(mask[None]))}
+
+
+def _image(value, size=32):
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    image[: size // 2] = value
+    return image
+
+
+@pytest.fixture
+def async_predictor(monkeypatch):
+    # forked workers inherit the dummy predictor
+    context = mp.get_start_method(allow_none=True)
+    mp.set_start_method("fork", force=True)
+    monkeypatch.setattr(predictor_module, "DefaultPredictor", DummyPredictor)
+    cfg = get_cfg()
+    predictor = AsyncPredictor(cfg, num_gpus=0, num_cpu_workers=2)
+    yield predictor
+    predictor.shutdown()
+    mp.set_start_method(context, force=True)
+
+
+def _check(result, value):
+    instances = result["instances"]
+    assert float(instances.scores[0]) == value
+    expected = _image(value)[..., 0] == value
+    np.testing.assert_array_equal(instances.pred_masks[0].numpy(), expected)
+
+
+def test_results_in_order(async_predictor):
+    values = list(range(1, 13))
+    for value in values:
+        async_predictor.put(_image(value))
+    for value in values:
+        _check(async_predictor.get(), value)
+    assert len(async_predictor) == 0
+
+
+def test_slots_are_reused(async_predictor):
+    # many more images than frame and mask slots, a few in flight at a time
+    num_images = 10 * async_predictor.masks_block.num_slots
+    in_flight = async_predictor.default_buffer_size
+    for value in range(1, num_images + 1):
+        async_predictor.put(_image(value % 256))
+        if value > in_flight:
+            _check(async_predictor.get(), (value - in_flight) % 256)
+    for value in range(num_images - in_flight + 1, num_images + 1):
+        _check(async_predictor.get(), value % 256)
+
+    # every frame went through shared memory, and every slot is free again
+    assert async_predictor.frame_slot_of == {}
+    assert sorted(async_predictor.free_frame_slots) == list(range(async_predictor.frames_block.num_slots))
+    free = []
+    while len(free) < async_predictor.masks_block.num_slots:
+        free.append(async_predictor.free_result_slots.get(timeout=5))
+    assert sorted(free) == list(range(async_predictor.masks_block.num_slots))
+
+
+def test_shutdown_with_pending_results(async_predictor):
+    # more results than the result queue holds, none of them read: the workers are blocked
+    # putting their last one, while tasks are still waiting for them
+    for value in range(1, 13):
+        async_predictor.put(_image(value))
+    time.sleep(0.5)
+    start = time.monotonic()
+    async_predictor.shutdown(timeout=30)
+    assert time.monotonic() - start < 10
+    # the workers read their stop token and exited, none was terminated
+    assert [p.exitcode for p in async_predictor.procs] == [0] * len(async_predictor.procs)
+    assert async_predictor.masks_block is None
+    # a second call does nothing
+    async_predictor.shutdown()
@@ -16,17 +16,15 @@ You may want to write your own script with your datasets and other customization
 import logging
 import os
 import yaml
-import json
-import cv2 as cv
-import numpy as np
 from collections import OrderedDict
 
 import detectron2.utils.comm as comm
-from detectron2.structures import BoxMode
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
 from detectron2.data.datasets import register_coco_panoptic_separated
-from detectron2.data import MetadataCatalog, DatasetCatalog
+from detectron2.data import MetadataCatalog, build_detection_test_loader, build_detection_train_loader
+from detectron2.data import get_detection_dataset_dicts
+from detectron2.data.samplers import RepeatFactorTrainingSampler, TrainingSampler
 from detectron2.engine import DefaultTrainer, default_argument_parser, default_setup, hooks, launch
 from detectron2.evaluation import (
     CityscapesInstanceEvaluator,
@@ -41,48 +39,13 @@ from detectron2.evaluation import (
 )
 from detectron2.modeling import GeneralizedRCNNWithTTA
 
-
-def get_dataset_dicts(img_dir):
-    json_file = os.path.join(img_dir, "via_region_data.json")
-    with open(json_file) as f:
-        imgs_anns = json.load(f)
-    
-    dataset_dicts = []
-    for idx, annots in enumerate(imgs_anns.values()):
-        record = {}
-        
-        filename = os.path.join(img_dir, annots["filename"])
-        height, width = cv.imread(filename).shape[:2]
-        
-        record["file_name"] = filename
-        record["image_id"] = idx
-        record["height"] = height
-        record["width"] = width
-      
-        annotations = annots["regions"]
-        objs = []
-        for _, anno in annotations.items():
-            assert not anno["region_attributes"]
-            anno = anno["shape_attributes"]
-            px = anno["all_points_x"]
-            py = anno["all_points_y"]
-            poly = [(x + 0.5, y + 0.5) for x, y in zip(px, py)]
-            poly = [p for x in poly for p in x]
-
-            obj = {
-                "bbox": [np.min(px),
-                         np.min(py),
-                         np.max(px),
-                         np.max(py)
-                        ],
-                "bbox_mode": BoxMode.XYXY_ABS,
-                "segmentation": [poly],
-                "category_id": anno["category"]
-            }
-            objs.append(obj)
-        record["annotations"] = objs
-        dataset_dicts.append(record)
-    return dataset_dicts
+from utils.config import add_spacenet_config
+from utils.dataset import CompactDataset, register_spacenet_datasets, release_dataset_dicts
+from utils.evaluator import SpacenetEvaluator
+from utils.hooks import ImageCacheHook, StepTimingHook
+from utils.imagecache import SharedImageCache
+from utils.metrics import metrics
+from utils.mapper import CachedDatasetMapper, SpacenetDatasetMapper, TileStoreDatasetMapper
 
 
 def build_evaluator(cfg, dataset_name, output_folder=None):
@@ -104,8 +67,16 @@ def build_evaluator(cfg, dataset_name, output_folder=None):
                 output_dir=output_folder,
             )
         )
-    if evaluator_type in ["coco", "coco_panoptic_seg"]:
+    if evaluator_type in ["coco", "coco_panoptic_seg"] and "coco" in cfg.SPACENET.EVALUATORS:
         evaluator_list.append(COCOEvaluator(dataset_name, output_dir=output_folder))
+    if evaluator_type in ["coco", "spacenet"] and "spacenet" in cfg.SPACENET.EVALUATORS:
+        evaluator_list.append(
+            SpacenetEvaluator(
+                dataset_name,
+                output_dir=output_folder,
+                score_threshold=cfg.SPACENET.EVAL_SCORE_THRESHOLD,
+            )
+        )
     if evaluator_type == "coco_panoptic_seg":
         evaluator_list.append(COCOPanopticEvaluator(dataset_name, output_folder))
     if evaluator_type == "cityscapes_instance":
@@ -133,10 +104,83 @@ class Trainer(DefaultTrainer):
     own training loop. You can use "tools/plain_train_net.py" as an example.
     """
 
+    # the image cache of the training mapper, with SPACENET.IMAGE_CACHE_MB
+    image_cache = None
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         return build_evaluator(cfg, dataset_name, output_folder)
 
+    def build_hooks(self):
+        ret = super().build_hooks()
+        if self.image_cache is not None:
+            # before the writers, which write its scalars in the same iteration
+            ret.insert(0, ImageCacheHook(self.image_cache, metrics, self.cfg.SPACENET.METRICS_PERIOD))
+        if metrics.enabled:
+            # first, so that the iterations it times do not include the other hooks
+            ret.insert(0, StepTimingHook(metrics, self.cfg.SPACENET.METRICS_PERIOD, self.cfg.SOLVER.IMS_PER_BATCH))
+        return ret
+
+    @classmethod
+    def build_mapper(cls, cfg, is_train):
+        if cfg.SPACENET.TILE_STORE:
+            return TileStoreDatasetMapper(cfg, is_train)
+        if is_train and cfg.SPACENET.IMAGE_CACHE_MB > 0:
+            # created before the dataloader workers, which share it
+            if cls.image_cache is None:
+                cls.image_cache = SharedImageCache(cfg.SPACENET.IMAGE_CACHE_MB << 20)
+            return CachedDatasetMapper(cfg, is_train, cache=cls.image_cache)
+        return SpacenetDatasetMapper(cfg, is_train)
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        if not cfg.SPACENET.COMPACT_DATASET:
+            return build_detection_train_loader(cfg, mapper=cls.build_mapper(cfg, True))
+
+        dataset_dicts = get_detection_dataset_dicts(
+            cfg.DATASETS.TRAIN,
+            filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+        )
+        sampler = cls.build_train_sampler(cfg, dataset_dicts)
+        dataset = CompactDataset(dataset_dicts)
+        # only the compact buffers are left for the workers to inherit
+        del dataset_dicts
+        release_dataset_dicts()
+        return build_detection_train_loader(
+            dataset=dataset,
+            mapper=cls.build_mapper(cfg, True),
+            sampler=sampler,
+            total_batch_size=cfg.SOLVER.IMS_PER_BATCH,
+            aspect_ratio_grouping=cfg.DATALOADER.ASPECT_RATIO_GROUPING,
+            num_workers=cfg.DATALOADER.NUM_WORKERS,
+        )
+
+    @staticmethod
+    def build_train_sampler(cfg, dataset_dicts):
+        """
+        The sampler of DATALOADER.SAMPLER_TRAIN, as detectron2 builds it from the config.
+        Repeat factors are computed from the records, before they are packed.
+        """
+        sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
+        logging.getLogger("detectron2.trainer").info("Using training sampler {}".format(sampler_name))
+        if sampler_name == "TrainingSampler":
+            return TrainingSampler(len(dataset_dicts))
+        if sampler_name == "RepeatFactorTrainingSampler":
+            repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(
+                dataset_dicts, cfg.DATALOADER.REPEAT_THRESHOLD
+            )
+            return RepeatFactorTrainingSampler(repeat_factors)
+        if sampler_name == "RandomSubsetTrainingSampler":
+            # only in recent versions of detectron2
+            from detectron2.data.samplers import RandomSubsetTrainingSampler
+
+            return RandomSubsetTrainingSampler(len(dataset_dicts), cfg.DATALOADER.RANDOM_SUBSET_RATIO)
+        raise ValueError("Unknown training sampler: {}".format(sampler_name))
+
+    @classmethod
+    def build_test_loader(cls, cfg, dataset_name):
+        return build_detection_test_loader(cfg, dataset_name, mapper=cls.build_mapper(cfg, False))
+
     @classmethod
     def test_with_TTA(cls, cfg, model):
         logger = logging.getLogger("detectron2.trainer")
@@ -160,33 +204,41 @@ def setup(args):
     Create configs and perform basic setups.
     """
     cfg = get_cfg()
+    add_spacenet_config(cfg)
     cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
+    if cfg.SPACENET.MASK_CACHE:
+        cfg.INPUT.MASK_FORMAT = "bitmask"
     cfg.freeze()
     default_setup(cfg, args)
     return cfg
 
 
 def main(args):
-    # Spacenet
-    classes = ["building"]
-    
-    for d in ["train", "val"]:
-        DatasetCatalog.register(d, lambda d=d: get_dataset_dicts(os.path.join("Spacenet", d)))
-        MetadataCatalog.get(d).thing_classes = classes
-    
     cfg = setup(args)
 
+    if comm.is_main_process() and (cfg.SPACENET.METRICS_FILE or cfg.SPACENET.PROMETHEUS_PORT):
+        metrics.open(
+            os.path.join(cfg.OUTPUT_DIR, cfg.SPACENET.METRICS_FILE) if cfg.SPACENET.METRICS_FILE else None,
+            cfg.SPACENET.PROMETHEUS_PORT,
+            script="train_net",
+        )
+
+    # Spacenet
+    register_spacenet_datasets("Spacenet", ["train", "val"], mask_format=cfg.INPUT.MASK_FORMAT)
+
     if args.eval_only:
         model = Trainer.build_model(cfg)
         DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
-        res = Trainer.test(cfg, model)
-        if cfg.TEST.AUG.ENABLED:
-            res.update(Trainer.test_with_TTA(cfg, model))
+        with metrics.stage("test"):
+            res = Trainer.test(cfg, model)
+            if cfg.TEST.AUG.ENABLED:
+                res.update(Trainer.test_with_TTA(cfg, model))
         if comm.is_main_process():
             verify_results(cfg, res)
+        close_metrics()
         return res
 
     """
@@ -194,13 +246,23 @@ def main(args):
     consider writing your own training loop (see plain_train_net.py) or
     subclassing the trainer.
     """
-    trainer = Trainer(cfg)
-    trainer.resume_or_load(resume=args.resume)
+    with metrics.stage("build"):
+        trainer = Trainer(cfg)
+        trainer.resume_or_load(resume=args.resume)
     if cfg.TEST.AUG.ENABLED:
         trainer.register_hooks(
             [hooks.EvalHook(0, lambda: trainer.test_with_TTA(cfg, trainer.model))]
         )
-    return trainer.train()
+    with metrics.stage("train"):
+        res = trainer.train()
+    close_metrics()
+    return res
+
+
+def close_metrics():
+    if metrics.enabled:
+        logging.getLogger("detectron2.trainer").info("Metrics:\n" + metrics.report())
+        metrics.close()
 
 
 if __name__ == "__main__":
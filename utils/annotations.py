@@ -0,0 +1,216 @@
+import os
+import json
+import numpy as np
+
+from utils.manifest import file_fingerprint, fingerprint_matches
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+# One row per polygon. Images without any building have a single row with region -1 and no points.
+# rle holds the counts of the mask of the polygon when the region JSON file was built with them, otherwise null.
+SCHEMA_FIELDS = [
+    ("filename", "string"),
+    ("aoi", "string"),
+    ("split", "string"),
+    ("size", "int64"),
+    ("width", "int32"),
+    ("height", "int32"),
+    ("region", "int32"),
+    ("category", "int32"),
+    ("all_points_x", "list<int32>"),
+    ("all_points_y", "list<int32>"),
+    ("rle", "string"),
+]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The columnar annotation store needs pyarrow, install it with `pip install pyarrow`")
+
+def annotation_schema():
+    """Returns the pyarrow schema of the columnar annotation store, see :data:`SCHEMA_FIELDS`"""
+    _require_pyarrow()
+    types = {"string": pa.string(), "int64": pa.int64(), "int32": pa.int32(), "list<int32>": pa.list_(pa.int32())}
+    return pa.schema([(name, types[kind]) for name, kind in SCHEMA_FIELDS])
+
+def region_json_to_table(json_path, aoi, split):
+    """Converts the region JSON file of an AOI into a columnar table with one row per polygon
+
+    :param json_path: File path of the region JSON file, Ex: "Spacenet/train/AOI_2_Vegas_region_data.json"
+    :type json_path: str
+
+    :param aoi: Name of the AOI, Ex: "AOI_2_Vegas"
+    :type aoi: str
+
+    :param split: "train" or "val"
+    :type split: str
+
+    :raises ImportError: Raised when pyarrow is not installed.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the table of the annotations
+    :rtype: pyarrow.Table
+    """
+    _require_pyarrow()
+    with open(json_path) as f:
+        imgs_anns = json.load(f)
+
+    columns = {name: [] for name, _ in SCHEMA_FIELDS}
+
+    def add_row(annots, region, category, xs, ys, rle=None):
+        columns["filename"].append(annots["filename"])
+        columns["aoi"].append(aoi)
+        columns["split"].append(split)
+        columns["size"].append(annots["size"])
+        columns["width"].append(annots["file_attributes"].get("width"))
+        columns["height"].append(annots["file_attributes"].get("height"))
+        columns["region"].append(region)
+        columns["category"].append(category)
+        columns["all_points_x"].append(xs)
+        columns["all_points_y"].append(ys)
+        columns["rle"].append(rle["counts"] if rle else None)
+
+    for annots in imgs_anns.values():
+        if not annots["regions"]:
+            add_row(annots, -1, -1, [], [])
+        for key, anno in annots["regions"].items():
+            anno = anno["shape_attributes"]
+            add_row(annots, int(key), anno["category"], anno["all_points_x"], anno["all_points_y"], anno.get("rle"))
+
+    return pa.table(columns, schema=annotation_schema())
+
+def write_annotation_table(json_path, dst, aoi, split):
+    """Writes the region JSON file of an AOI into the columnar annotation store of its split.
+    Every AOI is one parquet file of the store, adding an AOI only appends a file
+
+    :param json_path: File path of the region JSON file
+    :type json_path: str
+
+    :param dst: Folder of the columnar annotation store, Ex: "Spacenet/train/annotations"
+    :type dst: str
+
+    :param aoi: Name of the AOI, Ex: "AOI_2_Vegas"
+    :type aoi: str
+
+    :param split: "train" or "val"
+    :type split: str
+
+    :return: Returns the file path of the parquet file
+    :rtype: str
+    """
+    os.makedirs(dst, exist_ok=True)
+    path = os.path.join(dst, f"{aoi}.parquet")
+    table = region_json_to_table(json_path, aoi, split)
+    # the region JSON file the table was written from, see annotation_table_current
+    source = {"file": os.path.basename(json_path), "fingerprint": file_fingerprint(json_path, hash_file=True)}
+    pq.write_table(table.replace_schema_metadata({"source": json.dumps(source)}), path)
+    return path
+
+def annotation_table_current(path, json_dir):
+    """Checks that a parquet file of the columnar store was written from the current content of its region JSON
+    file, by the size, mtime and hash recorded when it was written. A copied file whose content did not change is
+    still current, but is hashed every time
+
+    :param path: File path of the parquet file
+    :type path: str
+
+    :param json_dir: Folder of the region JSON file, Ex: "Spacenet/train"
+    :type json_dir: str
+
+    :return: Returns False if pyarrow is not installed, the parquet file records no source, Ex: it was written
+    before sources were recorded, or the region JSON file is missing or changed
+    :rtype: bool
+    """
+    if pq is None:
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    if b"source" not in metadata:
+        return False
+    source = json.loads(metadata[b"source"])
+    return fingerprint_matches(os.path.join(json_dir, source["file"]), source["fingerprint"])
+
+def load_annotation_table(path):
+    """Loads every AOI of a columnar annotation store, in the order of their file names
+
+    :param path: Folder of the columnar annotation store
+    :type path: str
+
+    :raises ImportError: Raised when pyarrow is not installed.
+
+    :return: Returns the table of the annotations
+    :rtype: pyarrow.Table
+    """
+    _require_pyarrow()
+    schema = annotation_schema()
+    files = sorted(name for name in os.listdir(path) if name.endswith(".parquet"))
+    tables = []
+    for name in files:
+        table = pq.read_table(os.path.join(path, name))
+        # stores written before a column was added get it filled with nulls
+        for field in schema:
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(len(table), field.type))
+        tables.append(table.select(schema.names).cast(schema))
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+def _list_arrays(column):
+    """Returns the flat values and the offsets, starting at 0, of a list<int32> column"""
+    array = column.combine_chunks()
+    offsets = array.offsets.to_numpy()
+    values = array.flatten().to_numpy(zero_copy_only=False).astype(np.int64)
+    return values, offsets - offsets[0]
+
+def annotation_records(path):
+    """Reads a columnar annotation store into one record per image, with the polygons and bounding boxes
+    computed for all rows at once
+
+    :param path: Folder of the columnar annotation store
+    :type path: str
+
+    :return: Returns, for each image in order, a tuple (filename, size, width, height, regions) where width and
+    height are None if they were not recorded, and regions is a List of
+    (category, flat polygon as [x0 + 0.5, y0 + 0.5, ...], [x_min, y_min, x_max, y_max], RLE counts or None) tuples
+    :rtype: List
+    """
+    table = load_annotation_table(path)
+    filenames = table.column("filename").to_pylist()
+    sizes = table.column("size").to_numpy()
+    widths = table.column("width").to_pylist()
+    heights = table.column("height").to_pylist()
+    regions = table.column("region").to_numpy()
+    categories = table.column("category").to_numpy()
+    rles = table.column("rle").to_pylist()
+    xs, offsets = _list_arrays(table.column("all_points_x"))
+    ys, _ = _list_arrays(table.column("all_points_y"))
+
+    # polygons of every row, interleaved and shifted to the pixel centers
+    points = np.empty(2 * len(xs), dtype=np.float64)
+    points[0::2] = xs + 0.5
+    points[1::2] = ys + 0.5
+
+    starts, ends = offsets[:-1], offsets[1:]
+    mins_x, maxs_x = np.zeros(len(starts), dtype=np.int64), np.zeros(len(starts), dtype=np.int64)
+    mins_y, maxs_y = np.zeros(len(starts), dtype=np.int64), np.zeros(len(starts), dtype=np.int64)
+    non_empty = ends > starts
+    if non_empty.any():
+        # empty rows hold no values, so consecutive non-empty starts delimit exactly one polygon each
+        index = starts[non_empty]
+        mins_x[non_empty], maxs_x[non_empty] = np.minimum.reduceat(xs, index), np.maximum.reduceat(xs, index)
+        mins_y[non_empty], maxs_y[non_empty] = np.minimum.reduceat(ys, index), np.maximum.reduceat(ys, index)
+
+    records = []
+    for row, filename in enumerate(filenames):
+        if not records or records[-1][0] != filename:
+            records.append((filename, int(sizes[row]), widths[row], heights[row], []))
+        if regions[row] < 0:
+            continue
+        records[-1][4].append((int(categories[row]),
+                               points[2 * starts[row]:2 * ends[row]].tolist(),
+                               [int(mins_x[row]), int(mins_y[row]), int(maxs_x[row]), int(maxs_y[row])],
+                               rles[row]))
+    return records
@@ -0,0 +1,77 @@
+import os
+import json
+import datetime
+import numpy as np
+
+from utils.polygons import polygon_area
+from utils.masks import mask_util
+
+
+def region_json_to_coco(json_path, dst, classes=("building",)):
+    """Exports a region JSON file as a COCO instances file, the file COCOEvaluator loads instead of converting the
+    dataset at the start of every evaluation. Images get the ids :func:`utils.dataset.get_dataset_dicts` gives them,
+    their index in the file, and categories keep their contiguous ids, as Detectron2's own conversion does
+
+    :param json_path: File path of the region JSON file of a split, Ex: "Spacenet/val/via_region_data.json"
+    :type json_path: str
+
+    :param dst: File path of the COCO instances file, Ex: "Spacenet/val/coco_instances.json"
+    :type dst: str
+
+    :param classes: Names of the categories, defaults to ("building",)
+    :type classes: Tuple
+
+    :raises KeyError: Raised when the width or height of an image was not recorded.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the number of images and of annotations
+    :rtype: Tuple
+    """
+    with open(json_path) as f:
+        imgs_anns = json.load(f)
+
+    img_dir = os.path.dirname(json_path)
+    images, annotations = [], []
+    for image_id, annots in enumerate(imgs_anns.values()):
+        width, height = annots["file_attributes"]["width"], annots["file_attributes"]["height"]
+        images.append({"id": image_id,
+                       "width": width,
+                       "height": height,
+                       "file_name": os.path.join(img_dir, annots["filename"])
+                      })
+
+        for region in annots["regions"].values():
+            shape = region["shape_attributes"]
+            px, py = shape["all_points_x"], shape["all_points_y"]
+            x0, y0 = min(px), min(py)
+            rle = shape.get("rle")
+            if rle is not None and mask_util is not None:
+                # masks stored by `create_jsons.py --rle` are used as they are
+                segmentation = rle
+                area = float(mask_util.area({"size": rle["size"], "counts": rle["counts"].encode()}))
+            else:
+                segmentation = [[p for x, y in zip(px, py) for p in (x + 0.5, y + 0.5)]]
+                area = abs(polygon_area(np.column_stack([px, py]).astype(np.float64)))
+            annotations.append({"id": len(annotations) + 1,
+                                "image_id": image_id,
+                                "bbox": [x0, y0, max(px) - x0, max(py) - y0],
+                                "area": area,
+                                "iscrowd": 0,
+                                "category_id": shape["category"],
+                                "segmentation": segmentation
+                               })
+
+    coco = {"info": {"date_created": str(datetime.datetime.now()),
+                     "description": f"COCO instances exported from {json_path}"},
+            "images": images,
+            "categories": [{"id": i, "name": name} for i, name in enumerate(classes)],
+            "annotations": annotations,
+            "licenses": None
+           }
+
+    # written to a temporary file first, the evaluator never loads a partial file
+    tmp_path = f"{dst}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(coco, f)
+    os.replace(tmp_path, dst)
+    return len(images), len(annotations)
@@ -0,0 +1,36 @@
+from detectron2.config import CfgNode as CN
+
+
+def add_spacenet_config(cfg):
+    """
+    Add the options of this repository to a detectron2 config.
+    """
+    _C = cfg
+
+    _C.SPACENET = CN()
+    # Read the training and test images from the tile store written by
+    # `convert_tif.py --tile-store`, found in the "tiles" folder next to the images.
+    # Images missing from the store are read from their files.
+    _C.SPACENET.TILE_STORE = False
+    # Hold the training records in a CompactDataset, contiguous numpy buffers shared by the
+    # dataloader workers, instead of a list of dicts each worker ends up copying.
+    _C.SPACENET.COMPACT_DATASET = False
+    # Train on the masks of the buildings rasterized once as RLE, instead of rasterizing their
+    # polygons at every iteration. Sets INPUT.MASK_FORMAT to "bitmask".
+    _C.SPACENET.MASK_CACHE = False
+    # Evaluators of the test sets, any of "coco" (COCO AP of the masks and boxes) and "spacenet"
+    # (F1 of the buildings matched at IoU >= 0.5, overall and per AOI, as in the SpaceNet challenges).
+    _C.SPACENET.EVALUATORS = ["coco"]
+    # Predictions scoring below it are not buildings for the SpaceNet evaluator.
+    _C.SPACENET.EVAL_SCORE_THRESHOLD = 0.0
+    # Append stage timings, counters and the per iteration split of data wait and compute time to
+    # this JSON lines file in OUTPUT_DIR. Empty to disable.
+    _C.SPACENET.METRICS_FILE = ""
+    # Iterations between two lines of the metrics file.
+    _C.SPACENET.METRICS_PERIOD = 20
+    # Serve the metrics in the Prometheus text format on this port at /metrics. 0 to disable.
+    _C.SPACENET.PROMETHEUS_PORT = 0
+    # Byte budget in MB of a shared-memory LRU cache of the decoded training images, shared by
+    # the dataloader workers, so that tiles are only decoded once. 0 to disable. The cache lives
+    # in /dev/shm, which must be large enough for it and for the dataloader.
+    _C.SPACENET.IMAGE_CACHE_MB = 0
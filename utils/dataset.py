@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import torch
+import numpy as np
+
+from detectron2.structures import BoxMode
+from detectron2.data import MetadataCatalog, DatasetCatalog
+
+from utils.annotations import annotation_records, annotation_table_current
+from utils.masks import polygon_rle
+from utils.writers import image_size, resolve_image_file
+
+
+# Bumped whenever the records built by this module change, so that older caches are not used
+CACHE_VERSION = 1
+
+# A process waiting for another one to build the cache gives up and builds it itself after this many seconds
+CACHE_LOCK_TIMEOUT = 600
+
+# Records already loaded by this process, by cache key
+_LOADED = {}
+
+# "polygon" keeps the polygons as segmentations, "bitmask" the RLE masks to use with INPUT.MASK_FORMAT bitmask
+MASK_FORMATS = ("polygon", "bitmask")
+
+
+def _segmentation(poly, counts, height, width, mask_format):
+    if mask_format == "polygon":
+        return [poly]
+    # masks not stored with the annotations are rasterized once here, and cached with the records
+    if counts is None:
+        return polygon_rle([poly], height, width)
+    return {"size": [height, width], "counts": counts}
+
+
+def _dataset_dicts_from_json(img_dir, json_file, mask_format="polygon"):
+    with open(json_file) as f:
+        imgs_anns = json.load(f)
+
+    dataset_dicts = []
+    for idx, annots in enumerate(imgs_anns.values()):
+        record = {}
+
+        filename = resolve_image_file(os.path.join(img_dir, annots["filename"]))
+        # recorded when the dataset was built, otherwise read from the image header
+        width = annots["file_attributes"].get("width")
+        height = annots["file_attributes"].get("height")
+        if width is None or height is None:
+            width, height = image_size(filename)
+
+        record["file_name"] = filename
+        record["image_id"] = idx
+        record["height"] = height
+        record["width"] = width
+
+        annotations = annots["regions"]
+        objs = []
+        for _, anno in annotations.items():
+            assert not anno["region_attributes"]
+            anno = anno["shape_attributes"]
+            px = anno["all_points_x"]
+            py = anno["all_points_y"]
+            poly = [(x + 0.5, y + 0.5) for x, y in zip(px, py)]
+            poly = [p for x in poly for p in x]
+            rle = anno.get("rle")
+
+            obj = {
+                "bbox": [np.min(px),
+                         np.min(py),
+                         np.max(px),
+                         np.max(py)
+                        ],
+                "bbox_mode": BoxMode.XYXY_ABS,
+                "segmentation": _segmentation(poly, rle and rle["counts"], height, width, mask_format),
+                "category_id": anno["category"]
+            }
+            objs.append(obj)
+        record["annotations"] = objs
+        dataset_dicts.append(record)
+    return dataset_dicts
+
+
+def _dataset_dicts_from_table(img_dir, table_dir, mask_format="polygon"):
+    dataset_dicts = []
+    for idx, (name, _, width, height, regions) in enumerate(annotation_records(table_dir)):
+        filename = resolve_image_file(os.path.join(img_dir, name))
+        if width is None or height is None:
+            width, height = image_size(filename)
+
+        objs = [{"bbox": bbox,
+                 "bbox_mode": BoxMode.XYXY_ABS,
+                 "segmentation": _segmentation(poly, counts, height, width, mask_format),
+                 "category_id": category
+                } for category, poly, bbox, counts in regions]
+        dataset_dicts.append({"file_name": filename,
+                              "image_id": idx,
+                              "height": height,
+                              "width": width,
+                              "annotations": objs
+                             })
+    return dataset_dicts
+
+
+def annotation_sources(img_dir):
+    """
+    Args:
+        img_dir (str): folder of a split, Ex: "Spacenet/train".
+
+    Returns:
+        list[str]: the annotation files the records of the split are built from: the parquet files
+        of the columnar store if there is one, which is much faster to load, otherwise via_region_data.json.
+        A store is ignored if any of its files was not written from the current region JSON file of
+        its AOI, Ex: after the JSON files were rebuilt with `create_jsons.py --simplify` but without
+        `--parquet`.
+    """
+    json_file = os.path.join(img_dir, "via_region_data.json")
+    table_dir = os.path.join(img_dir, "annotations")
+    if os.path.isdir(table_dir):
+        tables = sorted(os.path.join(table_dir, name) for name in os.listdir(table_dir) if name.endswith(".parquet"))
+        if tables and (not os.path.exists(json_file)
+                       or all(annotation_table_current(path, img_dir) for path in tables)):
+            return tables
+    return [json_file]
+
+
+def _cache_key(img_dir, sources, mask_format):
+    key = hashlib.sha1(f"{CACHE_VERSION}|{os.path.abspath(img_dir)}|{mask_format}".encode())
+    for path in sources:
+        stat = os.stat(path)
+        key.update(f"|{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return key.hexdigest()[:16]
+
+
+def _build_dataset_dicts(img_dir, sources, mask_format):
+    if sources[0].endswith(".parquet"):
+        return _dataset_dicts_from_table(img_dir, os.path.dirname(sources[0]), mask_format)
+    return _dataset_dicts_from_json(img_dir, sources[0], mask_format)
+
+
+def _load_cache(path):
+    with open(path, "rb") as f:
+        dataset_dicts = pickle.load(f)
+    # the key only covers the annotations, images converted again to another format since
+    # are found again here, instead of reading files that are not there anymore
+    for record in dataset_dicts:
+        if not os.path.exists(record["file_name"]):
+            record["file_name"] = resolve_image_file(record["file_name"])
+    return dataset_dicts
+
+
+def _write_cache(path, dataset_dicts):
+    # written to a temporary file first, readers never see a partial cache
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(dataset_dicts, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    # caches of the same split and mask format whose annotations changed since are not needed anymore
+    folder, name = os.path.split(path)
+    prefix = name.rsplit("_", 1)[0] + "_"
+    for other in os.listdir(folder):
+        if other.startswith(prefix) and other.endswith(".pkl") and other != name:
+            try:
+                os.remove(os.path.join(folder, other))
+            except OSError:
+                pass
+
+
+def get_dataset_dicts(img_dir, cache_dir=None, use_cache=True, mask_format="polygon"):
+    """
+    Load the records of a split in Detectron2 Dataset format.
+
+    The resolved records are cached on disk in a binary file keyed on the path, size and mtime of
+    the annotation files, so that they are only built once for all processes, including every rank
+    of a multi-process launch, and rebuilt automatically when the annotations change. Within a
+    process, records are only loaded once.
+
+    Args:
+        img_dir (str): folder of the split, Ex: "Spacenet/train".
+        cache_dir (str): folder of the cache, defaults to ``<img_dir>/.cache``.
+        use_cache (bool): set to False to always build the records from the annotations.
+        mask_format (str): "polygon" for polygon segmentations, or "bitmask" for RLE masks, rasterized
+            once instead of at every iteration. Masks stored in the annotations by
+            `create_jsons.py --rle` are used as they are. Train with INPUT.MASK_FORMAT "bitmask".
+
+    Returns:
+        list[dict]: the records of the split.
+    """
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"Unknown mask format {mask_format}, expected one of {MASK_FORMATS}")
+    sources = annotation_sources(img_dir)
+    if not use_cache:
+        return _build_dataset_dicts(img_dir, sources, mask_format)
+
+    key = _cache_key(img_dir, sources, mask_format)
+    if key in _LOADED:
+        return list(_LOADED[key])
+
+    cache_dir = cache_dir or os.path.join(img_dir, ".cache")
+    # splits sharing a cache_dir have their own prefix, so that writing one never sweeps the other
+    split = hashlib.sha1(os.path.abspath(img_dir).encode()).hexdigest()[:8]
+    cache_path = os.path.join(cache_dir, f"dataset_dicts_{mask_format}_{split}_{key}.pkl")
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        lock_path = cache_path + ".lock"
+        if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > CACHE_LOCK_TIMEOUT:
+            # left behind by a process that died while building the cache
+            os.remove(lock_path)
+        try:
+            # only one process builds the cache, the others wait for it
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+            try:
+                _write_cache(cache_path, _build_dataset_dicts(img_dir, sources, mask_format))
+            finally:
+                os.remove(lock_path)
+        except FileExistsError:
+            start = time.time()
+            while os.path.exists(lock_path) and not os.path.exists(cache_path):
+                if time.time() - start > CACHE_LOCK_TIMEOUT:
+                    break
+                time.sleep(0.5)
+            if not os.path.exists(cache_path):
+                _LOADED[key] = _build_dataset_dicts(img_dir, sources, mask_format)
+                return list(_LOADED[key])
+
+    _LOADED[key] = _load_cache(cache_path)
+    return list(_LOADED[key])
+
+
+def register_spacenet_datasets(root="Spacenet", splits=("train", "val"), thing_colors=None, **kwargs):
+    """
+    Register the SpaceNet splits in the :class:`DatasetCatalog` and :class:`MetadataCatalog`.
+
+    Splits are evaluated with the COCO evaluator. When `create_jsons.py` exported the COCO instances
+    file of a split, the evaluator loads it directly instead of converting the dataset first.
+
+    Args:
+        root (str): folder of the dataset.
+        splits (tuple[str]): the splits to register, each one is a folder of `root` and a dataset name.
+        thing_colors (list[tuple]): colors of the classes for the visualizer.
+        kwargs: passed to :func:`get_dataset_dicts`.
+    """
+    classes = ["building"]
+    for d in splits:
+        DatasetCatalog.register(d, lambda d=d: get_dataset_dicts(os.path.join(root, d), **kwargs))
+        MetadataCatalog.get(d).thing_classes = classes
+        MetadataCatalog.get(d).evaluator_type = "coco"
+        coco_file = os.path.join(root, d, "coco_instances.json")
+        if os.path.exists(coco_file):
+            MetadataCatalog.get(d).json_file = coco_file
+        if thing_colors is not None:
+            MetadataCatalog.get(d).thing_colors = thing_colors
+
+
+def release_dataset_dicts():
+    """
+    Drop the records this process keeps after loading them, once they have been copied elsewhere,
+    e.g. into a :class:`CompactDataset`.
+    """
+    _LOADED.clear()
+
+
+class CompactDataset(torch.utils.data.Dataset):
+    """
+    Records in Detectron2 Dataset format held in a few contiguous numpy buffers instead of lists of
+    Python dicts: fixed-width arrays per image, CSR offsets from images to instances, from instances
+    to polygons and from polygons to their vertices. RLE masks are kept the same way, their counts in
+    one byte buffer with offsets per instance. Dicts are only built for the record asked for in
+    :meth:`__getitem__`.
+
+    Dataloader workers forked from the main process never write to these buffers, unlike to Python
+    objects whose reference counts change whenever they are read, so the pages stay shared and the
+    memory of the workers does not grow with their number.
+    """
+
+    def __init__(self, dataset_dicts):
+        """
+        Args:
+            dataset_dicts (list[dict]): records in Detectron2 Dataset format, with polygon or RLE segmentations.
+        """
+        names = [d["file_name"].encode() for d in dataset_dicts]
+        self._names = np.frombuffer(b"".join(names), dtype=np.uint8)
+        self._name_offsets = np.cumsum([0] + [len(name) for name in names], dtype=np.int64)
+        self._image_ids = np.array([d["image_id"] for d in dataset_dicts], dtype=np.int64)
+        self._heights = np.array([d["height"] for d in dataset_dicts], dtype=np.int32)
+        self._widths = np.array([d["width"] for d in dataset_dicts], dtype=np.int32)
+
+        annotations = [anno for d in dataset_dicts for anno in d.get("annotations", [])]
+        self._instance_offsets = np.cumsum([0] + [len(d.get("annotations", [])) for d in dataset_dicts], dtype=np.int64)
+        self._bboxes = np.array([anno["bbox"] for anno in annotations], dtype=np.float64).reshape(-1, 4)
+        self._bbox_modes = np.array([int(anno["bbox_mode"]) for anno in annotations], dtype=np.int8)
+        self._categories = np.array([anno["category_id"] for anno in annotations], dtype=np.int32)
+
+        rles = [anno["segmentation"] if isinstance(anno["segmentation"], dict) else None for anno in annotations]
+        self._is_rle = np.array([rle is not None for rle in rles], dtype=bool)
+        self._rle_sizes = np.array([rle["size"] if rle else (0, 0) for rle in rles], dtype=np.int32).reshape(-1, 2)
+        counts = [rle["counts"] if rle else b"" for rle in rles]
+        counts = [c.encode() if isinstance(c, str) else bytes(c) for c in counts]
+        self._rle_counts = np.frombuffer(b"".join(counts), dtype=np.uint8)
+        self._rle_offsets = np.cumsum([0] + [len(c) for c in counts], dtype=np.int64)
+
+        segmentations = [[] if rle else anno["segmentation"] for anno, rle in zip(annotations, rles)]
+        polygons = [poly for segm in segmentations for poly in segm]
+        self._polygon_offsets = np.cumsum([0] + [len(segm) for segm in segmentations], dtype=np.int64)
+        self._vertex_offsets = np.cumsum([0] + [len(poly) for poly in polygons], dtype=np.int64)
+        self._vertices = np.fromiter((v for poly in polygons for v in poly), dtype=np.float64,
+                                     count=int(self._vertex_offsets[-1]))
+
+    def __len__(self):
+        return len(self._image_ids)
+
+    def _segmentation(self, i):
+        if self._is_rle[i]:
+            return {"size": self._rle_sizes[i].tolist(),
+                    "counts": self._rle_counts[self._rle_offsets[i]:self._rle_offsets[i + 1]].tobytes().decode()}
+        polygons = range(self._polygon_offsets[i], self._polygon_offsets[i + 1])
+        return [self._vertices[self._vertex_offsets[p]:self._vertex_offsets[p + 1]].tolist() for p in polygons]
+
+    def _annotation(self, i):
+        return {
+            "bbox": self._bboxes[i].tolist(),
+            "bbox_mode": BoxMode(int(self._bbox_modes[i])),
+            "segmentation": self._segmentation(i),
+            "category_id": int(self._categories[i]),
+        }
+
+    def __getitem__(self, idx):
+        name = self._names[self._name_offsets[idx]:self._name_offsets[idx + 1]].tobytes().decode()
+        instances = range(self._instance_offsets[idx], self._instance_offsets[idx + 1])
+        return {
+            "file_name": name,
+            "image_id": int(self._image_ids[idx]),
+            "height": int(self._heights[idx]),
+            "width": int(self._widths[idx]),
+            "annotations": [self._annotation(i) for i in instances],
+        }
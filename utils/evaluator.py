@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import itertools
+import numpy as np
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import detectron2.utils.comm as comm
+from detectron2.data import DatasetCatalog
+from detectron2.evaluation import DatasetEvaluator
+
+from utils.masks import mask_util
+from utils.polygons import mask_polygons, polygon_area
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+
+
+# IoU above which a proposal matches a building, as in the SpaceNet challenges
+IOU_THRESHOLD = 0.5
+
+_AOI = re.compile(r"AOI_\d+_[A-Za-z]+", re.IGNORECASE)
+
+
+def _require_shapely():
+    if shapely is None or not hasattr(shapely, "STRtree"):
+        raise ImportError("The SpaceNet evaluator needs shapely>=2.0, install it with `pip install shapely`")
+
+
+def _aoi(file_name):
+    match = _AOI.search(os.path.basename(file_name))
+    return match.group(0) if match else "unknown"
+
+
+def _mask_outlines(mask):
+    """
+    Outlines of a binary mask, shifted from the indices of its pixels to their centers, the
+    convention of the polygons of the dataset dicts.
+    """
+    return [polygon + 0.5 for polygon in mask_polygons(mask)]
+
+
+def _instance_outline(mask):
+    """
+    Outline of a predicted instance, the largest of its connected regions: a fragmented mask is
+    still a single proposal, like a building of a SpaceNet solution.
+    """
+    polygons = _mask_outlines(mask)
+    return max(polygons, key=lambda polygon: abs(polygon_area(polygon))) if polygons else None
+
+
+def _gt_polygons(record):
+    """Building outlines of a record in Detectron2 Dataset format, as (N, 2) arrays in pixels."""
+    polygons = []
+    for anno in record.get("annotations", []):
+        segm = anno["segmentation"]
+        if isinstance(segm, dict):
+            polygons.extend(_mask_outlines(mask_util.decode(segm)))
+        else:
+            polygons.extend(np.asarray(poly, dtype=np.float64).reshape(-1, 2) for poly in segm)
+    return [polygon for polygon in polygons if len(polygon) >= 3]
+
+
+def _geometries(polygons):
+    # every outline at once, rings are closed by shapely
+    coords = np.concatenate([np.asarray(p, dtype=np.float64) for p in polygons])
+    indices = np.repeat(np.arange(len(polygons)), [len(p) for p in polygons])
+    geometries = shapely.polygons(shapely.linearrings(coords, indices=indices))
+    # self-intersecting outlines are repaired instead of failing the intersections
+    invalid = ~shapely.is_valid(geometries)
+    if invalid.any():
+        geometries[invalid] = shapely.make_valid(geometries[invalid])
+    return geometries
+
+
+def match_buildings(proposals, buildings, iou_threshold=IOU_THRESHOLD):
+    """
+    One-to-one matching of the SpaceNet metric: proposals, by decreasing score, are matched to
+    the unmatched building they overlap the most, if their IoU is above the threshold.
+
+    Candidate pairs come from an STRtree of the buildings, queried for every proposal at once,
+    and their IoUs are computed in one vectorized call.
+
+    Args:
+        proposals (list[np.ndarray]): outlines of the proposals, sorted by decreasing score.
+        buildings (list[np.ndarray]): outlines of the buildings.
+        iou_threshold (float):
+
+    Returns:
+        tuple[int]: true positives, false positives and false negatives.
+    """
+    _require_shapely()
+    if not proposals or not buildings:
+        return 0, len(proposals), len(buildings)
+
+    proposals, buildings = _geometries(proposals), _geometries(buildings)
+    tree = shapely.STRtree(buildings)
+    pairs = tree.query(proposals, predicate="intersects")
+    if pairs.shape[1] == 0:
+        return 0, len(proposals), len(buildings)
+
+    p, b = pairs
+    intersections = shapely.area(shapely.intersection(proposals[p], buildings[b]))
+    unions = shapely.area(proposals)[p] + shapely.area(buildings)[b] - intersections
+    ious = np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+    keep = ious >= iou_threshold
+    p, b, ious = p[keep], b[keep], ious[keep]
+    # by proposal, then by decreasing IoU
+    order = np.lexsort((-ious, p))
+    matched = np.zeros(len(buildings), dtype=bool)
+    true_positives = 0
+    current = -1
+    for proposal, building in zip(p[order], b[order]):
+        if proposal == current or matched[building]:
+            continue
+        matched[building] = True
+        true_positives += 1
+        current = proposal
+    return true_positives, len(proposals) - true_positives, len(buildings) - true_positives
+
+
+def _match_images(images):
+    return [(aoi, match_buildings(proposals, buildings)) for aoi, proposals, buildings in images]
+
+
+def _f1(tp, fp, fn):
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+class SpacenetEvaluator(DatasetEvaluator):
+    """
+    Evaluate instance segmentation with the SpaceNet building metric: the F1 score of the one
+    to one matching of predicted and annotated building outlines at IoU >= 0.5, overall and for
+    each AOI. The outline of every predicted mask is extracted as images are processed, and
+    the matching runs over a pool of processes at the end.
+    """
+
+    def __init__(self, dataset_name, distributed=True, output_dir=None, workers=None, score_threshold=0.0):
+        """
+        Args:
+            dataset_name (str): name of the dataset to be evaluated.
+            distributed (bool): if True, will collect results from all ranks for evaluation.
+                Otherwise, will evaluate the results in the current process.
+            output_dir (str): an optional folder to dump the per-AOI counts to.
+            workers (int): number of processes of the matching, defaults to every core.
+            score_threshold (float): predictions scoring below it are not proposals.
+        """
+        _require_shapely()
+        self._dataset_name = dataset_name
+        self._distributed = distributed
+        self._output_dir = output_dir
+        self._workers = workers or os.cpu_count() or 1
+        self._score_threshold = score_threshold
+        self._records = None
+
+    def reset(self):
+        self._predictions = []
+
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            instances = output["instances"].to("cpu")
+            keep = instances.scores >= self._score_threshold
+            instances = instances[keep]
+            order = np.argsort(-instances.scores.numpy(), kind="stable")
+            masks = instances.pred_masks.numpy()[order] if instances.has("pred_masks") else []
+            outlines = (_instance_outline(mask) for mask in masks)
+            proposals = [outline for outline in outlines if outline is not None]
+            self._predictions.append((input["image_id"], input["file_name"], proposals))
+
+    def _buildings(self):
+        if self._records is None:
+            self._records = {record["image_id"]: record for record in DatasetCatalog.get(self._dataset_name)}
+        return self._records
+
+    def evaluate(self):
+        if self._distributed:
+            comm.synchronize()
+            predictions = comm.gather(self._predictions, dst=0)
+            predictions = list(itertools.chain(*predictions))
+            if not comm.is_main_process():
+                return {}
+        else:
+            predictions = self._predictions
+
+        records = self._buildings()
+        images = [(_aoi(file_name), proposals, _gt_polygons(records[image_id]))
+                  for image_id, file_name, proposals in predictions]
+
+        chunks = [images[i::self._workers] for i in range(self._workers)]
+        if self._workers == 1 or len(images) < 2 * self._workers:
+            matches = _match_images(images)
+        else:
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                matches = list(itertools.chain(*executor.map(_match_images, chunks)))
+
+        counts = defaultdict(lambda: np.zeros(3, dtype=np.int64))
+        for aoi, match in matches:
+            counts[aoi] += match
+            counts["all"] += match
+
+        results = OrderedDict()
+        for aoi in sorted(counts, key=lambda name: (name != "all", name)):
+            precision, recall, f1 = _f1(*counts[aoi])
+            suffix = "" if aoi == "all" else f"-{aoi}"
+            results[f"F1{suffix}"] = 100 * f1
+            results[f"precision{suffix}"] = 100 * precision
+            results[f"recall{suffix}"] = 100 * recall
+
+        if self._output_dir:
+            os.makedirs(self._output_dir, exist_ok=True)
+            with open(os.path.join(self._output_dir, "spacenet_evaluation.json"), "w") as f:
+                json.dump({aoi: dict(zip(["tp", "fp", "fn"], c.tolist())) for aoi, c in counts.items()}, f)
+
+        return OrderedDict(spacenet=results)
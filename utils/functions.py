@@ -2,10 +2,13 @@ import os
 import json
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 from tqdm import tqdm
 from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.metrics import metrics
+from utils.writers import image_extension, write_image
 
 
 def grab_certain_file(file_ext, folder_path):
@@ -38,17 +41,26 @@ def grab_certain_file(file_ext, folder_path):
 
     return file_list
 
-def normalize_array(array):
+def normalize_array(array, low=None, high=None, out=None):
     """Normalizes an array of values from [0, 1]
 
     :param array: A numpy array of values to be normalized
     :type array: numpy.array
 
+    :param low: Value mapped to 0, defaults to None which uses the minimum of :param:`array`
+    :type low: float
+
+    :param high: Value mapped to 1, defaults to None which uses the maximum of :param:`array`
+    :type high: float
+
+    :param out: float32 array of the same shape to write the result into, defaults to None which allocates one.
+    Passing :param:`array` itself normalizes a float32 array in place
+    :type out: numpy.array
 
     :raises TypeError: Raised when a function or operation is applied to an object of an incorrect type.
     :raises ValueError: Raised when a function gets an argument of correct type but improper value.
 
-    :return: Returns a numpy array  of values normalized to the range [0, 1]
+    :return: Returns a float32 numpy array of values normalized to the range [0, 1]
     :rtype: numpy.array
 
     .. note:: An empty numpy array will return an empty numpy array while an array full of the same values 
@@ -58,25 +70,210 @@ def normalize_array(array):
         if len(array) == 0:
             norm_array = []
         else:
-            norm_array = array.astype(float)
-            mat_min, mat_max = np.amin(norm_array), np.amax(norm_array)
-            if mat_min != mat_max:
-                for i in range(len(norm_array)):
-                    norm_array[i] = (norm_array[i] - mat_min) / (mat_max - mat_min)
-            elif  mat_min == mat_max == 0:
-                norm_array = array.astype(float)
+            mat_min = np.amin(array) if low is None else low
+            mat_max = np.amax(array) if high is None else high
+            norm_array = np.subtract(array, mat_min, out=out, dtype=np.float32)
+            if mat_min < mat_max:
+                np.divide(norm_array, mat_max - mat_min, out=norm_array)
+                np.clip(norm_array, 0, 1, out=norm_array)
             else:
-                for i in range(len(norm_array)):
-                    norm_array[i] = (norm_array[i] - mat_min) / (mat_min)        
-    
+                norm_array.fill(0)
+
     except ValueError as e:
         print("Error encountered: ", e)
         norm_array = array
-    
+
     return norm_array
 
-def tif_to_png(files, path_to_files, dst, normalize=False):
-    """Converts a list of tiff images into png images before saving them at a specified location 
+def to_uint8(arrays, normalize=False, low=None, high=None, out=None):
+    """Stacks the bands of a tile into an 8-bit image, stretching each band to [0, 255] if asked to
+
+    :param arrays: Bands of the tile, as read by GDAL
+    :type arrays: numpy.array of shape (bands, rows, cols)
+
+    :param normalize: Indicates whether the bands must be stretched to [0, 255], defaults to False
+    which only clips the values into the uint8 range
+    :type normalize: bool
+
+    :param low: Per band value mapped to 0, defaults to None which uses the minimum of each band of this tile
+    :type low: List or numpy.array
+
+    :param high: Per band value mapped to 255, defaults to None which uses the maximum of each band of this tile
+    :type high: List or numpy.array
+
+    :param out: uint8 array of shape (rows, cols, bands) to write the image into, defaults to None which allocates one
+    :type out: numpy.array
+
+    :return: Returns the 8-bit image
+    :rtype: numpy.array of shape (rows, cols, bands)
+
+    .. note:: Values are truncated, not rounded, to match the output of the previous matplotlib based conversion
+    """
+    num_bands, rows, cols = arrays.shape
+    if out is None:
+        out = np.empty((rows, cols, num_bands), dtype=np.uint8)
+
+    if not normalize:
+        if arrays.dtype == np.uint8:
+            np.copyto(out, arrays.transpose(1, 2, 0))
+        else:
+            np.copyto(out, np.clip(arrays, 0, 255).transpose(1, 2, 0), casting="unsafe")
+        return out
+
+    scratch = np.empty((rows, cols), dtype=np.float32)
+    for b in range(num_bands):
+        normalize_array(arrays[b], None if low is None else low[b], None if high is None else high[b], out=scratch)
+        # the maximum is exactly 1 and maps exactly to 255
+        np.multiply(scratch, 255, out=scratch)
+        out[..., b] = scratch
+
+    return out
+
+def _tile_statistics(file_path, histogram):
+    """Reads a single tiff image and gathers its per band statistics. Runs inside the worker processes of
+    :func:`band_statistics`
+
+    :param file_path: File path of the tiff image
+    :type file_path: str
+
+    :param histogram: Indicates whether a per band histogram of the values must be returned
+    :type histogram: bool
+
+    :return: Returns the per band minimums, maximums and histograms (None if not asked for), or the error message
+    :rtype: Tuple
+    """
+    try:
+        image = gdal.Open(file_path)
+        if image is None:
+            raise FileNotFoundError(f"GDAL could not open {file_path}")
+        arrays = image.ReadAsArray(band_list=[1, 2, 3])
+        mins = arrays.reshape(len(arrays), -1).min(axis=1)
+        maxs = arrays.reshape(len(arrays), -1).max(axis=1)
+        hists = None
+        if histogram:
+            if arrays.dtype.kind not in "ui":
+                raise ValueError(f"Percentile statistics need integer bands, got {arrays.dtype}")
+            hists = [np.bincount(band.ravel().clip(0)) for band in arrays]
+
+    except Exception as e:
+        return None, None, None, f"{type(e).__name__}: {e}"
+
+    return mins, maxs, hists, None
+
+def band_statistics(files, path_to_files, percentiles=None, workers=None):
+    """Makes one streaming pass over the tiff images of an AOI and gathers the per band values used to stretch
+    every tile of the AOI the same way. Only running minimums, maximums and histograms are kept in memory
+
+    :param files: List of the names of the tiff images
+    :type files: List
+
+    :param path_to_files: File path of the tiff images
+    :type path_to_files: str
+
+    :param percentiles: Lower and upper percentile to stretch between, Ex: (2, 98), defaults to None
+    which uses the minimum and maximum of the AOI
+    :type percentiles: Tuple
+
+    :param workers: Number of worker processes, defaults to None which uses every core. 1 reads in this process
+    :type workers: int
+
+    :raises ValueError: Raised when none of the images could be read.
+
+    :return: Returns the per band lower and upper values
+    :rtype: Tuple of numpy.array
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    low, high, hist = None, None, None
+
+    def accumulate(item, result):
+        nonlocal low, high, hist
+        mins, maxs, hists, error = result
+        if error is not None:
+            tqdm.write(f"Skipping {item} for the statistics: {error}")
+            return
+        low = mins if low is None else np.minimum(low, mins)
+        high = maxs if high is None else np.maximum(high, maxs)
+        if hists is not None:
+            if hist is None:
+                hist = [np.zeros(0, dtype=np.int64) for _ in hists]
+            for b, h in enumerate(hists):
+                if len(h) > len(hist[b]):
+                    hist[b] = np.pad(hist[b], (0, len(h) - len(hist[b])))
+                hist[b][:len(h)] += h
+
+    progress = tqdm(total=len(files), desc=f"Gathering band statistics of {path_to_files}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}")
+    if workers == 1:
+        for item in files:
+            accumulate(item, _tile_statistics(os.path.join(path_to_files, item), percentiles is not None))
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_tile_statistics, os.path.join(path_to_files, item), percentiles is not None): item
+                       for item in files}
+            for future in as_completed(futures):
+                accumulate(futures[future], future.result())
+                progress.update()
+    progress.close()
+
+    if low is None:
+        raise ValueError(f"None of the images in {path_to_files} could be read")
+
+    if percentiles is not None:
+        lower, upper = percentiles
+        low, high = np.empty(len(hist)), np.empty(len(hist))
+        for b, h in enumerate(hist):
+            cdf = np.cumsum(h) / h.sum()
+            low[b] = np.searchsorted(cdf, lower / 100)
+            high[b] = np.searchsorted(cdf, upper / 100)
+
+    return np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+
+def _convert_tile(file_path, dst_path, normalize, stats=None, fmt="png", compression=None):
+    """Converts a single tiff image into an 8-bit image. Runs inside the worker processes of :func:`tif_to_png`
+
+    :param file_path: File path of the tiff image
+    :type file_path: str
+
+    :param dst_path: File path that the converted image will be saved to
+    :type dst_path: str
+
+    :param normalize: Indicates whether the tiff image must be normalized
+    :type normalize: bool
+
+    :param stats: Per band lower and upper values to stretch between, defaults to None which uses those of the tile
+    :type stats: Tuple
+
+    :param fmt: Output format, see :data:`utils.writers.IMAGE_FORMATS`, defaults to "png"
+    :type fmt: str
+
+    :param compression: Compression level of the output format, defaults to None
+    :type compression: int
+
+    :return: Returns None on success, or the error message if the tile could not be converted
+    :rtype: str or None
+    """
+    try:
+        image = gdal.Open(file_path)
+        if image is None:
+            raise FileNotFoundError(f"GDAL could not open {file_path}")
+
+        # one read for all three bands, shaped (bands, rows, cols)
+        arrays = image.ReadAsArray(band_list=[1, 2, 3])
+        low, high = stats if stats is not None else (None, None)
+        image = to_uint8(arrays, normalize=normalize, low=low, high=high)
+        write_image(dst_path, image, fmt=fmt, compression=compression)
+
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+    return None
+
+def tif_to_png(files, path_to_files, dst, normalize=False, stats=None, workers=None, fmt="png", compression=None,
+               callback=None):
+    """Converts a list of tiff images into png images (or another format) before saving them at a specified location.
+    The tiles are spread across a pool of worker processes
 
     :param files: List of the names of the tiff images to be converted
     :type files: List
@@ -90,36 +287,184 @@ def tif_to_png(files, path_to_files, dst, normalize=False):
     :param normalize: Indicates whether the tiff image must be normalized, defaults to False
     :type normalize: bool
 
+    :param stats: Per band lower and upper values shared by every tile, as returned by :func:`band_statistics`,
+    defaults to None which stretches each tile by its own minimum and maximum
+    :type stats: Tuple
+
+    :param workers: Number of worker processes, defaults to None which uses every core. 1 converts in this process
+    :type workers: int
+
+    :param fmt: Output format, "png", "webp" (lossless) or "npy", defaults to "png"
+    :type fmt: str
+
+    :param compression: PNG compression level from 0 to 9, defaults to None which uses 1
+    :type compression: int
+
+    :param callback: Function called as callback(file name, error) as soon as each tile is done, defaults to None
+    :type callback: callable
+
     :raises FileNotFound: No such file or directory.
 
-    :return: Returns nothing, saves the converted png images at the indicated place
-    :rtype: None
-    
+    :return: Returns a dictionary mapping each file name to None if it was converted, or to the error message
+    if it failed. The png images are saved at the indicated place
+    :rtype: dict
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    extension = image_extension(fmt)
+    results = {}
+    progress = tqdm(total=len(files), desc=f"Converting TIF images to {fmt.upper()} to {dst}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}")
+
+    if workers == 1:
+        for item in files:
+            results[item] = _convert_tile(os.path.join(path_to_files, item),
+                                          os.path.join(dst, item.replace(".tif", extension)),
+                                          normalize, stats, fmt, compression)
+            if callback is not None:
+                callback(item, results[item])
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_convert_tile,
+                                       os.path.join(path_to_files, item),
+                                       os.path.join(dst, item.replace(".tif", extension)),
+                                       normalize, stats, fmt, compression): item for item in files}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if callback is not None:
+                    callback(futures[future], results[futures[future]])
+                progress.update()
+    progress.close()
+
+    # keep the order of the input list
+    results = {item: results[item] for item in files}
+    for item, error in results.items():
+        if error is not None:
+            tqdm.write(f"Failed to convert {item}: {error}")
+
+    return results
+
+
+def parse_wkt_polygons(literals, exterior_only=False):
+    """Parses SpaceNet ``PolygonWKT_Pix`` strings into rounded pixel coordinates, all at once.
+    Every string is split and converted in bulk, only the final slicing is done per polygon.
+    Rings of a polygon are chained together, as in the original annotations, unless :param:`exterior_only` is set
+
+    :param literals: WKT strings, Ex: "POLYGON ((103.4 2.2 0,109.1 8.6 0,103.4 2.2 0))"
+    :type literals: List or pandas.Series
+
+    :param exterior_only: Keep only the exterior ring of each polygon instead of chaining its holes to it, defaults to False
+    :type exterior_only: bool
+
+    :raises ValueError: Raised when a coordinate cannot be converted to a number.
+
+    :return: Returns, for each string, a tuple of the x and y coordinates as Lists of int, or None for "EMPTY" polygons
+    :rtype: List
+    """
+    literals = pd.Series(literals, dtype=object).reset_index(drop=True)
+    parsed = [None] * len(literals)
+
+    empty = literals.str.contains("EMPTY", regex=False).to_numpy()
+    bodies = literals[~empty]
+    metrics.increment("polygons_parsed", len(bodies))
+    if len(bodies) == 0:
+        return parsed
+
+    if exterior_only:
+        bodies = bodies.str.split("((", regex=False).str[1].str.split("),(", regex=False).str[0].str.rstrip(")")
+    else:
+        bodies = bodies.str.replace("),(", ",", regex=False).str.split("((", regex=False).str[1].str[:-2]
+    num_points = bodies.str.count(",").to_numpy() + 1
+    num_values = bodies.str.count(" ").to_numpy() + num_points
+    values = np.array(",".join(bodies).replace(",", " ").split(" "), dtype=np.float64)
+    # round half to even, like the built-in round
+    values = np.rint(values).astype(np.int64)
+
+    ends = np.cumsum(num_values)
+    starts = ends - num_values
+    for index, start, end, points in zip(bodies.index, starts, ends, num_points):
+        coords = values[start:end].reshape(points, -1)
+        parsed[index] = (coords[:, 0].tolist(), coords[:, 1].tolist())
+
+    return parsed
+
+def _regions(polygons):
+    """Builds the regions of one image from its parsed polygons
+
+    :param polygons: Polygons of the image as returned by :func:`parse_wkt_polygons`
+    :type polygons: List
+
+    :return: Returns the regions, keyed by the index of the polygon. An image with an "EMPTY" polygon has no regions
+    :rtype: dict
     """
+    regions = {}
+    for i, polygon in enumerate(polygons):
+        if polygon is None:
+            return {}
+
+        all_points_x, all_points_y = polygon
+        regions[str(i)] = {"shape_attributes":
+                               {"name": "polygon",
+                                "all_points_x": all_points_x,
+                                "all_points_y": all_points_y,
+                                "category": 0
+                               },
+                           "region_attributes": {}
+                          }
+    return regions
+
+def _image_dimensions(file_path):
+    """Reads the width and height of a tiff image from its header, without reading its pixels
+
+    :param file_path: File path of the tiff image
+    :type file_path: str
 
-    for item in tqdm(files, desc = f"Converting TIF images to PNG to {dst}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}"):
-        file_path = os.path.join(path_to_files, item)
-        dst_path = os.path.join(dst, item.replace(".tif", ".png"))
-        image = gdal.Open(file_path)
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the width and height of the image
+    :rtype: Tuple
+    """
+    image = gdal.Open(file_path)
+    if image is None:
+        raise FileNotFoundError(f"GDAL could not open {file_path}")
+    return image.RasterXSize, image.RasterYSize
 
-        band1 = image.GetRasterBand(1)
-        band2 = image.GetRasterBand(2)
-        band3 = image.GetRasterBand(3)
+def _image_entry(file, file_path, regions, dimensions=None):
+    """Builds the JSON entry of one image. The width and height of the image are kept in its file attributes,
+    so that the dataset can be registered without decoding the images
 
-        array1 = band1.ReadAsArray()
-        array2 = band2.ReadAsArray()
-        array3 = band3.ReadAsArray()
+    :param file: Name of the tiff image
+    :type file: str
 
-        if normalize:
-            array1 = normalize_array(array1)
-            array2 = normalize_array(array2)
-            array3 = normalize_array(array3)
+    :param file_path: File path of the tiff image
+    :type file_path: str
 
-        image = np.dstack((array1, array2, array3))
-        plt.imsave(dst_path, image)
+    :param regions: Regions of the image, as returned by :func:`_regions`
+    :type regions: dict
 
+    :param dimensions: Width and height of the image, defaults to None which reads them from the tiff header
+    :type dimensions: Tuple
 
-def detectron_json(files, path_to_files, csv, num_dataset, train_val):
+    :return: Returns the entry of the image
+    :rtype: dict
+    """
+    width, height = _image_dimensions(file_path) if dimensions is None else dimensions
+    return {"file_ref": '',
+            "size": os.path.getsize(file_path),
+            "filename": file.replace(".tif", ".png"),
+            "base64_img_data": '',
+            "file_attributes": {"width": width, "height": height},
+            "regions": regions
+           }
+
+def _image_id(file, num_dataset):
+    """Returns the ImageId of the csv annotations of a tiff image, Ex: "AOI_2_Vegas_img123" """
+    img_num = file.split(".")[0]
+    img_id = img_num.split("img")[1]
+    return f"AOI_{num_dataset}_img{img_id}"
+
+def detectron_json(files, path_to_files, csv, num_dataset, train_val, exterior_only=False):
     """Creates JSON files for Detectron2 from SpaceNet images and their associated csv annotations
 
     :param files: List of file names that are represented by the SpaceNet csv file
@@ -137,6 +482,9 @@ def detectron_json(files, path_to_files, csv, num_dataset, train_val):
     :param train_val: String indicating whether the images being converted are training or validation images
     :type train_val: str
 
+    :param exterior_only: Keep only the exterior ring of each polygon, see :func:`parse_wkt_polygons`, defaults to False
+    :type exterior_only: bool
+
     :raises TypeError: Raised when a function or operation is applied to an object of an incorrect type.
     :raises ValueError: Raised when a function gets an argument of correct type but improper value.
     :raises FileNotFound: No such file or directory.
@@ -147,55 +495,252 @@ def detectron_json(files, path_to_files, csv, num_dataset, train_val):
     """
     files_dict = {}
 
+    # Image ID of each file
+    image_ids = {file: _image_id(file, num_dataset) for file in files}
+
+    # One pass over the csv: keep the rows of these images, parse their polygons and index them by ImageId
+    rows = csv[csv["ImageId"].isin(set(image_ids.values()))]
+    polygons = parse_wkt_polygons(rows["PolygonWKT_Pix"], exterior_only)
+    buildings_of = rows.groupby("ImageId", sort=False).indices
+
     for file in tqdm(files, desc=f"Creating JSONs for Detectron2 on {num_dataset}_{train_val}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}", position=0, leave=True):
         file_path = os.path.join(path_to_files, file)
 
-        # Image ID
-        img_num = file.split(".")[0]
-        img_id = img_num.split("img")[1]
-        ImageId = f"AOI_{num_dataset}_img{img_id}"
-
         # Annotations
-        buildings = csv[csv["ImageId"] == ImageId]["PolygonWKT_Pix"]
-        regions = {}
-        for i in range(len(buildings)):
-            dataf = buildings.to_frame()
-            row = dataf.iloc[i]
-            literal = row.factorize()[1][0]
-
-            if "EMPTY" in literal:
-                regions = {}
-                break
-            if "),(" in literal:
-                literal = literal.replace("),(", ",")
-
-            tup = literal.split("((")[1]
-            tup = tup[:-2]
-            strlist = tup.split(",")
-            all_points_x, all_points_y = [], []
-            for j in range(len(strlist)):
-                split = strlist[j].split(" ")
-                all_points_x.append(round(float(split[0])))
-                all_points_y.append(round(float(split[1])))
-            regions[str(i)] = {"shape_attributes":
-                                   {"name": "polygon",
-                                    "all_points_x": all_points_x,
-                                    "all_points_y": all_points_y,
-                                    "category": 0
-                                   },
-                               "region_attributes": {}
-                              }
+        buildings = buildings_of.get(image_ids[file], [])
+        regions = _regions([polygons[row] for row in buildings])
 
         # complete dictionary
-        dictionary = {"file_ref": '',
-                      "size": os.path.getsize(file_path),
-                      "filename": file.replace(".tif", ".png"),
-                      "base64_img_data": '',
-                      "file_attributes": {},
-                      "regions": regions
-                 }
+        files_dict[file.replace(".tif", ".png")] = _image_entry(file, file_path, regions)
+
+    with open(f"Spacenet/{train_val}/AOI_{num_dataset}_region_data.json", "w") as f:
+        json.dump(files_dict, f)
+
+
+def _geojson_regions(file_path, geojson_path):
+    """Builds the regions of one tiff image from its geojson annotations. Runs inside the worker processes of
+    :func:`geojson_json`
+
+    :param file_path: File path of the tiff image
+    :type file_path: str
+
+    :param geojson_path: File path of the geojson annotations of the image
+    :type geojson_path: str
+
+    :return: Returns the regions, the width and height of the image and None, or None, None and the error message
+    :rtype: Tuple
+    """
+    try:
+        with open(geojson_path) as f:
+            features = json.load(f)["features"]
+
+        # the header, with the dimensions and the geotransform, is read once per tile
+        gdal_image = gdal.Open(file_path)
+        if gdal_image is None:
+            raise FileNotFoundError(f"GDAL could not open {file_path}")
+        dimensions = (gdal_image.RasterXSize, gdal_image.RasterYSize)
+
+        polygons = []
+        if len(features) > 0:
+            originX, pixel_width, _, originY, _, pixel_height = gdal_image.GetGeoTransform()
+            origin = np.array([originX, originY])
+            pixel_size = np.array([pixel_width, pixel_height])
+
+            for feature in features:
+                points = feature["geometry"]["coordinates"][0]
+                if len(points) == 1:
+                    points = points[0]
+
+                # all vertices of the building at once, rounded half to even like the built-in round
+                coords = np.asarray([point[:2] for point in points], dtype=np.float64)
+                pixels = np.rint((coords - origin) / pixel_size).astype(np.int64).reshape(-1, 2)
+                polygons.append((pixels[:, 0].tolist(), pixels[:, 1].tolist()))
+
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+    return _regions(polygons), dimensions, None
+
+def geojson_json(files, path_to_files, geojson_paths, num_dataset, train_val, workers=None):
+    """Creates JSON files for Detectron2 from SpaceNet images annotated with one geojson file per image,
+    as the Rio de Janeiro images are. The geojson files are parsed across a pool of worker processes
+
+    :param files: List of the names of the tiff images
+    :type files: List
+
+    :param path_to_files: File path to where the tiff images are
+    :type path_to_files: str
+
+    :param geojson_paths: List of the geojson file paths, one for each file of :param:`files`
+    :type geojson_paths: List
+
+    :param num_dataset: Number and name of the SpaceNet dataset the data belongs to, Ex: "1_Rio"
+    :type num_dataset: str
+
+    :param train_val: String indicating whether the images being converted are training or validation images
+    :type train_val: str
 
-        files_dict[file.replace(".tif", ".png")] = dictionary
+    :param workers: Number of worker processes, defaults to None which uses every core. 1 parses in this process
+    :type workers: int
+
+    :raises ValueError: Raised when the annotations of an image could not be read.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns nothing, creates a JSON file within the folder the SpaceNet images are located
+    :rtype: None
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    results = {}
+    progress = tqdm(total=len(files), desc=f"Creating JSONs for Detectron2 on {num_dataset}_{train_val}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}")
+    if workers == 1:
+        for file, geojson_path in zip(files, geojson_paths):
+            results[file] = _geojson_regions(os.path.join(path_to_files, file), geojson_path)
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_geojson_regions, os.path.join(path_to_files, file), geojson_path): file
+                       for file, geojson_path in zip(files, geojson_paths)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                progress.update()
+    progress.close()
+
+    files_dict = {}
+    for file in files:
+        regions, dimensions, error = results[file]
+        if error is not None:
+            raise ValueError(f"Could not read the annotations of {file}: {error}")
+        files_dict[file.replace(".tif", ".png")] = _image_entry(file, os.path.join(path_to_files, file), regions, dimensions)
+        metrics.increment("polygons_parsed", len(regions))
 
     with open(f"Spacenet/{train_val}/AOI_{num_dataset}_region_data.json", "w") as f:
-        json.dump(files_dict, f)
\ No newline at end of file
+        json.dump(files_dict, f)
+
+def detectron_json_stream(splits, path_to_files, csv_path, num_dataset, chunksize=100000, exterior_only=False):
+    """Creates the JSON files for Detectron2 of several splits of an AOI in a single streaming pass over its csv.
+    The csv is read in chunks, each row is routed to the split of its image, and the images are written to
+    their JSON file as soon as all of their rows have been read, so memory does not grow with the size of the csv.
+    The rows of an image must be contiguous in the csv, as they are in the SpaceNet csv files
+
+    :param splits: Dictionary mapping "train" and/or "val" to the list of file names of that split
+    :type splits: dict
+
+    :param path_to_files: File path to where the images represented by the SpaceNet csv file are
+    :type path_to_files: str
+
+    :param csv_path: File path of the SpaceNet annotation csv
+    :type csv_path: str
+
+    :param num_dataset: Number indicating which SpaceNet dataset the data belongs to. This should be represented in the image names as well
+    :type num_dataset: str
+
+    :param chunksize: Number of csv rows read at a time, defaults to 100000
+    :type chunksize: int
+
+    :param exterior_only: Keep only the exterior ring of each polygon, see :func:`parse_wkt_polygons`, defaults to False
+    :type exterior_only: bool
+
+    :raises ValueError: Raised when the rows of an image are not contiguous in the csv.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns nothing, creates one JSON file per split, identical to those of :func:`detectron_json`
+    except for the order of the images
+    :rtype: None
+    """
+    split_of, file_of = {}, {}
+    for train_val, files in splits.items():
+        for file in files:
+            image_id = _image_id(file, num_dataset)
+            split_of[image_id] = train_val
+            file_of[image_id] = file
+
+    # written to temporary files, only moved in place once complete, so that a failed run never
+    # leaves a truncated JSON file that still parses
+    paths = {train_val: f"Spacenet/{train_val}/AOI_{num_dataset}_region_data.json" for train_val in splits}
+    outputs = {train_val: open(f"{path}.tmp", "w") for train_val, path in paths.items()}
+    written = {train_val: 0 for train_val in splits}
+
+    def write(image_id, polygons):
+        train_val, file = split_of[image_id], file_of[image_id]
+        f = outputs[train_val]
+        f.write("{" if written[train_val] == 0 else ", ")
+        f.write(json.dumps(file.replace(".tif", ".png")) + ": ")
+        f.write(json.dumps(_image_entry(file, os.path.join(path_to_files, file), _regions(polygons))))
+        written[train_val] += 1
+        progress.update()
+
+    done = set()
+    pending_id, pending = None, []
+    progress = tqdm(total=len(split_of), desc=f"Creating JSONs for Detectron2 on {num_dataset}_{'_'.join(splits)}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}")
+    try:
+        for chunk in pd.read_csv(csv_path, usecols=["ImageId", "PolygonWKT_Pix"], chunksize=chunksize):
+            chunk = chunk[chunk["ImageId"].isin(split_of)]
+            if len(chunk) == 0:
+                continue
+            polygons = parse_wkt_polygons(chunk["PolygonWKT_Pix"], exterior_only)
+            for image_id, polygon in zip(chunk["ImageId"].tolist(), polygons):
+                if image_id != pending_id:
+                    if pending_id is not None:
+                        write(pending_id, pending)
+                        done.add(pending_id)
+                    if image_id in done:
+                        raise ValueError(f"The rows of {image_id} are not contiguous in {csv_path}, "
+                                         "use detectron_json to load the whole csv instead")
+                    pending_id, pending = image_id, []
+                pending.append(polygon)
+
+        if pending_id is not None:
+            write(pending_id, pending)
+            done.add(pending_id)
+
+        # images without any row in the csv
+        for image_id in split_of:
+            if image_id not in done:
+                write(image_id, [])
+
+    except BaseException:
+        for f in outputs.values():
+            f.close()
+            os.remove(f.name)
+        raise
+
+    finally:
+        progress.close()
+
+    for train_val, f in outputs.items():
+        f.write("}" if written[train_val] else "{}")
+        f.close()
+        os.replace(f.name, paths[train_val])
+
+def merge_region_jsons(jsons, dst):
+    """Merges the region JSON files of several AOIs into one JSON file. The files are concatenated as text,
+    without being parsed, which gives the same file as loading and dumping them again
+
+    :param jsons: List of the JSON files to be merged, in order
+    :type jsons: List
+
+    :param dst: File path of the merged JSON file
+    :type dst: str
+
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns nothing, creates the merged JSON file
+    :rtype: None
+    """
+    with open(dst, "w") as out:
+        out.write("{")
+        first = True
+        for file in jsons:
+            with open(file, "r") as f:
+                content = f.read().strip()
+            # content of the object without its braces
+            content = content[1:-1].strip()
+            if not content:
+                continue
+            if not first:
+                out.write(", ")
+            out.write(content)
+            first = False
+        out.write("}")
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+
+from detectron2.engine import HookBase
+
+from utils.metrics import peak_rss_mb
+
+
+class StepTimingHook(HookBase):
+    """
+    Splits the time of every training iteration into the time spent waiting for the data loader and
+    the compute time of the model, forward, backward and optimizer step. The data time is the one
+    the trainer measures itself, the compute time is the rest of the iteration.
+
+    The compute time is added to the event storage next to "data_time", and every `period` iterations
+    the means over the period are written to the metrics file.
+
+    Register it first, so that the iteration it times does not include the other hooks, Ex: the
+    evaluation or the checkpoints.
+    """
+
+    def __init__(self, metrics, period=20, images_per_batch=None):
+        """
+        Args:
+            metrics (Metrics): where the timings are recorded.
+            period (int): iterations between two lines of the metrics file.
+            images_per_batch (int): to report the training throughput in images per second.
+        """
+        self._metrics = metrics
+        self._period = period
+        self._images_per_batch = images_per_batch
+        self._window = []
+
+    def before_step(self):
+        self._start = time.perf_counter()
+
+    def after_step(self):
+        total = time.perf_counter() - self._start
+        data = self.trainer.storage.latest().get("data_time")
+        # only written by the main process, and not at every iteration by every trainer
+        data_time = data[0] if data is not None and data[1] == self.trainer.iter else 0.0
+        compute_time = max(total - data_time, 0.0)
+        self.trainer.storage.put_scalar("compute_time", compute_time)
+
+        images = self._images_per_batch or 0
+        self._metrics.add_time("train/data_wait", data_time)
+        self._metrics.add_time("train/compute", compute_time, images)
+        self._window.append((data_time, compute_time))
+        if len(self._window) >= self._period:
+            self._write()
+
+    def after_train(self):
+        if self._window:
+            self._write()
+
+    def _write(self):
+        data_time, compute_time = np.mean(self._window, axis=0)
+        total = data_time + compute_time
+        self._metrics.emit(
+            "train",
+            iteration=self.trainer.iter,
+            data_time=float(data_time),
+            compute_time=float(compute_time),
+            data_wait_fraction=float(data_time / total) if total > 0 else 0.0,
+            images_per_second=self._images_per_batch / total if self._images_per_batch and total > 0 else None,
+            peak_rss_mb=peak_rss_mb(),
+        )
+        self._window = []
+
+
+class ImageCacheHook(HookBase):
+    """
+    Every `period` iterations, adds the hit rate of the image cache of the training mapper to the
+    event storage, and its hits, misses and evictions to the metrics.
+    """
+
+    def __init__(self, cache, metrics=None, period=20):
+        """
+        Args:
+            cache (SharedImageCache):
+            metrics (Metrics): where the counts are recorded, in addition to the event storage.
+            period (int):
+        """
+        self._cache = cache
+        self._metrics = metrics
+        self._period = period
+
+    def after_step(self):
+        if (self.trainer.iter + 1) % self._period != 0:
+            return
+        stats = self._cache.stats()
+        self.trainer.storage.put_scalars(
+            image_cache_hit_rate=stats["hit_rate"],
+            image_cache_images=stats["images"],
+            smoothing_hint=False,
+        )
+        if self._metrics is not None:
+            for name in ("hits", "misses", "evictions", "images", "bytes"):
+                self._metrics.set(f"image_cache_{name}", stats[name])
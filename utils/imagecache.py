@@ -0,0 +1,201 @@
+import os
+import atexit
+import hashlib
+import logging
+import multiprocessing as mp
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+# Size of a 650 x 650 RGB SpaceNet tile, larger images are not cached
+DEFAULT_SLOT_SIZE = 650 * 650 * 3
+
+# States of a slot
+EMPTY, WRITING, READY = 0, 1, 2
+
+_SLOT = np.dtype([("key", "<i8"), ("last_used", "<i8"), ("state", "<i4"), ("pins", "<i4"),
+                  ("rows", "<i4"), ("cols", "<i4"), ("bands", "<i4"), ("pad", "<i4")])
+
+# tick of the LRU clock, hits, misses and evictions, shared by every process
+_COUNTERS = 4
+_TICK, _HITS, _MISSES, _EVICTIONS = range(_COUNTERS)
+
+logger = logging.getLogger(__name__)
+
+
+def _key(name):
+    # stable across processes, unlike hash() of a string
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+def _shm_available():
+    try:
+        stats = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+    return stats.f_bavail * stats.f_frsize
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded uint8 images in shared memory, shared by the dataloader workers.
+
+    The block is an arena of fixed-size slots, as many as fit in the byte budget, after a header
+    with the key, shape, state and last use of every slot and the shared counters. The header is
+    only changed under a lock. Images are copied out of their slot, so that augmentations never
+    see a slot another worker is overwriting, and a slot is not evicted while it is being read.
+
+    The process that creates the cache owns the block and removes it at exit. Workers attach to
+    it by name when the cache is pickled to them, forked workers inherit the mapping.
+    """
+
+    def __init__(self, capacity, slot_size=DEFAULT_SLOT_SIZE):
+        """
+        Args:
+            capacity (int): byte budget of the images.
+            slot_size (int): bytes of a slot, the size of the largest image that can be cached.
+        """
+        available = _shm_available()
+        if available is not None and capacity > available // 2:
+            # a block larger than /dev/shm is only a bus error on the first write past its end,
+            # and the dataloader needs shared memory too
+            logger.warning(
+                "The image cache of {} MB does not fit in /dev/shm, reduced to {} MB".format(
+                    capacity >> 20, (available // 2) >> 20
+                )
+            )
+            capacity = available // 2
+        self.num_slots = capacity // slot_size
+        if self.num_slots < 1:
+            raise ValueError(f"A budget of {capacity} bytes does not hold a single image of {slot_size} bytes")
+        self.slot_size = slot_size
+        self._lock = mp.Lock()
+        self._owner = True
+        # the arena starts on a cache line
+        self._arena_offset = -(-(_COUNTERS * 8 + self.num_slots * _SLOT.itemsize) // 64) * 64
+        self._attach(shared_memory.SharedMemory(create=True, size=self._arena_offset + self.num_slots * slot_size))
+        atexit.register(self.close)
+
+    def _attach(self, shm):
+        self._shm = shm
+        # a new block is filled with zeros: every slot is EMPTY and the counters are 0
+        self._counters = np.ndarray(_COUNTERS, dtype=np.int64, buffer=shm.buf)
+        self._slots = np.ndarray(self.num_slots, dtype=_SLOT, buffer=shm.buf, offset=_COUNTERS * 8)
+
+    def _image(self, slot, shape):
+        offset = self._arena_offset + slot * self.slot_size
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf, offset=offset)
+
+    def _find(self, key):
+        slots = np.flatnonzero((self._slots["key"] == key) & (self._slots["state"] == READY))
+        return int(slots[0]) if len(slots) else None
+
+    def get(self, name):
+        """
+        Args:
+            name (str): key of the image, Ex: its file name.
+
+        Returns:
+            np.ndarray or None: a copy of the cached image, None if it is not cached.
+        """
+        key = _key(name)
+        with self._lock:
+            slot = self._find(key)
+            if slot is None:
+                self._counters[_MISSES] += 1
+                return None
+            self._counters[_HITS] += 1
+            self._counters[_TICK] += 1
+            entry = self._slots[slot]
+            entry["last_used"] = self._counters[_TICK]
+            entry["pins"] += 1
+            shape = (int(entry["rows"]), int(entry["cols"]), int(entry["bands"]))
+        try:
+            return self._image(slot, shape).copy()
+        finally:
+            with self._lock:
+                self._slots[slot]["pins"] -= 1
+
+    def put(self, name, image):
+        """
+        Caches an image, in place of the least recently used one if the cache is full.
+
+        Args:
+            name (str): key of the image.
+            image (np.ndarray): uint8 image of shape (H, W, C).
+
+        Returns:
+            bool: whether the image was cached. Images larger than a slot are not, nor those
+            already cached or being cached by another worker.
+        """
+        if image.dtype != np.uint8 or image.ndim != 3 or image.nbytes > self.slot_size:
+            return False
+        key = _key(name)
+        with self._lock:
+            if np.any((self._slots["key"] == key) & (self._slots["state"] != EMPTY)):
+                return False
+            free = np.flatnonzero(self._slots["state"] == EMPTY)
+            if len(free):
+                slot = int(free[0])
+            else:
+                candidates = np.flatnonzero((self._slots["state"] == READY) & (self._slots["pins"] == 0))
+                if len(candidates) == 0:
+                    return False
+                slot = int(candidates[np.argmin(self._slots["last_used"][candidates])])
+                self._counters[_EVICTIONS] += 1
+            entry = self._slots[slot]
+            entry["key"] = key
+            entry["state"] = WRITING
+            entry["rows"], entry["cols"], entry["bands"] = image.shape
+
+        self._image(slot, image.shape)[...] = image
+
+        with self._lock:
+            self._counters[_TICK] += 1
+            entry = self._slots[slot]
+            entry["last_used"] = self._counters[_TICK]
+            entry["state"] = READY
+        return True
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, evictions and hit rate since the cache was created, by every
+            process, and the number of cached images and their bytes.
+        """
+        with self._lock:
+            hits, misses, evictions = (int(self._counters[i]) for i in (_HITS, _MISSES, _EVICTIONS))
+            ready = self._slots[self._slots["state"] == READY]
+        used = ready["rows"].astype(np.int64) * ready["cols"] * ready["bands"]
+        return {"hits": hits,
+                "misses": misses,
+                "evictions": evictions,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "images": len(ready),
+                "bytes": int(used.sum()),
+                "capacity": self.num_slots}
+
+    def __getstate__(self):
+        # workers attach to the block by name, only the owner removes it
+        state = self.__dict__.copy()
+        state["_name"] = self._shm.name
+        state["_owner"] = False
+        for name in ("_shm", "_counters", "_slots"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("_name")
+        self.__dict__.update(state)
+        self._attach(shared_memory.SharedMemory(name=name))
+
+    def close(self):
+        if self._shm is None:
+            return
+        # views of the block must be released before it is closed
+        self._counters = self._slots = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
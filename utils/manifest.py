@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+
+
+def _sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path, hash_file=False):
+    """
+    Args:
+        path (str): a source file.
+        hash_file (bool): also hash its content.
+
+    Returns:
+        dict: its size, mtime and, if `hash_file`, its sha1.
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if hash_file:
+        fingerprint["sha1"] = _sha1(path)
+    return fingerprint
+
+
+def fingerprint_matches(path, recorded, hash_files=True):
+    """
+    Args:
+        path (str): a source file.
+        recorded (dict): its fingerprint, as returned by :func:`file_fingerprint`. Its mtime is
+            updated when the file was only touched.
+        hash_files (bool): compare the content when the mtime changed, if it was hashed.
+
+    Returns:
+        bool: True if the file exists and did not change since it was fingerprinted.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if stat.st_size == recorded["size"] and stat.st_mtime_ns == recorded["mtime"]:
+        return True
+    # the file was touched or copied, compare the content if it was hashed
+    if hash_files and "sha1" in recorded and stat.st_size == recorded["size"]:
+        if _sha1(path) == recorded["sha1"]:
+            recorded["mtime"] = stat.st_mtime_ns
+            return True
+    return False
+
+
+class BuildManifest:
+    """
+    Records, for every output of a dataset build, the source files it was made from (size, mtime and
+    optionally a hash) and the parameters it was made with, so that a rerun only rebuilds the outputs
+    whose sources or parameters changed, or which are missing.
+
+    The manifest is a JSON file of the form::
+
+        {"entries": {key: {"sources": {path: {"size": ..., "mtime": ..., "sha1": ...}},
+                           "outputs": [path, ...],
+                           "params": {...},
+                           "data": ...}}}
+    """
+
+    def __init__(self, path, hash_files=False, autosave=500):
+        """
+        Args:
+            path (str): file the manifest is loaded from and saved to.
+            hash_files (bool): also hash the sources. A source whose size or mtime changed
+                but whose content did not is then still considered unchanged.
+            autosave (int): save the manifest every `autosave` records, so that an
+                interrupted build resumes where it stopped.
+        """
+        self.path = path
+        self.hash_files = hash_files
+        self.autosave = autosave
+        self._unsaved = 0
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f).get("entries", {})
+
+    def fingerprint(self, path):
+        """
+        Args:
+            path (str): a source file.
+
+        Returns:
+            dict: its size, mtime and, if the manifest hashes files, its sha1.
+        """
+        return file_fingerprint(path, self.hash_files)
+
+    def _source_unchanged(self, path, recorded):
+        return fingerprint_matches(path, recorded, self.hash_files)
+
+    def is_current(self, key, sources, params=None):
+        """
+        Args:
+            key (str): name of the output, usually its path.
+            sources (list[str]): the files the output is made from.
+            params (dict): the parameters the output is made with.
+
+        Returns:
+            bool: True if the output was recorded with the same sources and parameters,
+            none of the sources changed since and all of its outputs still exist.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.get("params") != params:
+            return False
+        if set(entry["sources"]) != set(sources):
+            return False
+        if not all(os.path.exists(output) for output in entry["outputs"]):
+            return False
+        return all(self._source_unchanged(path, entry["sources"][path]) for path in sources)
+
+    def record(self, key, sources, outputs, params=None, data=None):
+        """
+        Records that `outputs` were built from `sources` with `params`.
+
+        Args:
+            key (str): name of the output, usually its path.
+            sources (list[str]): the files the output is made from.
+            outputs (list[str]): the files that were written.
+            params (dict): the parameters the output is made with.
+            data: any JSON serializable value to keep with the entry, see :meth:`data`.
+        """
+        self.entries[key] = {
+            "sources": {path: self.fingerprint(path) for path in sources},
+            "outputs": list(outputs),
+            "params": params,
+            "data": data,
+        }
+        self._unsaved += 1
+        if self.autosave and self._unsaved >= self.autosave:
+            self.save()
+
+    def data(self, key):
+        """
+        Returns:
+            the value recorded with `data` for `key`, or None.
+        """
+        entry = self.entries.get(key)
+        return None if entry is None else entry.get("data")
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+
+    def save(self):
+        """
+        Writes the manifest atomically, an interrupted save never leaves a truncated manifest.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
@@ -0,0 +1,118 @@
+import os
+import copy
+import torch
+import numpy as np
+
+from detectron2.data import DatasetMapper
+from detectron2.data import detection_utils
+from detectron2.data import transforms as T
+
+from utils.tilestore import TileStore
+from utils.writers import read_image
+
+
+class SpacenetDatasetMapper(DatasetMapper):
+    """
+    The default :class:`DatasetMapper`, except that images are loaded through :meth:`read_image`.
+    By default it reads any of the formats of :mod:`utils.writers` (png, webp or npy),
+    subclasses override :meth:`read_image` to load images from somewhere else.
+    """
+
+    def read_image(self, dataset_dict):
+        """
+        Args:
+            dataset_dict (dict): metadata of one image, in Detectron2 Dataset format.
+
+        Returns:
+            np.ndarray: the image of shape (H, W, C) in ``self.image_format``.
+        """
+        return read_image(dataset_dict["file_name"], format=self.image_format)
+
+    def __call__(self, dataset_dict):
+        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        image = self.read_image(dataset_dict)
+        detection_utils.check_image_size(dataset_dict, image)
+
+        if "sem_seg_file_name" in dataset_dict:
+            sem_seg_gt = detection_utils.read_image(dataset_dict.pop("sem_seg_file_name"), "L").squeeze(2)
+        else:
+            sem_seg_gt = None
+
+        aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
+        transforms = self.augmentations(aug_input)
+        image, sem_seg_gt = aug_input.image, aug_input.sem_seg
+
+        image_shape = image.shape[:2]  # h, w
+        # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
+        # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
+        # Therefore it's important to use torch.Tensor.
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        if sem_seg_gt is not None:
+            dataset_dict["sem_seg"] = torch.as_tensor(sem_seg_gt.astype("long"))
+
+        if self.proposal_topk is not None:
+            detection_utils.transform_proposals(
+                dataset_dict, image_shape, transforms, proposal_topk=self.proposal_topk
+            )
+
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            dataset_dict.pop("sem_seg_file_name", None)
+            return dataset_dict
+
+        if "annotations" in dataset_dict:
+            self._transform_annotations(dataset_dict, transforms, image_shape)
+
+        return dataset_dict
+
+
+class TileStoreDatasetMapper(SpacenetDatasetMapper):
+    """
+    Reads the images from the tile store of their folder (see :class:`utils.tilestore.TileStore`)
+    instead of decoding their files. Images are slices of the memory-mapped store, and the
+    dataloader workers share its page cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stores = {}
+
+    def _store(self, folder):
+        if folder not in self._stores:
+            path = os.path.join(folder, "tiles")
+            self._stores[folder] = TileStore(path) if os.path.isdir(path) else None
+        return self._stores[folder]
+
+    def read_image(self, dataset_dict):
+        file_name = dataset_dict["file_name"]
+        store = self._store(os.path.dirname(file_name))
+        if store is None or file_name not in store:
+            return super().read_image(dataset_dict)
+        image = store.get(file_name)
+        # the store holds RGB tiles, flipping the channels is only a view
+        return image[..., ::-1] if self.image_format == "BGR" else image
+
+
+class CachedDatasetMapper(SpacenetDatasetMapper):
+    """
+    Keeps the decoded images in a :class:`utils.imagecache.SharedImageCache` shared by the
+    dataloader workers, so that each tile is only decoded once as long as it fits in the cache.
+    Augmentations run on a copy of the cached image, as on a decoded one.
+    """
+
+    def __init__(self, *args, cache=None, **kwargs):
+        """
+        Args:
+            cache (SharedImageCache): the cache, created once in the main process before the
+                dataloader workers start.
+        """
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    def read_image(self, dataset_dict):
+        file_name = dataset_dict["file_name"]
+        image = self.cache.get(file_name)
+        if image is None:
+            image = super().read_image(dataset_dict)
+            self.cache.put(file_name, image)
+        return image
@@ -0,0 +1,74 @@
+import json
+
+try:
+    import pycocotools.mask as mask_util
+except ImportError:
+    mask_util = None
+
+
+def _require_pycocotools():
+    if mask_util is None:
+        raise ImportError("RLE masks need pycocotools, install it with `pip install pycocotools`")
+
+def polygon_rle(polygons, height, width):
+    """Rasterizes the polygons of an instance into one compressed RLE mask, the same way Detectron2
+    rasterizes polygon segmentations during training
+
+    :param polygons: Flat polygons of the instance as [x0, y0, x1, y1, ...], in the coordinates of the dataset dicts
+    :type polygons: List
+
+    :param height: Height of the image
+    :type height: int
+
+    :param width: Width of the image
+    :type width: int
+
+    :raises ImportError: Raised when pycocotools is not installed.
+
+    :return: Returns the mask as {"size": [height, width], "counts": str}, which can be saved in JSON
+    :rtype: dict
+    """
+    _require_pycocotools()
+    rle = mask_util.merge(mask_util.frPyObjects(polygons, height, width))
+    return {"size": [int(height), int(width)], "counts": rle["counts"].decode("ascii")}
+
+def shape_polygon(shape):
+    """Returns the flat polygon of a region of a region JSON file, as used in the dataset dicts
+
+    :param shape: Shape attributes of the region
+    :type shape: dict
+
+    :return: Returns the polygon as [x0 + 0.5, y0 + 0.5, x1 + 0.5, ...]
+    :rtype: List
+    """
+    return [p for x, y in zip(shape["all_points_x"], shape["all_points_y"]) for p in (x + 0.5, y + 0.5)]
+
+def add_region_rles(json_path):
+    """Rasterizes every polygon of a region JSON file once and stores its RLE mask next to it, in place,
+    as the "rle" of its shape attributes. The width and height of the images must be in their file attributes
+
+    :param json_path: File path of the region JSON file, Ex: "Spacenet/train/AOI_2_Vegas_region_data.json"
+    :type json_path: str
+
+    :raises ImportError: Raised when pycocotools is not installed.
+    :raises KeyError: Raised when the width or height of an image was not recorded.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the number of masks
+    :rtype: int
+    """
+    _require_pycocotools()
+    with open(json_path) as f:
+        imgs_anns = json.load(f)
+
+    count = 0
+    for annots in imgs_anns.values():
+        width, height = annots["file_attributes"]["width"], annots["file_attributes"]["height"]
+        for region in annots["regions"].values():
+            shape = region["shape_attributes"]
+            shape["rle"] = polygon_rle([shape_polygon(shape)], height, width)
+            count += 1
+
+    with open(json_path, "w") as f:
+        json.dump(imgs_anns, f)
+    return count
@@ -0,0 +1,244 @@
+import re
+import json
+import time
+import resource
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    """Named stage timers, counters and gauges of a process. Every stage is written as a JSON line to the
+    metrics file when one is open, a summary is written when it is closed, and the running totals can be
+    served in the Prometheus text format. Recording is thread-safe and costs a lock, so timers and counters
+    are left in the code whether or not the metrics are written anywhere
+
+    :param prefix: Prefix of the Prometheus metric names, defaults to "spacenet"
+    :type prefix: str
+    """
+
+    def __init__(self, prefix="spacenet"):
+        self.prefix = prefix
+        self.labels = {}
+        self.lock = threading.Lock()
+        # name -> [calls, seconds, items]
+        self.stages = defaultdict(lambda: [0, 0.0, 0])
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.start_time = time.time()
+        self.sink = None
+        self.server = None
+
+    @property
+    def enabled(self):
+        return self.sink is not None or self.server is not None
+
+    def open(self, path=None, prometheus_port=None, **labels):
+        """Starts writing the metrics
+
+        :param path: File path of the JSON lines metrics file, appended to, defaults to None which writes no file
+        :type path: str
+
+        :param prometheus_port: Port to serve the metrics on at /metrics in the Prometheus text format,
+        defaults to None which serves nothing
+        :type prometheus_port: int
+
+        :param labels: Added to every line and Prometheus sample, Ex: script="convert_tif"
+        :type labels: str
+        """
+        self.labels = labels
+        if path is not None:
+            self.sink = open(path, "a")
+        if prometheus_port:
+            self._serve(prometheus_port)
+        self.emit("start")
+
+    def increment(self, name, value=1):
+        """Adds :param:`value` to a counter, Ex: increment("bytes_read", 1024)"""
+        with self.lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        """Sets a gauge to :param:`value`"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_time(self, name, seconds, items=0, emit=False):
+        """Adds a duration measured elsewhere to a stage, Ex: from a hot loop that times itself
+
+        :param name: Name of the stage, Ex: "predict"
+        :type name: str
+
+        :param seconds: Duration in seconds
+        :type seconds: float
+
+        :param items: Number of items processed in that time, defaults to 0
+        :type items: int
+
+        :param emit: Write a line to the metrics file, defaults to False as this is called for every item
+        :type emit: bool
+        """
+        with self.lock:
+            stats = self.stages[name]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += items or 0
+        if emit:
+            self.emit("stage", stage=name, seconds=seconds, items=items,
+                      items_per_second=items / seconds if items and seconds > 0 else None,
+                      peak_rss_mb=peak_rss_mb())
+
+    @contextmanager
+    def stage(self, name, items=None, emit=True):
+        """Times the body of a with statement as a stage. The yielded dict takes the number of items processed
+        when it is only known at the end, Ex: ``with metrics.stage("convert") as stage: stage["items"] = n``
+
+        :param name: Name of the stage, Ex: "convert/Vegas/train"
+        :type name: str
+
+        :param items: Number of items processed, defaults to None
+        :type items: int
+
+        :param emit: Write a line to the metrics file when the stage ends, defaults to True
+        :type emit: bool
+        """
+        record = {"items": items}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add_time(name, time.perf_counter() - start, record["items"], emit=emit)
+
+    def emit(self, event, **fields):
+        """Writes a line to the metrics file, with the time, the event and the labels of the process"""
+        if self.sink is None:
+            return
+        line = json.dumps({"time": time.time(), "event": event, **self.labels, **fields})
+        with self.lock:
+            self.sink.write(line + "\n")
+            self.sink.flush()
+
+    def summary(self):
+        """Returns the totals of every stage, counter and gauge, and the peak resident memory
+
+        :rtype: dict
+        """
+        with self.lock:
+            stages = {name: {"calls": calls,
+                             "seconds": seconds,
+                             "items": items,
+                             "items_per_second": items / seconds if items and seconds > 0 else None}
+                      for name, (calls, seconds, items) in self.stages.items()}
+            counters, gauges = dict(self.counters), dict(self.gauges)
+        return {"elapsed": time.time() - self.start_time,
+                "stages": stages,
+                "counters": counters,
+                "gauges": gauges,
+                "peak_rss_mb": peak_rss_mb()}
+
+    def report(self):
+        """Returns a table of the stages by decreasing time, with their share of the wall clock time,
+        followed by the counters
+
+        :rtype: str
+        """
+        summary = self.summary()
+        elapsed = summary["elapsed"]
+        lines = [f"{'stage':<40}{'calls':>8}{'seconds':>12}{'share':>8}{'items/s':>12}"]
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            share = stage["seconds"] / elapsed if elapsed > 0 else 0
+            rate = f"{stage['items_per_second']:.2f}" if stage["items_per_second"] else "-"
+            lines.append(f"{name:<40}{stage['calls']:>8}{stage['seconds']:>12.2f}{share:>8.1%}{rate:>12}")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"{name}: {value:g}")
+        lines.append(f"wall clock: {elapsed:.2f}s, peak RSS: {summary['peak_rss_mb']:.0f} MB")
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        """Returns the running totals in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        summary = self.summary()
+        labels = ",".join(f'{_metric_name(k)}="{_escape(v)}"' for k, v in self.labels.items())
+
+        def sample(name, value, **extra):
+            pairs = ",".join(filter(None, [labels] + [f'{k}="{_escape(v)}"' for k, v in extra.items()]))
+            return f"{name}{{{pairs}}} {value}" if pairs else f"{name} {value}"
+
+        lines = []
+        for field, kind in (("seconds", "stage_seconds_total"), ("items", "stage_items_total"),
+                            ("calls", "stage_calls_total")):
+            name = f"{self.prefix}_{kind}"
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(sample(name, stage[field], stage=stage_name) for stage_name, stage in summary["stages"].items())
+        for counter, value in summary["counters"].items():
+            name = f"{self.prefix}_{_metric_name(counter)}_total"
+            lines += [f"# TYPE {name} counter", sample(name, value)]
+        for gauge, value in summary["gauges"].items():
+            name = f"{self.prefix}_{_metric_name(gauge)}"
+            lines += [f"# TYPE {name} gauge", sample(name, value)]
+        lines += [f"# TYPE {self.prefix}_peak_rss_bytes gauge",
+                  sample(f"{self.prefix}_peak_rss_bytes", int(summary["peak_rss_mb"] * 2 ** 20))]
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+
+    def close(self):
+        """Writes the summary to the metrics file and stops writing the metrics"""
+        self.emit("summary", **self.summary())
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def peak_rss_mb():
+    """Returns the peak resident memory in MB of this process or of the largest of its finished children,
+    Ex: the workers of a pool"""
+    # kilobytes on Linux
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / 1024
+
+def add_metrics_arguments(parser):
+    """Adds the --metrics and --prometheus-port options of the pipeline scripts to an argparse parser"""
+    parser.add_argument("--metrics", metavar="FILE", help="Append stage timings and counters to this JSON lines file")
+    parser.add_argument(
+        "--prometheus-port",
+        type=int,
+        help="Serve the running metrics on this port at /metrics in the Prometheus text format",
+    )
+    return parser
+
+
+# Metrics of this process, shared by the modules of the pipeline
+metrics = Metrics()
@@ -0,0 +1,254 @@
+import json
+import cv2 as cv
+import numpy as np
+
+
+def remove_duplicate_points(points):
+    """Removes the vertices equal to the previous one, including a closing vertex equal to the first one
+
+    :param points: Vertices of a ring of shape (N, 2)
+    :type points: numpy.array
+
+    :return: Returns the vertices without consecutive duplicates
+    :rtype: numpy.array
+    """
+    if len(points) < 2:
+        return points
+    keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+    if not keep.any():
+        return points[:1]
+    return points[keep]
+
+def remove_collinear_points(points):
+    """Removes the vertices lying on the line through their neighbours, including spikes going back on themselves
+
+    :param points: Vertices of a ring of shape (N, 2), without consecutive duplicates
+    :type points: numpy.array
+
+    :return: Returns the vertices where the ring changes direction
+    :rtype: numpy.array
+    """
+    # removing vertices can make their neighbours collinear or duplicated, Ex: the base of a spike
+    while len(points) >= 3:
+        before = points - np.roll(points, 1, axis=0)
+        after = np.roll(points, -1, axis=0) - points
+        keep = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0] != 0
+        if keep.all():
+            break
+        points = remove_duplicate_points(points[keep])
+    return points
+
+def _douglas_peucker_mask(points, tolerance):
+    """Returns the vertices of an open polyline kept by the Douglas-Peucker algorithm, as a boolean mask"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+def douglas_peucker(points, tolerance):
+    """Simplifies a ring with the Douglas-Peucker algorithm. The ring is split at its first vertex and the
+    vertex farthest from it, and both halves are simplified as open polylines
+
+    :param points: Vertices of a ring of shape (N, 2)
+    :type points: numpy.array
+
+    :param tolerance: Largest distance, in pixels, between the ring and its simplification
+    :type tolerance: float
+
+    :return: Returns the kept vertices, in order
+    :rtype: numpy.array
+    """
+    if tolerance <= 0 or len(points) <= 3:
+        return points
+    farthest = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    if farthest == 0:
+        return points[:1]
+    closed = np.concatenate([points, points[:1]])
+    keep = np.zeros(len(closed), dtype=bool)
+    keep[:farthest + 1] = _douglas_peucker_mask(closed[:farthest + 1], tolerance)
+    keep[farthest:] |= _douglas_peucker_mask(closed[farthest:], tolerance)
+    return points[keep[:-1]]
+
+def clip_polygon(points, width, height):
+    """Clips a ring to the tile, whose pixel centers go from 0 to width - 1 and height - 1,
+    with the Sutherland-Hodgman algorithm
+
+    :param points: Vertices of a ring of shape (N, 2)
+    :type points: numpy.array
+
+    :param width: Width of the tile
+    :type width: int
+
+    :param height: Height of the tile
+    :type height: int
+
+    :return: Returns the vertices of the clipped ring, as floats. It is empty when the ring is outside of the tile
+    :rtype: numpy.array
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) and points.min() >= 0 and points[:, 0].max() <= width - 1 and points[:, 1].max() <= height - 1:
+        return points
+
+    # (axis, bound, keep the side above the bound)
+    for axis, bound, above in [(0, 0, True), (0, width - 1, False), (1, 0, True), (1, height - 1, False)]:
+        if len(points) == 0:
+            break
+        inside = points[:, axis] >= bound if above else points[:, axis] <= bound
+        previous, previous_inside = points[-1], inside[-1]
+        clipped = []
+        for point, point_inside in zip(points, inside):
+            if point_inside != previous_inside:
+                t = (bound - previous[axis]) / (point[axis] - previous[axis])
+                clipped.append(previous + t * (point - previous))
+            if point_inside:
+                clipped.append(point)
+            previous, previous_inside = point, point_inside
+        points = np.array(clipped, dtype=np.float64).reshape(-1, 2)
+    return points
+
+def polygon_area(points):
+    """Returns the signed area of a ring with the shoelace formula"""
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+def clean_polygon(all_points_x, all_points_y, tolerance=0.0, width=None, height=None):
+    """Validates and simplifies the polygon of a building: removes duplicate and collinear vertices, clips it to
+    the tile, simplifies it with the Douglas-Peucker algorithm and drops it if no area is left
+
+    :param all_points_x: x coordinates of the polygon, in pixels
+    :type all_points_x: List
+
+    :param all_points_y: y coordinates of the polygon, in pixels
+    :type all_points_y: List
+
+    :param tolerance: Douglas-Peucker tolerance in pixels, defaults to 0.0 which only removes redundant vertices
+    :type tolerance: float
+
+    :param width: Width of the tile, defaults to None which does not clip the polygon
+    :type width: int
+
+    :param height: Height of the tile, defaults to None which does not clip the polygon
+    :type height: int
+
+    :return: Returns the x and y coordinates of the polygon as Lists of int, or None if the polygon is invalid
+    :rtype: Tuple
+    """
+    points = np.column_stack([all_points_x, all_points_y]).astype(np.int64)
+    points = remove_duplicate_points(points)
+    if width is not None and height is not None:
+        # vertices created by the clipping are rounded back to pixels
+        points = np.rint(clip_polygon(points, width, height)).astype(np.int64)
+        points = remove_duplicate_points(points)
+    points = remove_collinear_points(points)
+    points = douglas_peucker(points, tolerance)
+    if len(points) < 3 or polygon_area(points) == 0:
+        return None
+    return points[:, 0].tolist(), points[:, 1].tolist()
+
+def simplify_region_json(json_path, tolerance=0.0, clip=True):
+    """Cleans every polygon of a region JSON file with :func:`clean_polygon`, in place. Invalid polygons are
+    dropped and the regions of each image renumbered
+
+    :param json_path: File path of the region JSON file, Ex: "Spacenet/train/AOI_2_Vegas_region_data.json"
+    :type json_path: str
+
+    :param tolerance: Douglas-Peucker tolerance in pixels, defaults to 0.0
+    :type tolerance: float
+
+    :param clip: Clip the polygons to their tile, whose dimensions are read from the file attributes, defaults to True
+    :type clip: bool
+
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the number of vertices before and after, and the number of dropped polygons
+    :rtype: Tuple
+    """
+    with open(json_path) as f:
+        imgs_anns = json.load(f)
+
+    before = after = dropped = 0
+    for annots in imgs_anns.values():
+        width = annots["file_attributes"].get("width") if clip else None
+        height = annots["file_attributes"].get("height") if clip else None
+        regions = {}
+        for region in annots["regions"].values():
+            shape = region["shape_attributes"]
+            before += len(shape["all_points_x"])
+            polygon = clean_polygon(shape["all_points_x"], shape["all_points_y"], tolerance, width, height)
+            if polygon is None:
+                dropped += 1
+                continue
+            shape["all_points_x"], shape["all_points_y"] = polygon
+            after += len(polygon[0])
+            regions[str(len(regions))] = region
+        annots["regions"] = regions
+
+    with open(json_path, "w") as f:
+        json.dump(imgs_anns, f)
+    return before, after, dropped
+
+def mask_polygons(mask, offset=(0, 0), tolerance=0.0, min_area=1.0):
+    """Extracts the outlines of a binary mask as polygons with OpenCV, only following the outer boundary
+    of each connected region
+
+    :param mask: Binary mask of shape (rows, cols), Ex: the crop of a predicted mask
+    :type mask: numpy.array
+
+    :param offset: (x, y) added to the vertices, Ex: the top left corner of the crop in the image, defaults to (0, 0)
+    :type offset: Tuple
+
+    :param tolerance: Douglas-Peucker tolerance in pixels, defaults to 0.0 which keeps the vertices of the contours
+    :type tolerance: float
+
+    :param min_area: Smallest area in pixels of a polygon, defaults to 1.0
+    :type min_area: float
+
+    :return: Returns the polygons, each an int array of shape (N, 2) of x and y pixel coordinates
+    :rtype: List
+    """
+    contours, _ = cv.findContours(np.ascontiguousarray(mask, dtype=np.uint8), cv.RETR_EXTERNAL,
+                                  cv.CHAIN_APPROX_SIMPLE, offset=tuple(int(v) for v in offset))
+    polygons = []
+    for contour in contours:
+        points = remove_collinear_points(contour.reshape(-1, 2).astype(np.int64))
+        points = douglas_peucker(points, tolerance)
+        if len(points) >= 3 and abs(polygon_area(points)) >= min_area:
+            polygons.append(points)
+    return polygons
+
+def pixel_to_geo(points, geotransform):
+    """Maps pixel coordinates to the coordinates of the reference system of a raster, Ex: longitude and latitude.
+    The coordinates are mapped with the geotransform as they are, without a half pixel offset: the annotations
+    use the ``PolygonWKT_Pix`` coordinates of SpaceNet as pixel indices, shifted by 0.5 to the pixel centers only
+    for the dataset dicts, so the indices of a predicted mask are in the same coordinates as ``PolygonWKT_Pix``,
+    which maps to ``PolygonWKT_Geo`` and the SpaceNet geojson this way
+
+    :param points: x and y pixel coordinates of shape (N, 2), Ex: the vertices of :func:`mask_polygons`
+    :type points: numpy.array
+
+    :param geotransform: GDAL geotransform of the raster, as returned by ``GetGeoTransform``
+    :type geotransform: Tuple
+
+    :return: Returns the coordinates of shape (N, 2)
+    :rtype: numpy.array
+    """
+    x0, dx, rx, y0, ry, dy = geotransform
+    px, py = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+    return np.column_stack([x0 + px * dx + py * rx, y0 + px * ry + py * dy])
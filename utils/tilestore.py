@@ -0,0 +1,193 @@
+import os
+import json
+import numpy as np
+
+from tqdm import tqdm
+from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.functions import to_uint8
+
+
+# Tiles start on 64 byte boundaries inside a shard
+ALIGNMENT = 64
+
+
+def _store_tile(file_path, shard_path, offset, shape, normalize, stats=None):
+    """Converts a single tiff image straight into its slot of a tile store shard. Runs inside the worker
+    processes of :func:`write_tile_store`
+
+    :param file_path: File path of the tiff image
+    :type file_path: str
+
+    :param shard_path: File path of the shard
+    :type shard_path: str
+
+    :param offset: Byte offset of the tile inside the shard
+    :type offset: int
+
+    :param shape: Shape (rows, cols, bands) of the tile
+    :type shape: Tuple
+
+    :param normalize: Indicates whether the tiff image must be normalized
+    :type normalize: bool
+
+    :param stats: Per band lower and upper values to stretch between, defaults to None which uses those of the tile
+    :type stats: Tuple
+
+    :return: Returns None on success, or the error message if the tile could not be converted
+    :rtype: str or None
+    """
+    try:
+        image = gdal.Open(file_path)
+        if image is None:
+            raise FileNotFoundError(f"GDAL could not open {file_path}")
+        arrays = image.ReadAsArray(band_list=[1, 2, 3])
+        if arrays.shape[1:] != tuple(shape[:2]):
+            raise ValueError(f"Expected a {shape[0]}x{shape[1]} tile, read {arrays.shape[1]}x{arrays.shape[2]}")
+
+        slot = np.memmap(shard_path, dtype=np.uint8, mode="r+", offset=offset, shape=tuple(shape))
+        low, high = stats if stats is not None else (None, None)
+        to_uint8(arrays, normalize=normalize, low=low, high=high, out=slot)
+        slot.flush()
+        del slot
+
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+    return None
+
+def write_tile_store(files, path_to_files, dst, shard, normalize=False, stats=None, workers=None):
+    """Packs a list of tiff images into one shard of a tile store: a single uint8 file holding every tile
+    back to back, plus a JSON index of the offset and shape of each tile. Shards of the same folder
+    form one store, see :class:`TileStore`
+
+    :param files: List of the names of the tiff images to be packed
+    :type files: List
+
+    :param path_to_files: File path of the tiff images
+    :type path_to_files: str
+
+    :param dst: Folder of the tile store
+    :type dst: str
+
+    :param shard: Name of the shard, Ex: "AOI_2_Vegas"
+    :type shard: str
+
+    :param normalize: Indicates whether the tiff images must be normalized, defaults to False
+    :type normalize: bool
+
+    :param stats: Per band lower and upper values shared by every tile, as returned by
+    :func:`utils.functions.band_statistics`, defaults to None which stretches each tile by its own range
+    :type stats: Tuple
+
+    :param workers: Number of worker processes, defaults to None which uses every core. 1 converts in this process
+    :type workers: int
+
+    :return: Returns a dictionary mapping each file name to None if it was packed, or to the error message if it failed
+    :rtype: dict
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    os.makedirs(dst, exist_ok=True)
+    shard_path = os.path.join(dst, f"{shard}.u8")
+
+    # Layout from the tiff headers only, no pixels are read here
+    layout, results, offset = {}, {}, 0
+    for item in files:
+        image = gdal.Open(os.path.join(path_to_files, item))
+        if image is None:
+            results[item] = f"FileNotFoundError: GDAL could not open {os.path.join(path_to_files, item)}"
+            continue
+        shape = (image.RasterYSize, image.RasterXSize, 3)
+        layout[item] = (offset, shape)
+        offset += -(-int(np.prod(shape)) // ALIGNMENT) * ALIGNMENT
+
+    np.memmap(shard_path, dtype=np.uint8, mode="w+", shape=(max(offset, 1),)).flush()
+
+    progress = tqdm(total=len(layout), desc=f"Packing TIF images into {shard_path}", ncols=150, bar_format="{l_bar}{bar:10}{r_bar}")
+    if workers == 1:
+        for item, (offset, shape) in layout.items():
+            results[item] = _store_tile(os.path.join(path_to_files, item), shard_path, offset, shape, normalize, stats)
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_store_tile, os.path.join(path_to_files, item), shard_path,
+                                       offset, shape, normalize, stats): item
+                       for item, (offset, shape) in layout.items()}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                progress.update()
+    progress.close()
+
+    index = {"shard": os.path.basename(shard_path),
+             "tiles": {os.path.splitext(item)[0]: [offset, *shape]
+                       for item, (offset, shape) in layout.items() if results[item] is None}
+            }
+    with open(os.path.join(dst, f"{shard}.json"), "w") as f:
+        json.dump(index, f)
+
+    results = {item: results[item] for item in files}
+    for item, error in results.items():
+        if error is not None:
+            tqdm.write(f"Failed to pack {item}: {error}")
+
+    return results
+
+
+class TileStore:
+    """
+    Read-only view of the tile store written by :func:`write_tile_store`.
+    Tiles are returned as slices of memory-mapped shards, so they are neither decoded nor copied,
+    and every process reading the store shares the same page cache.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): folder of the tile store.
+        """
+        self.path = path
+        self._index = {}
+        self._shards = {}
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(path, name)) as f:
+                index = json.load(f)
+            for key, (offset, rows, cols, bands) in index["tiles"].items():
+                self._index[key] = (index["shard"], offset, (rows, cols, bands))
+
+    def _shard(self, shard):
+        # opened lazily so that each dataloader worker maps the shards itself
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.path, shard), dtype=np.uint8, mode="r")
+        return self._shards[shard]
+
+    def get(self, name):
+        """
+        Args:
+            name (str): file name of the tile, with or without its folder and extension.
+
+        Returns:
+            np.ndarray: read-only RGB tile of shape (H, W, 3).
+        """
+        shard, offset, shape = self._index[self.key(name)]
+        size = shape[0] * shape[1] * shape[2]
+        return self._shard(shard)[offset:offset + size].reshape(shape)
+
+    @staticmethod
+    def key(name):
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def __contains__(self, name):
+        return self.key(name) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getstate__(self):
+        # pickling a memmap copies its content, only ship the index to the workers
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
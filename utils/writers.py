@@ -0,0 +1,165 @@
+import os
+import cv2 as cv
+import numpy as np
+
+from PIL import Image
+
+
+def _write_png(path, image, compression=None):
+    """Writes an RGB uint8 image as a png file
+
+    :param path: File path the image will be saved to
+    :type path: str
+
+    :param image: RGB image of shape (rows, cols, 3)
+    :type image: numpy.array
+
+    :param compression: zlib compression level from 0 (fastest) to 9 (smallest), defaults to None which uses 1
+    :type compression: int
+    """
+    level = 1 if compression is None else compression
+    if not cv.imwrite(path, image[..., ::-1], [cv.IMWRITE_PNG_COMPRESSION, level]):
+        raise OSError(f"Could not write {path}")
+
+def _write_webp(path, image, compression=None):
+    """Writes an RGB uint8 image as a lossless webp file. :param:`compression` is not used"""
+    # OpenCV switches WebP to lossless mode for qualities above 100
+    if not cv.imwrite(path, image[..., ::-1], [cv.IMWRITE_WEBP_QUALITY, 101]):
+        raise OSError(f"Could not write {path}")
+
+def _write_npy(path, image, compression=None):
+    """Writes an RGB uint8 image as a raw numpy file. :param:`compression` is not used"""
+    np.save(path, np.ascontiguousarray(image))
+
+def _read_cv(path):
+    """Reads a png or webp file into an RGB uint8 image"""
+    image = cv.imread(path, cv.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Could not read {path}")
+    return image[..., ::-1]
+
+def _read_npy(path):
+    """Reads a raw numpy file into an RGB uint8 image"""
+    return np.load(path)
+
+
+# name: (extension, writer, reader)
+IMAGE_FORMATS = {
+    "png": (".png", _write_png, _read_cv),
+    "webp": (".webp", _write_webp, _read_cv),
+    "npy": (".npy", _write_npy, _read_npy),
+}
+
+
+def register_image_format(name, extension, writer, reader):
+    """Adds an output format usable by :func:`write_image` and :func:`read_image`
+
+    :param name: Name of the format, Ex: "png"
+    :type name: str
+
+    :param extension: File extension of the format, Ex: ".png"
+    :type extension: str
+
+    :param writer: Function called as writer(path, image, compression) with an RGB uint8 image
+    :type writer: callable
+
+    :param reader: Function called as reader(path) returning an RGB uint8 image
+    :type reader: callable
+    """
+    IMAGE_FORMATS[name] = (extension, writer, reader)
+
+def image_extension(fmt):
+    """Returns the file extension of an output format
+
+    :param fmt: Name of the format, Ex: "png"
+    :type fmt: str
+
+    :raises ValueError: Raised when the format is unknown.
+
+    :return: File extension including the dot
+    :rtype: str
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format {fmt}, expected one of {sorted(IMAGE_FORMATS)}")
+    return IMAGE_FORMATS[fmt][0]
+
+def write_image(path, image, fmt="png", compression=None):
+    """Writes an RGB uint8 image without going through matplotlib
+
+    :param path: File path the image will be saved to
+    :type path: str
+
+    :param image: RGB image of shape (rows, cols, 3)
+    :type image: numpy.array
+
+    :param fmt: Name of the output format, defaults to "png"
+    :type fmt: str
+
+    :param compression: Compression level passed to the writer, defaults to None
+    :type compression: int
+    """
+    image_extension(fmt)
+    IMAGE_FORMATS[fmt][1](path, image, compression)
+
+def read_image(path, format="RGB"):
+    """Reads an image written in any of the registered formats
+
+    :param path: File path of the image
+    :type path: str
+
+    :param format: Channel order of the returned image, "RGB" or "BGR", defaults to "RGB"
+    :type format: str
+
+    :raises ValueError: Raised when the extension does not belong to a registered format.
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the uint8 image of shape (rows, cols, 3)
+    :rtype: numpy.array
+    """
+    extension = os.path.splitext(path)[1].lower()
+    for ext, _, reader in IMAGE_FORMATS.values():
+        if ext == extension:
+            image = reader(path)
+            break
+    else:
+        raise ValueError(f"No reader registered for {path}")
+
+    if format == "BGR":
+        image = image[..., ::-1]
+    return np.ascontiguousarray(image)
+
+def resolve_image_file(path):
+    """Finds the image a dataset entry refers to, whatever format the dataset was built with.
+    The annotations always name the image with the extension they were created with
+
+    :param path: File path of the image as written in the annotations
+    :type path: str
+
+    :return: Returns :param:`path` if it exists, otherwise the path of the same image in another registered
+    format, or :param:`path` if there is none
+    :rtype: str
+    """
+    if os.path.exists(path):
+        return path
+    stem = os.path.splitext(path)[0]
+    for ext, _, _ in IMAGE_FORMATS.values():
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return path
+
+def image_size(path):
+    """Reads the width and height of an image from its header only, without decoding it
+
+    :param path: File path of the image
+    :type path: str
+
+    :raises FileNotFound: No such file or directory.
+
+    :return: Returns the width and height of the image
+    :rtype: Tuple
+    """
+    if path.lower().endswith(".npy"):
+        rows, cols = np.load(path, mmap_mode="r").shape[:2]
+        return cols, rows
+    with Image.open(path) as image:
+        return image.size